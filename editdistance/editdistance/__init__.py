@@ -1,2 +1,2 @@
-from .bycython import eval, eval_all
-__all__ = ('eval', 'eval_all')
+from .bycython import eval, eval_all, get_num_threads, set_num_threads
+__all__ = ('eval', 'eval_all', 'get_num_threads', 'set_num_threads')
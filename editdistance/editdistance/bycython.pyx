@@ -6,6 +6,7 @@ from libc.stdlib cimport malloc, free
 
 from cython.parallel import prange
 cimport numpy as np
+cimport openmp
 import numpy as np
 from cachetools import LRUCache
 
@@ -36,9 +37,22 @@ cpdef unsigned int eval(object a, object b):
     _DIST_CACHE[key] = dist
     return dist
 
+# Number of OpenMP threads used by `eval_all`. Default to the OpenMP default (e.g., OMP_NUM_THREADS).
+cdef int _num_threads = openmp.omp_get_max_threads()
+
+def set_num_threads(int num_threads):
+    global _num_threads
+    if num_threads < 1:
+        raise ValueError('num_threads must be positive, got %d' % num_threads)
+    _num_threads = num_threads
+
+def get_num_threads():
+    return _num_threads
+
 # DEF MAX_LEN = 1000000
 cpdef object eval_all(object a_list, object b_list):
     cdef unsigned int i, j, l
+    cdef int num_threads = _num_threads
     cdef unsigned int na = len(a_list)
     cdef unsigned int nb = len(b_list)
     # assert na <= MAX_LEN and nb <= MAX_LEN, 'na=%d, nb=%d' %(na, nb)
@@ -64,7 +78,7 @@ cpdef object eval_all(object a_list, object b_list):
         b_lens[i] = l
         bl[i] = hash_object(b, l)
     with nogil:
-        for i in prange(na, num_threads=12):
+        for i in prange(na, num_threads=num_threads):
             for j in range(nb):
                 dists[i, j] = edit_distance(al[i], a_lens[i], bl[j], b_lens[j])
     #free(al)
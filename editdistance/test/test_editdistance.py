@@ -7,6 +7,16 @@ class TestEditDistance(unittest.TestCase):
         self.assertEqual(2, editdistance.eval('abc', 'aec'))
         self.assertEqual(np.asarray([[2, 3], [1, 2]], dtype='int64').tolist(), editdistance.eval_all(['ab', 'abc'], ['bc', 'bcd']).tolist())
 
+    def test_num_threads(self):
+        import editdistance
+        old = editdistance.get_num_threads()
+        editdistance.set_num_threads(2)
+        self.assertEqual(2, editdistance.get_num_threads())
+        self.assertEqual([[2, 3], [1, 2]], editdistance.eval_all(['ab', 'abc'], ['bc', 'bcd']).tolist())
+        with self.assertRaises(ValueError):
+            editdistance.set_num_threads(0)
+        editdistance.set_num_threads(old)
+
     def test_time(self):
         import uuid, editdistance
         strings = [uuid.uuid4().hex.lower()[0:6] for _ in range(5000)]
@@ -0,0 +1,89 @@
+'''
+Measure the memory and time of an M-step batch with the decoder checkpointed in segments of different lengths (see
+``--decoder_ckpt_segment``), and write the results to ``<log_dir>/bench_checkpointing.json``.
+
+Run it like training, e.g., ``python -m nd.benchmark.checkpointing --cfg UgaHebNoSpe --batch_size 500``. By default,
+the segment lengths are 0 (no checkpointing), 1, 2, 4 and the square root of the longest known word, which keeps
+about ``2 * sqrt(T)`` steps of activations instead of ``T``. Every segment length is run once untimed and then
+measured ``bench_repeats`` times. The memory is the increase of the peak over the memory in use before the batch. The
+slowdown and the memory ratio are relative to the first segment length.
+'''
+import json
+import math
+
+import numpy as np
+
+from arglib import parser, use_arguments_as_properties
+from dev_misc import log_pp
+from nd.main import parse_args
+
+from .measure import measure
+
+
+def get_default_segments(max_len):
+    segments = {0, 1, 2, 4, int(round(math.sqrt(max_len)))}
+    return sorted(s for s in segments if s < max_len)
+
+
+@use_arguments_as_properties('ckpt_segments', 'bench_repeats', 'log_dir')
+class CheckpointingBenchmark:
+
+    def __init__(self):
+        from nd.train.manager import Manager
+
+        self.manager = Manager()
+        self.model = self.manager.model
+        self.trainer = self.manager.trainer
+        self.trainer.flow.warm_up()
+        self.batch = next(iter(self.manager.train_data_loader))
+        self.trainer._prepare_flow(self.batch)
+        self.max_len = int(max(self.batch.known.lengths))
+
+    def _m_step_batch(self):
+        self.model.train()
+        self.trainer._do_M_step_batch(self.batch)
+
+    def run(self):
+        results = list()
+        for segment in self.ckpt_segments or get_default_segments(self.max_len):
+            self.model.ckpt_segment = segment
+            self._m_step_batch()
+            measurements = [measure(self._m_step_batch) for _ in range(self.bench_repeats)]
+            increase = [m.increase_mb for m in measurements if m.increase_mb is not None]
+            results.append({'segment': segment, 'time_mean': float(np.mean([m.time for m in measurements])),
+                            'increase_mb': float(np.max(increase)) if increase else None})
+        self.model.ckpt_segment = self.model.decoder_ckpt_segment
+        self._write(results)
+
+    def _write(self, results):
+        from prettytable import PrettyTable as pt
+
+        base = results[0]
+        table = pt()
+        table.field_names = 'segment', 'time (s)', 'slowdown', 'memory (MB)', 'memory ratio'
+        for r in results:
+            memory = ratio = ''
+            if r['increase_mb'] is not None:
+                memory = f"{r['increase_mb']:.1f}"
+                if base['increase_mb']:
+                    ratio = f"{r['increase_mb'] / base['increase_mb']:.2f}"
+            table.add_row([r['segment'] or 'none', f"{r['time_mean']:.4f}",
+                           f"{r['time_mean'] / base['time_mean']:.2f}x", memory, ratio])
+        table.align = 'l'
+        table.title = (f'{len(self.batch.lost.words)} lost x {len(self.batch.known.words)} known words, '
+                       f'{self.max_len} decoder steps')
+        log_pp(table)
+        with open(self.log_dir + '/bench_checkpointing.json', 'w') as fout:
+            json.dump({'max_len': self.max_len, 'results': results}, fout, indent=2)
+
+
+def main():
+    parser.add_argument('--bench_repeats', default=3, dtype=int, help='how many times to measure every segment length')
+    parser.add_argument('--ckpt_segments', default=tuple(), nargs='+', dtype=int,
+                        help='segment lengths to try. 0 means no checkpointing')
+    parse_args()
+    CheckpointingBenchmark().run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+'''
+Compare two results of ``nd.benchmark.main``, e.g., ``python -m nd.benchmark.compare old/bench.json new/bench.json``.
+
+For every stage in both files, print the mean times, the speedup (old time / new time) and the peak memory. With
+``--max_slowdown``, exit with a nonzero status if any stage is slower than that ratio, so that this can guard CI runs.
+'''
+import argparse
+import json
+import sys
+
+
+def load_results(path):
+    with open(path, encoding='utf8') as fin:
+        return json.load(fin)
+
+
+def compare_results(old, new):
+    '''
+    Return one row per stage present in both ``old`` and ``new``, in the order of ``new``.
+    '''
+    old_results = {r['stage']: r for r in old['results']}
+    rows = list()
+    for r in new['results']:
+        if r['stage'] not in old_results:
+            continue
+        o = old_results[r['stage']]
+        rows.append({
+            'stage': r['stage'],
+            'old_time': o['time_mean'],
+            'new_time': r['time_mean'],
+            'speedup': o['time_mean'] / r['time_mean'] if r['time_mean'] > 0 else float('inf'),
+            'old_peak_rss_mb': o['peak_rss_mb'],
+            'new_peak_rss_mb': r['peak_rss_mb'],
+        })
+    return rows
+
+
+def _format_table(rows):
+    header = ['stage', 'old (s)', 'new (s)', 'speedup', 'old rss (MB)', 'new rss (MB)']
+    lines = [[r['stage'], f"{r['old_time']:.4f}", f"{r['new_time']:.4f}", f"{r['speedup']:.2f}x",
+              f"{r['old_peak_rss_mb']:.1f}", f"{r['new_peak_rss_mb']:.1f}"] for r in rows]
+    widths = [max(len(line[i]) for line in [header] + lines) for i in range(len(header))]
+    return '\n'.join('  '.join(cell.ljust(w) for cell, w in zip(line, widths)) for line in [header] + lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('old', help='path to the old results')
+    parser.add_argument('new', help='path to the new results')
+    parser.add_argument('--max_slowdown', type=float,
+                        help='fail if any stage takes longer than this many times its old time')
+    args = parser.parse_args(argv)
+
+    old = load_results(args.old)
+    new = load_results(args.new)
+    for key in ['cog_path', 'git_commit', 'torch', 'cuda']:
+        print(f"{key}: {old['meta'].get(key)} -> {new['meta'].get(key)}")
+    rows = compare_results(old, new)
+    print(_format_table(rows))
+
+    if args.max_slowdown:
+        slow = [r['stage'] for r in rows if r['new_time'] > r['old_time'] * args.max_slowdown]
+        if slow:
+            print(f'Slower than {args.max_slowdown}x: {", ".join(slow)}')
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
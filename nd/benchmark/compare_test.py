@@ -0,0 +1,30 @@
+import json
+import tempfile
+from pathlib import Path
+
+from dev_misc import TestCase
+
+from .compare import compare_results, main
+
+
+def _results(**times):
+    return {'meta': {}, 'results': [{'stage': stage, 'time_mean': t, 'peak_rss_mb': 100.0}
+                                    for stage, t in times.items()]}
+
+
+class TestCompare(TestCase):
+
+    def test_compare_results(self):
+        rows = compare_results(_results(parse=1.0, evaluate=2.0), _results(evaluate=1.0, em_round=3.0))
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['stage'], 'evaluate')
+        self.assertEqual(rows[0]['speedup'], 2.0)
+
+    def test_max_slowdown(self):
+        with tempfile.TemporaryDirectory() as log_dir:
+            old = Path(log_dir) / 'old.json'
+            new = Path(log_dir) / 'new.json'
+            old.write_text(json.dumps(_results(parse=1.0)))
+            new.write_text(json.dumps(_results(parse=1.5)))
+            self.assertEqual(main([str(old), str(new), '--max_slowdown', '2.0']), 0)
+            self.assertEqual(main([str(old), str(new), '--max_slowdown', '1.2']), 1)
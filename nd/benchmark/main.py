@@ -0,0 +1,229 @@
+'''
+Benchmark the hot paths of decipherment one stage at a time, and write the results to ``<log_dir>/bench.json``.
+
+Run it like training, e.g., ``python -m nd.benchmark.main --cfg UgaHebSmallNoSpe [--saved_path <ckpt>]``, and compare
+two runs with ``python -m nd.benchmark.compare <old.json> <new.json>``.
+
+Every stage is run ``bench_warmup`` times first, and then timed ``bench_repeats`` times. Throughput is the number of
+items (words, pairs of lost and known words, or distances) processed per second. Peak memory (see ``measure``) is
+measured over the timed runs only.
+'''
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+import numpy as np
+import torch
+
+import editdistance
+from arglib import parser, use_arguments_as_properties
+from dev_misc import log_pp
+from nd.dataset.charset import get_charset
+from nd.dataset.vocab import build_vocabs, clear_vocabs, get_vocab_size
+from nd.flow.edit_dist import _get_samples, compute_expected_edits
+from nd.flow.min_cost_flow import min_cost_flow
+from nd.magic_tensor.core import ChunkedMagicTensor
+from nd.main import parse_args
+from nd.train.checkpoint import load_checkpoint
+
+from .measure import get_peak_memory, reset_peak_memory, sync, use_cuda
+
+STAGES = ['parse', 'trie_prepare', 'trie_analyze', 'forward_train', 'forward_no_grad', 'expected_edits',
+          'edit_distance', 'min_cost_flow', 'evaluate', 'em_round']
+
+
+def _get_git_commit():
+    try:
+        out = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, timeout=10,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+        return out.stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+@use_arguments_as_properties('cog_path', 'lost_lang', 'known_lang', 'saved_path', 'num_cognates', 'capacity',
+                             'n_similar', 'batch_size', 'cache_dir', 'bench_repeats', 'bench_warmup', 'bench_stages',
+                             'precision', 'quantize_inference', 'log_dir')
+class Benchmark:
+
+    def __init__(self):
+        for stage in self.bench_stages:
+            if stage not in STAGES:
+                raise ValueError(f'Unrecognized stage {stage}. Choose from {STAGES}.')
+        self.results = list()
+
+    def _run_stage(self, name, fn, num_items, unit):
+        """``num_items`` can also be a function that is called after timing."""
+        if name not in self.bench_stages:
+            return
+        for _ in range(self.bench_warmup):
+            fn()
+        resettable = reset_peak_memory()
+        times = list()
+        for _ in range(self.bench_repeats):
+            sync()
+            start = time.perf_counter()
+            fn()
+            sync()
+            times.append(time.perf_counter() - start)
+        if callable(num_items):
+            num_items = num_items()
+        result = {'stage': name, 'repeats': len(times), 'time_mean': float(np.mean(times)),
+                  'time_min': float(np.min(times)), 'time_std': float(np.std(times)), 'items': int(num_items),
+                  'unit': unit, 'throughput': num_items / float(np.mean(times))}
+        result.update(get_peak_memory(resettable))
+        self.results.append(result)
+        log_pp(f"{name}: {result['time_mean']:.4f}s, {result['throughput']:.1f} {unit}/s, "
+               f"peak rss {result['peak_rss_mb']:.1f}MB")
+
+    def _build_vocabs(self):
+        clear_vocabs()
+        build_vocabs(self.cog_path, self.lost_lang, self.known_lang, cache_dir=self.cache_dir)
+
+    def _setup(self):
+        # NOTE The manager builds the vocabs again, so the last vocabs from the parse stage are not used.
+        from nd.train.manager import Manager
+
+        clear_vocabs()
+        self.manager = Manager()
+        self.model = self.manager.model
+        self.trainer = self.manager.trainer
+        if self.saved_path:
+            self.model.load_state_dict(load_checkpoint(self.saved_path, names=['model'])['model'])
+        self.trainer.flow.warm_up()
+        self.entire_batch = self.manager.flow_data_loader.entire_batch
+        self.train_batch = next(iter(self.manager.train_data_loader))
+
+    def _forward(self, batch, train):
+        self.model.train(train)
+        with torch.set_grad_enabled(train):
+            return self.model(batch)
+
+    def run(self):
+        # NOTE The vocab sizes are only known after parsing.
+        self._run_stage('parse', self._build_vocabs,
+                        lambda: get_vocab_size(self.lost_lang) + get_vocab_size(self.known_lang), 'words')
+        self._setup()
+        lost_size = get_vocab_size(self.lost_lang)
+        known_size = get_vocab_size(self.known_lang)
+        num_pairs = lost_size * known_size
+        train_pairs = len(self.train_batch.lost.words) * len(self.train_batch.known.words)
+
+        trie = self.model.trie
+        self._run_stage('trie_prepare', trie._prepare_weight, known_size, 'words')
+
+        # Decoder outputs of the right shapes are enough for the trie.
+        batch = self.entire_batch
+        tl = int(max(batch.known.lengths))
+        nc = len(get_charset(self.known_lang))
+        bs, sl = batch.lost.id_seqs.shape
+        log_probs = torch.log_softmax(torch.randn(tl, nc, bs), dim=1).to(batch.lost.id_seqs.device)
+        almt_distr = torch.softmax(torch.randn(bs, tl, sl), dim=-1).to(batch.lost.id_seqs.device)
+
+        def trie_analyze():
+            chunk_size = self.model.score_chunk_size
+            with torch.no_grad():
+                ret = trie.analyze(log_probs, almt_distr, batch.known.words, batch.lost.lengths,
+                                   chunk_size=chunk_size)
+                if chunk_size > 0:
+                    # NOTE Only a lazy score function is returned, so reduce over all the chunks to time computing them.
+                    ChunkedMagicTensor(ret.score_chunk, batch.lost.words, batch.known.words,
+                                       chunk_size).logsumexp_over_cols()
+
+        self._run_stage('trie_analyze', trie_analyze, num_pairs, 'pairs')
+        self._run_stage('forward_train', lambda: self._forward(self.train_batch, True), train_pairs, 'pairs')
+        self._run_stage('forward_no_grad', lambda: self._forward(batch, False), num_pairs, 'pairs')
+
+        model_ret = self._forward(batch, False)
+        known_charset = get_charset(self.known_lang)
+        known_forms = batch.known.forms
+
+        def expected_edits():
+            with torch.no_grad():
+                return compute_expected_edits(known_charset, model_ret.log_probs, known_forms,
+                                              model_ret.valid_log_probs, edit=True,
+                                              chunk_size=self.model.edit_chunk_size, **self.model._sampling_kwargs)
+
+        self._run_stage('expected_edits', expected_edits, num_pairs, 'pairs')
+
+        with torch.no_grad():
+            tokens, _, _ = _get_samples(known_charset, model_ret.log_probs, known_forms, model_ret.valid_log_probs,
+                                        self.model.num_samples, 1e1)
+        sample_forms = tokens.flatten()
+        self._run_stage('edit_distance', lambda: editdistance.eval_all(known_forms, sample_forms),
+                        len(known_forms) * len(sample_forms), 'distances')
+
+        dists = expected_edits().cpu().numpy()
+        self._run_stage('min_cost_flow',
+                        lambda: min_cost_flow(dists, self.num_cognates, capacity=self.capacity[0],
+                                              n_similar=self.n_similar),
+                        num_pairs, 'pairs')
+
+        eval_size = self.manager.eval_data_loader.size(self.lost_lang)
+        self._run_stage('evaluate', lambda: self.manager.evaluator.evaluate(0, self.num_cognates), eval_size, 'words')
+
+        def em_round():
+            with torch.no_grad():
+                self.trainer.flow.update(self.model, self.manager.flow_data_loader, self.num_cognates, True,
+                                         self.capacity[0])
+            self.trainer._M_step_kernel()
+
+        self._run_stage('em_round', em_round, num_pairs, 'pairs')
+        self._write()
+
+    def _get_metadata(self):
+        meta = {
+            'time': datetime.now().isoformat(timespec='seconds'),
+            'argv': sys.argv,
+            'git_commit': _get_git_commit(),
+            'host': platform.node(),
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'torch': torch.__version__,
+            'numpy': np.__version__,
+            'cpu_count': os.cpu_count(),
+            'torch_num_threads': torch.get_num_threads(),
+            'edit_distance_threads': getattr(editdistance, 'get_num_threads', lambda: None)(),
+            'cuda': torch.cuda.get_device_name() if use_cuda() else None,
+            'cog_path': self.cog_path,
+            'lost_lang': self.lost_lang,
+            'known_lang': self.known_lang,
+            'lost_size': get_vocab_size(self.lost_lang),
+            'known_size': get_vocab_size(self.known_lang),
+            'batch_size': self.batch_size,
+            'num_cognates': self.num_cognates,
+            'saved_path': self.saved_path,
+            'precision': self.precision,
+            'quantize_inference': self.quantize_inference,
+        }
+        return meta
+
+    def _write(self):
+        from prettytable import PrettyTable as pt
+
+        table = pt()
+        table.field_names = 'stage', 'time', 'throughput', 'peak rss (MB)'
+        for r in self.results:
+            table.add_row([r['stage'], f"{r['time_mean']:.4f}", f"{r['throughput']:.1f} {r['unit']}/s",
+                           f"{r['peak_rss_mb']:.1f}"])
+        table.align = 'l'
+        log_pp(table)
+        with open(self.log_dir + '/bench.json', 'w') as fout:
+            json.dump({'meta': self._get_metadata(), 'results': self.results}, fout, indent=2)
+
+
+def main():
+    parser.add_argument('--bench_repeats', default=3, dtype=int, help='how many times to time every stage')
+    parser.add_argument('--bench_warmup', default=1, dtype=int, help='how many untimed runs before timing a stage')
+    parser.add_argument('--bench_stages', default=tuple(STAGES), nargs='+', dtype=str,
+                        help='which stages to run')
+    parse_args()
+    Benchmark().run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+'''
+Helpers to time a function and measure its peak memory. On the cpu, the peak is the high water mark of the resident
+set size (reset through ``/proc/self/clear_refs``, or the peak of the whole process if that is not available), and on
+the gpu, it is ``torch.cuda.max_memory_allocated``.
+'''
+import os
+import resource
+import sys
+import time
+
+import torch
+
+from dev_misc import Map
+
+_MB = 1024 * 1024
+
+
+def use_cuda():
+    return bool(os.environ.get('CUDA_VISIBLE_DEVICES', False))
+
+
+def sync():
+    if use_cuda():
+        torch.cuda.synchronize()
+
+
+def reset_peak_memory():
+    '''
+    Reset the peak memory counters. Return whether the cpu counter (VmHWM) can be reset.
+    '''
+    if use_cuda():
+        torch.cuda.reset_peak_memory_stats()
+    try:
+        # NOTE Writing 5 to clear_refs resets the peak resident set size of this process (Linux 4.0+).
+        with open('/proc/self/clear_refs', 'w') as fout:
+            fout.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _read_status(field):
+    """Return ``field`` (e.g., VmHWM) of /proc/self/status in MB, or None if not available."""
+    try:
+        with open('/proc/self/status') as fin:
+            for line in fin:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def get_peak_memory(resettable):
+    ret = dict()
+    peak = _read_status('VmHWM') if resettable else None
+    if peak is not None:
+        ret['peak_rss_mb'] = peak
+        ret['peak_rss_source'] = 'VmHWM'
+    else:
+        # NOTE `ru_maxrss` is in KB on Linux (and in bytes on macOS), and it cannot be reset.
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        ret['peak_rss_mb'] = maxrss / (_MB if sys.platform == 'darwin' else 1024)
+        ret['peak_rss_source'] = 'ru_maxrss'
+    if use_cuda():
+        ret['peak_cuda_mb'] = torch.cuda.max_memory_allocated() / _MB
+    return ret
+
+
+def get_current_memory():
+    """Return the memory in use now in MB: allocated by cuda if it is used, and the resident set size otherwise."""
+    if use_cuda():
+        return torch.cuda.memory_allocated() / _MB
+    return _read_status('VmRSS') or 0.0
+
+
+def measure(fn):
+    '''
+    Call ``fn`` once. Return its time, peak memory, and increase of memory over what was in use before the call (in
+    MB, None if the peak cannot be reset).
+    '''
+    start_memory = get_current_memory()
+    resettable = reset_peak_memory()
+    sync()
+    start = time.perf_counter()
+    fn()
+    sync()
+    elapsed = time.perf_counter() - start
+    peak = get_peak_memory(resettable)
+    peak_mb = peak['peak_cuda_mb'] if use_cuda() else peak['peak_rss_mb']
+    increase = peak_mb - start_memory if resettable or use_cuda() else None
+    return Map(time=elapsed, increase_mb=increase, **peak)
@@ -0,0 +1,249 @@
+'''
+Plan the resources of a run before launching it: predict the peak memory and time of every stage of a round, pick
+the largest ``edit_chunk_size`` and ``batch_size`` (up to the configured one) that fit in a memory budget, and write
+the result as a new config.
+
+Run it like training, e.g., ``python -m nd.benchmark.planner --cfg OCMC --memory_budget_mb 16000``. This adds a config
+named ``plan_name`` (default "Planned") to ``nd/config/planned.json`` (ignored by git), which is registered by
+``nd.config.planned_config``, so the planned run can be launched by ``python -m nd.main --cfg Planned``.
+
+Every stage is calibrated by running it on the entire lost vocab and two small known batches, and its time and memory
+are extrapolated linearly in the number of (lost, known) pairs (times ``1 + num_samples`` for expected edits). The
+estimates ignore ``score_chunk_size`` and candidate selection, so they are on the safe side for runs that use them.
+'''
+import json
+import logging
+import math
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from arglib import parser, use_arguments_as_properties
+from dev_misc import Map, log_pp
+from nd.dataset.charset import get_charset
+from nd.dataset.vocab import clear_vocabs, get_vocab
+from nd.flow.edit_dist import compute_expected_edits
+from nd.flow.min_cost_flow import min_cost_flow
+from nd.main import parse_args
+
+from .measure import measure, use_cuda
+
+# These fields are written to the planned config.
+CONFIG_FIELDS = ['lost_lang', 'known_lang', 'cog_path', 'num_cognates', 'num_epochs_per_M_step', 'eval_interval',
+                 'check_interval', 'num_rounds', 'batch_size', 'n_similar', 'capacity', 'dropout', 'warm_up_steps',
+                 'hidden_size', 'char_emb_dim', 'num_layers', 'num_samples', 'edit_chunk_size']
+PLANNED_PATH = Path(__file__).resolve().parent.parent / 'config' / 'planned.json'
+_MB = 1024 * 1024
+
+
+class LinearCost:
+    """A cost (time or memory) of ``intercept + slope * units``, fitted on two measurements."""
+
+    def __init__(self, units, values):
+        (u1, u2), (v1, v2) = units, values
+        self.slope = max((v2 - v1) / (u2 - u1), 0.0)
+        self.intercept = max(v1 - self.slope * u1, 0.0)
+
+    def __call__(self, units):
+        return self.intercept + self.slope * units
+
+    def to_dict(self):
+        return {'intercept': self.intercept, 'slope': self.slope}
+
+
+def get_memory_budget():
+    """Return 80% of the total gpu memory if cuda is used, or 80% of the available memory otherwise (in MB)."""
+    if use_cuda():
+        return 0.8 * torch.cuda.get_device_properties(torch.cuda.current_device()).total_memory / _MB
+    try:
+        with open('/proc/meminfo') as fin:
+            for line in fin:
+                if line.startswith('MemAvailable:'):
+                    return 0.8 * int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    raise RuntimeError('Cannot tell the available memory. Set --memory_budget_mb.')
+
+
+def _get_candidates(largest):
+    """``largest`` followed by powers of two below it, down to 16."""
+    candidates = [largest]
+    size = 2 ** int(math.log2(largest))
+    if size == largest:
+        size //= 2
+    while size >= 16:
+        candidates.append(size)
+        size //= 2
+    return candidates
+
+
+@use_arguments_as_properties(*CONFIG_FIELDS, 'memory_budget_mb', 'plan_name', 'plan_path', 'log_dir')
+class Planner:
+
+    def __init__(self):
+        from nd.train.manager import Manager
+
+        clear_vocabs()
+        self.manager = Manager()
+        self.model = self.manager.model
+        self.trainer = self.manager.trainer
+        self.trainer.flow.warm_up()
+        loader = self.manager.train_data_loader
+        self.lost_batch = loader.datasets[self.lost_lang].entire_batch
+        self.known_dataset = loader.datasets[self.known_lang]
+        self.lost_size = len(get_vocab(self.lost_lang))
+        self.known_size = len(get_vocab(self.known_lang))
+
+    def _get_batch(self, known_size):
+        known_batch = self.known_dataset.get_batch(np.arange(known_size))
+        return Map(lost=self.lost_batch, known=known_batch, num_samples=known_size)
+
+    def _calibrate(self, fn, sizes, units_per_size):
+        '''
+        Run ``fn(size)`` once to warm up and once to measure for every size. Return the time and memory costs.
+        '''
+        measurements = list()
+        for size in sizes:
+            fn(size)
+            measurements.append(measure(lambda: fn(size)))
+        units = [units_per_size * size for size in sizes]
+        time_cost = LinearCost(units, [m.time for m in measurements])
+        memory = [m.increase_mb or 0.0 for m in measurements]
+        return Map(time=time_cost, memory=LinearCost(units, memory))
+
+    def _m_step(self, size):
+        batch = self._get_batch(size)
+        self.trainer._prepare_flow(batch)
+        self.trainer._do_M_step_batch(batch)
+
+    def _forward(self, size):
+        self.model.eval()
+        with torch.no_grad():
+            return self.model(self._get_batch(size))
+
+    def _expected_edits(self, size):
+        model_ret = self._forward(size)
+        known_forms = self._get_batch(size).known.forms
+        with torch.no_grad():
+            return compute_expected_edits(get_charset(self.known_lang), model_ret.log_probs, known_forms,
+                                          model_ret.valid_log_probs, edit=True, chunk_size=size,
+                                          **self.model._sampling_kwargs)
+
+    def calibrate(self):
+        small = min(self.known_size, 256)
+        sizes = [max(1, small // 4), small]
+        if sizes[0] == sizes[1]:
+            raise RuntimeError('The known vocab is too small to plan for.')
+        L = self.lost_size
+        costs = dict()
+        costs['m_step_batch'] = self._calibrate(self._m_step, sizes, L)
+        costs['forward_no_grad'] = self._calibrate(self._forward, sizes, L)
+        # NOTE The forward pass is also measured here, but it is much cheaper than the expected edits themselves.
+        costs['expected_edits_chunk'] = self._calibrate(self._expected_edits, sizes, L * (1 + self.num_samples))
+        dists = {size: self._expected_edits(size).cpu().numpy() for size in sizes}
+        costs['flow_solve'] = self._calibrate(
+            lambda size: min_cost_flow(dists[size], min(self.num_cognates, size), capacity=self.capacity[0],
+                                       n_similar=self.n_similar),
+            sizes, L)
+        return costs
+
+    def estimate(self, costs, batch_size, edit_chunk_size):
+        '''
+        Return the estimated peak memory (MB) and time (seconds) of every stage of a round.
+        '''
+        L, K, ns = self.lost_size, self.known_size, self.num_samples
+        num_pairs = L * K
+        # The scores of all pairs, the expected edits of all chunks, and their concatenation.
+        scores_mb = 3 * 4 * num_pairs / _MB
+        num_batches = math.ceil(K / batch_size)
+        num_chunks = math.ceil(K / edit_chunk_size)
+        stages = {
+            'forward_no_grad': (costs['forward_no_grad'].memory(num_pairs), costs['forward_no_grad'].time(num_pairs)),
+            'expected_edits': (scores_mb + costs['expected_edits_chunk'].memory(L * edit_chunk_size * (1 + ns)),
+                               num_chunks * costs['expected_edits_chunk'].time(L * edit_chunk_size * (1 + ns))),
+            'flow_solve': (scores_mb + costs['flow_solve'].memory(num_pairs), costs['flow_solve'].time(num_pairs)),
+            'm_step_epoch': (costs['m_step_batch'].memory(L * batch_size),
+                             num_batches * costs['m_step_batch'].time(L * batch_size)),
+        }
+        ret = {name: {'peak_mb': mem, 'time': t} for name, (mem, t) in stages.items()}
+        e_stages = [ret[name] for name in ['forward_no_grad', 'expected_edits', 'flow_solve']]
+        ret['e_step'] = {'peak_mb': max(s['peak_mb'] for s in e_stages), 'time': sum(s['time'] for s in e_stages)}
+        ret['round'] = {'peak_mb': max(ret['e_step']['peak_mb'], ret['m_step_epoch']['peak_mb']),
+                        'time': ret['e_step']['time'] + self.num_epochs_per_M_step * ret['m_step_epoch']['time']}
+        return ret
+
+    def _pick(self, candidates, get_peak, budget, name):
+        for size in candidates:
+            if get_peak(size) <= budget:
+                return size
+        log_pp(f'No {name} fits in {budget:.0f}MB. Using the smallest one {candidates[-1]}.')
+        return candidates[-1]
+
+    def run(self):
+        budget = self.memory_budget_mb or get_memory_budget()
+        costs = self.calibrate()
+        batch_size = min(self.batch_size or self.known_size, self.known_size)
+        batch_size = self._pick(
+            _get_candidates(batch_size),
+            lambda size: self.estimate(costs, size, self.edit_chunk_size)['m_step_epoch']['peak_mb'],
+            budget, 'batch size')
+        edit_chunk_size = self._pick(_get_candidates(self.known_size),
+                                     lambda size: self.estimate(costs, batch_size, size)['e_step']['peak_mb'],
+                                     budget, 'edit chunk size')
+        estimates = self.estimate(costs, batch_size, edit_chunk_size)
+        self._write(batch_size, edit_chunk_size, budget, costs, estimates)
+
+    def _write(self, batch_size, edit_chunk_size, budget, costs, estimates):
+        from prettytable import PrettyTable as pt
+
+        table = pt()
+        table.field_names = 'stage', 'peak (MB)', 'time (s)'
+        for name, estimate in estimates.items():
+            table.add_row([name, f"{estimate['peak_mb']:.0f}", f"{estimate['time']:.1f}"])
+        table.align = 'l'
+        table.title = (f'{self.lost_size} lost x {self.known_size} known words, batch_size {batch_size}, '
+                       f'edit_chunk_size {edit_chunk_size}, budget {budget:.0f}MB')
+        log_pp(table)
+
+        config = {field: getattr(self, field) for field in CONFIG_FIELDS}
+        config['capacity'] = config['capacity'][0] if len(config['capacity']) == 1 else list(config['capacity'])
+        config.update(batch_size=batch_size, edit_chunk_size=edit_chunk_size)
+        # NOTE Keys starting with '_' are not part of the config.
+        config['_plan'] = {
+            'memory_budget_mb': budget,
+            'lost_size': self.lost_size,
+            'known_size': self.known_size,
+            'max_lost_length': int(get_vocab(self.lost_lang).lengths.max()),
+            'max_known_length': int(get_vocab(self.known_lang).lengths.max()),
+            'costs': {name: {'time': c.time.to_dict(), 'memory': c.memory.to_dict()} for name, c in costs.items()},
+            'estimates': estimates,
+        }
+        plan_path = Path(self.plan_path) if self.plan_path else PLANNED_PATH
+        planned = dict()
+        if plan_path.exists():
+            try:
+                with plan_path.open(encoding='utf8') as fin:
+                    planned = dict(json.load(fin))
+            except (ValueError, TypeError) as e:
+                logging.warning(f'Overwriting unreadable planned configs in {plan_path}: {e}')
+        planned[self.plan_name] = config
+        with plan_path.open('w', encoding='utf8') as fout:
+            json.dump(planned, fout, indent=2)
+        with open(self.log_dir + '/plan.json', 'w', encoding='utf8') as fout:
+            json.dump(config, fout, indent=2)
+        log_pp(f'Wrote config {self.plan_name} to {plan_path}. Launch it with --cfg {self.plan_name}.')
+
+
+def main():
+    parser.add_argument('--memory_budget_mb', default=0, dtype=float,
+                        help='memory budget in MB. 0 means 80% of the gpu memory or of the available memory')
+    parser.add_argument('--plan_name', default='Planned', dtype=str, help='name of the planned config')
+    parser.add_argument('--plan_path', dtype=str,
+                        help='where to write the planned config. Default to nd/config/planned.json')
+    parse_args()
+    Planner().run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,18 @@
+from dev_misc import TestCase
+
+from .planner import LinearCost, _get_candidates
+
+
+class TestPlanner(TestCase):
+
+    def test_linear_cost(self):
+        cost = LinearCost([10, 30], [2.0, 6.0])
+        self.assertAlmostEqual(cost(100), 20.0)
+        # Noisy measurements never give negative costs.
+        cost = LinearCost([10, 30], [6.0, 2.0])
+        self.assertAlmostEqual(cost(100), 6.0)
+
+    def test_get_candidates(self):
+        self.assertListEqual(_get_candidates(500), [500, 256, 128, 64, 32, 16])
+        self.assertListEqual(_get_candidates(64), [64, 32, 16])
+        self.assertListEqual(_get_candidates(10), [10])
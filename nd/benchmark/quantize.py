@@ -0,0 +1,89 @@
+'''
+Compare inference with the dynamically quantized model (``--quantize_inference``) against fp32, and write the results
+to ``<log_dir>/bench_quantize.json``.
+
+Run it like training with a trained model, e.g.,
+``python -m nd.benchmark.quantize --cfg UgaHebSmallNoSpe --saved_path <ckpt>``. For both precisions, every eval
+setting is evaluated once, and the no-grad forward over the entire vocab and the E step are timed ``bench_repeats``
+times after one untimed run. The accuracy of every setting is reported side by side, with the speedup of int8 over
+fp32.
+'''
+import json
+
+import numpy as np
+import torch
+
+from arglib import parser, use_arguments_as_properties
+from dev_misc import log_pp
+from nd.main import parse_args
+from nd.model.quantize import QuantizedInference
+from nd.train.checkpoint import load_checkpoint
+
+from .measure import measure
+
+
+@use_arguments_as_properties('saved_path', 'num_cognates', 'capacity', 'bench_repeats', 'log_dir')
+class QuantizeBenchmark:
+
+    def __init__(self):
+        from nd.train.manager import Manager
+
+        self.manager = Manager()
+        self.model = self.manager.model
+        self.trainer = self.manager.trainer
+        if self.saved_path:
+            self.model.load_state_dict(load_checkpoint(self.saved_path, names=['model'])['model'])
+        self.trainer.flow.warm_up()
+        self.model.eval()
+
+    def _forward_no_grad(self):
+        with torch.no_grad():
+            self.model(self.manager.flow_data_loader.entire_batch)
+
+    def _e_step(self):
+        with torch.no_grad():
+            self.trainer.flow.update(self.model, self.manager.flow_data_loader, self.num_cognates, True,
+                                     self.capacity[0])
+
+    def _time(self, fn):
+        fn()
+        return float(np.mean([measure(fn).time for _ in range(self.bench_repeats)]))
+
+    def _run_one(self, quantized):
+        self.model.quantized = QuantizedInference() if quantized else None
+        ret = {'scores': self.manager.evaluator.evaluate(0, self.num_cognates)}
+        ret['forward_no_grad'] = self._time(self._forward_no_grad)
+        ret['e_step'] = self._time(self._e_step)
+        return ret
+
+    def run(self):
+        results = {'fp32': self._run_one(False), 'int8': self._run_one(True)}
+        self.model.quantized = None
+        self._write(results)
+
+    def _write(self, results):
+        from prettytable import PrettyTable as pt
+
+        fp32, int8 = results['fp32'], results['int8']
+        table = pt()
+        table.field_names = 'metric', 'fp32', 'int8', 'diff'
+        for name, score in fp32['scores'].items():
+            table.add_row([name, f'{score:.3f}', f"{int8['scores'][name]:.3f}",
+                           f"{int8['scores'][name] - score:+.3f}"])
+        for name in ['forward_no_grad', 'e_step']:
+            table.add_row([f'{name} (s)', f'{fp32[name]:.4f}', f'{int8[name]:.4f}',
+                           f'{fp32[name] / int8[name]:.2f}x'])
+        table.align = 'l'
+        log_pp(table)
+        with open(self.log_dir + '/bench_quantize.json', 'w') as fout:
+            json.dump(results, fout, indent=2)
+
+
+def main():
+    parser.add_argument('--bench_repeats', default=3, dtype=int, help='how many times to time every stage')
+    parse_args()
+    QuantizeBenchmark().run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+'''
+Benchmark the estimators of expected edits: E-step time vs. agreement with a reference flow that uses many samples.
+
+Run it like training, e.g., ``python -m nd.benchmark.sampling --cfg UgaHebSmallNoSpe [--saved_path <ckpt>]``.
+'''
+import json
+import time
+
+import numpy as np
+import torch
+from prettytable import PrettyTable as pt
+
+from arglib import parser, use_arguments_as_properties
+from dev_misc import log_pp
+from nd.dataset.charset import get_charset
+from nd.dataset.data_loader import LostKnownDataLoader
+from nd.dataset.vocab import build_vocabs
+from nd.flow.edit_dist import compute_expected_edits
+from nd.flow.min_cost_flow import min_cost_flow
+from nd.main import parse_args
+from nd.model.decipher import DecipherModelWithFlow
+from nd.model.trie import Trie
+from nd.train.checkpoint import load_checkpoint
+
+# sampling, num_samples, adaptive
+_SETTINGS = [
+    ('multinomial', 10, False),
+    ('multinomial', 5, False),
+    ('multinomial', 1, False),
+    ('stratified', 5, False),
+    ('stratified', 2, False),
+    ('gumbel', 5, False),
+    ('gumbel', 2, False),
+    ('multinomial', 10, True),
+    ('gumbel', 10, True),
+]
+
+
+@use_arguments_as_properties('cog_path', 'lost_lang', 'known_lang', 'saved_path', 'num_cognates', 'capacity',
+                             'n_similar', 'entropy_per_sample', 'reference_num_samples', 'bench_repeats', 'log_dir')
+class SamplingBenchmark:
+
+    def __init__(self):
+        build_vocabs(self.cog_path, self.lost_lang, self.known_lang)
+        self.data_loader = LostKnownDataLoader(self.lost_lang, self.known_lang, None)
+        self.model = DecipherModelWithFlow(Trie(self.known_lang))
+        if self.saved_path:
+            self.model.load_state_dict(load_checkpoint(self.saved_path, names=['model'])['model'])
+        self.model.eval()
+
+    def _solve(self, model_ret, batch, **kwargs):
+        start = time.perf_counter()
+        expected_edits = compute_expected_edits(get_charset(self.known_lang), model_ret.log_probs, batch.known.forms,
+                                                model_ret.valid_log_probs, edit=True, **kwargs)
+        flow, _ = min_cost_flow(expected_edits.cpu().numpy(), self.num_cognates, capacity=self.capacity[0],
+                                n_similar=self.n_similar)
+        return flow, time.perf_counter() - start
+
+    def run(self):
+        batch = self.data_loader.entire_batch
+        with torch.no_grad():
+            model_ret = self.model(batch)
+            ref_flow, ref_time = self._solve(model_ret, batch, num_samples=self.reference_num_samples)
+            results = list()
+            for sampling, num_samples, adaptive in _SETTINGS:
+                times = list()
+                agreements = list()
+                for _ in range(self.bench_repeats):
+                    flow, elapsed = self._solve(model_ret, batch, num_samples=num_samples, sampling=sampling,
+                                                adaptive=adaptive, entropy_per_sample=self.entropy_per_sample)
+                    times.append(elapsed)
+                    agreements.append((flow * ref_flow).sum() / ref_flow.sum())
+                results.append({'sampling': sampling, 'num_samples': num_samples, 'adaptive': adaptive,
+                                'time': float(np.mean(times)), 'agreement': float(np.mean(agreements))})
+
+        table = pt()
+        table.field_names = 'sampling', 'num_samples', 'adaptive', 'time', 'agreement'
+        for r in results:
+            table.add_row([r['sampling'], r['num_samples'], r['adaptive'], f"{r['time']:.3f}", f"{r['agreement']:.3f}"])
+        table.align = 'l'
+        table.title = f'Reference: {self.reference_num_samples} samples in {ref_time:.3f}s'
+        log_pp(table)
+        with open(self.log_dir + '/bench_sampling.json', 'w') as fout:
+            json.dump({'reference_time': ref_time, 'results': results}, fout, indent=2)
+
+
+def main():
+    parser.add_argument('--reference_num_samples', default=100, dtype=int,
+                        help='number of samples for the reference flow')
+    parser.add_argument('--bench_repeats', default=3, dtype=int, help='how many times to repeat every setting')
+    parse_args()
+    SamplingBenchmark().run()
+
+
+if __name__ == '__main__':
+    main()
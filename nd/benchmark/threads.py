@@ -0,0 +1,124 @@
+'''
+Measure how the cpu-bound stages scale with the number of threads, and write the results to
+``<log_dir>/bench_threads.json``.
+
+Run it like training, e.g., ``python -m nd.benchmark.threads --cfg UgaHebSmallNoSpe --thread_counts 1 2 4 8``. By
+default, the thread counts are the powers of two up to the number of cpus. For every count, ``configure_threads`` sets
+the torch and edit distance threads together (as ``--num_threads`` does for training), and every stage is timed
+``bench_repeats`` times after ``bench_warmup`` untimed runs. The speedup of a stage is its time with one thread over its
+time with the given number of threads.
+'''
+import json
+import os
+
+import numpy as np
+import torch
+
+import editdistance
+from arglib import parser, use_arguments_as_properties
+from dev_misc import log_pp
+from nd.dataset.charset import get_charset
+from nd.flow.edit_dist import _get_samples
+from nd.main import configure_threads, parse_args
+
+from .measure import measure
+
+
+def get_default_thread_counts():
+    """Powers of two up to the number of cpus, and the number of cpus itself."""
+    cpu_count = os.cpu_count() or 1
+    counts = list()
+    n = 1
+    while n < cpu_count:
+        counts.append(n)
+        n *= 2
+    counts.append(cpu_count)
+    return counts
+
+
+@use_arguments_as_properties('known_lang', 'num_samples', 'num_workers', 'bench_repeats', 'bench_warmup',
+                             'thread_counts', 'log_dir')
+class ThreadBenchmark:
+
+    def __init__(self):
+        from nd.train.manager import Manager
+
+        self.manager = Manager()
+        self.model = self.manager.model
+        self.trainer = self.manager.trainer
+        self.trainer.flow.warm_up()
+        self.entire_batch = self.manager.flow_data_loader.entire_batch
+        self.train_batch = next(iter(self.manager.train_data_loader))
+        self.trainer._prepare_flow(self.train_batch)
+
+        batch = self.entire_batch
+        self.known_forms = batch.known.forms
+        with torch.no_grad():
+            self.model.eval()
+            model_ret = self.model(batch)
+            tokens, _, _ = _get_samples(get_charset(self.known_lang), model_ret.log_probs, self.known_forms,
+                                        model_ret.valid_log_probs, self.num_samples, 1e1)
+        self.sample_forms = tokens.flatten()
+
+    def _forward_no_grad(self):
+        self.model.eval()
+        with torch.no_grad():
+            self.model(self.entire_batch)
+
+    def _time(self, fn):
+        for _ in range(self.bench_warmup):
+            fn()
+        return float(np.mean([measure(fn).time for _ in range(self.bench_repeats)]))
+
+    def run(self):
+        stages = {
+            'forward_no_grad': self._forward_no_grad,
+            'edit_distance': lambda: editdistance.eval_all(self.known_forms, self.sample_forms),
+            'm_step_batch': lambda: self.trainer._do_M_step_batch(self.train_batch),
+        }
+        thread_counts = self.thread_counts or get_default_thread_counts()
+        results = list()
+        for num_threads in thread_counts:
+            configure_threads(num_threads, num_workers=self.num_workers)
+            for name, fn in stages.items():
+                results.append({'stage': name, 'num_threads': num_threads, 'time_mean': self._time(fn)})
+                log_pp(f"{name} with {num_threads} threads: {results[-1]['time_mean']:.4f}s")
+        add_speedups(results)
+        self._write(results)
+
+    def _write(self, results):
+        from prettytable import PrettyTable as pt
+
+        table = pt()
+        table.field_names = 'stage', 'threads', 'time', 'speedup'
+        for r in results:
+            table.add_row([r['stage'], r['num_threads'], f"{r['time_mean']:.4f}", f"{r['speedup']:.2f}x"])
+        table.align = 'l'
+        log_pp(table)
+        meta = {'cpu_count': os.cpu_count(), 'torch': torch.__version__, 'num_workers': self.num_workers}
+        with open(self.log_dir + '/bench_threads.json', 'w') as fout:
+            json.dump({'meta': meta, 'results': results}, fout, indent=2)
+
+
+def add_speedups(results):
+    '''
+    Add the speedup over the smallest thread count of the same stage to every result.
+    '''
+    base = dict()
+    for r in sorted(results, key=lambda r: r['num_threads']):
+        base.setdefault(r['stage'], r['time_mean'])
+    for r in results:
+        r['speedup'] = base[r['stage']] / r['time_mean'] if r['time_mean'] > 0 else float('inf')
+
+
+def main():
+    parser.add_argument('--bench_repeats', default=3, dtype=int, help='how many times to time every stage')
+    parser.add_argument('--bench_warmup', default=1, dtype=int, help='how many untimed runs before timing a stage')
+    parser.add_argument('--thread_counts', default=tuple(), nargs='+', dtype=int,
+                        help='numbers of threads to try. Default to powers of two up to the number of cpus')
+    parse_args()
+    ThreadBenchmark().run()
+
+
+if __name__ == '__main__':
+    main()
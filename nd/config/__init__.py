@@ -2,4 +2,5 @@ from arglib import create_registry
 
 registry = create_registry('model')
 
-from . import decipher_config
\ No newline at end of file
+from . import decipher_config
+from . import planned_config
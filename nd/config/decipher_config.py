@@ -23,6 +23,22 @@ class UgaHebSmallNoSpe:
     warm_up_steps: int = 5
     #gpu: int = 0                                                                                        # hs 20240109 #kagayaki
 
+@register
+class UgaHebNoSpe:
+    lost_lang: str = 'uga-no_spe'
+    known_lang: str = 'heb-no_spe'
+    cog_path: str = 'data/uga-heb.no_spe.cog'
+    num_cognates: int = 2182
+    num_epochs_per_M_step: int = 150
+    eval_interval: int = 10
+    check_interval: int = 10
+    num_rounds: int = 10
+    batch_size: int = 500
+    n_similar: int = 5
+    capacity: int = 3
+    dropout: float = 0.3
+    warm_up_steps: int = 5
+
 @register
 class KorWuu:                                                                                           # hs 20240319
     lost_lang: str = 'kor'
@@ -76,3 +92,20 @@ class OCMCtri:
     dropout: float = 0.3
     warm_up_steps: int = 5
     #gpu: int = 0                                                                                       # hs 20240314 kagayaki            
+
+@register
+class Synthetic:
+    # NOTE Generate the file first by `python -m nd.dataset.synthetic data/synthetic.cog --num_words 10000`.
+    lost_lang: str = 'lost'
+    known_lang: str = 'k1'
+    cog_path: str = 'data/synthetic.cog'
+    num_cognates: int = 10000
+    num_epochs_per_M_step: int = 150
+    eval_interval: int = 10
+    check_interval: int = 10
+    num_rounds: int = 10
+    batch_size: int = 500
+    n_similar: int = 5
+    capacity: int = 3
+    dropout: float = 0.3
+    warm_up_steps: int = 5
@@ -0,0 +1,36 @@
+'''
+Configs written by the resource planner (``python -m nd.benchmark.planner``) to ``planned.json`` next to this file.
+The file is local to every checkout (and not tracked by git). Configs that cannot be read are skipped with a warning,
+so that a stale or hand-edited file never breaks importing ``nd.config``.
+'''
+import json
+import logging
+from pathlib import Path
+from typing import Tuple
+
+from . import registry
+
+PLANNED_PATH = Path(__file__).resolve().parent / 'planned.json'
+
+
+def _register_planned(path):
+    if not path.exists():
+        return
+    try:
+        with path.open(encoding='utf8') as fin:
+            planned = json.load(fin)
+        planned = dict(planned)
+    except (OSError, ValueError, TypeError) as e:
+        logging.warning(f'Skipping planned configs in {path}: {e}')
+        return
+    for name, fields in planned.items():
+        try:
+            # NOTE Keys starting with '_' (e.g., the estimates of the planner) are not part of the config.
+            attrs = {k: tuple(v) if isinstance(v, list) else v for k, v in fields.items() if not k.startswith('_')}
+            annotations = {k: Tuple[int, ...] if isinstance(v, tuple) else type(v) for k, v in attrs.items()}
+            registry.register(type(name, (), dict(attrs, __annotations__=annotations)))
+        except Exception as e:
+            logging.warning(f'Skipping planned config {name} in {path}: {e}')
+
+
+_register_planned(PLANNED_PATH)
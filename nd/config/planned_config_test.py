@@ -0,0 +1,47 @@
+import json
+import tempfile
+from pathlib import Path
+from typing import Tuple
+
+from dev_misc import TestCase, patch
+
+from . import registry
+from .planned_config import _register_planned
+
+
+class TestPlannedConfig(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp_dir.name) / 'planned.json'
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def _register(self, content):
+        """Register the configs in ``content`` and return the classes that reach the registry."""
+        self.path.write_text(content, encoding='utf8')
+        with patch.object(registry, 'register', wraps=registry.register) as patched_register:
+            _register_planned(self.path)
+        return [call[0][0] for call in patched_register.call_args_list]
+
+    def test_bad_file(self):
+        for content in ['{"Planned": {"batch_size": ', '[1, 2]', '{"PlannedTestBad": 3}']:
+            with self.assertLogs(level='WARNING'):
+                registered = self._register(content)
+            self.assertListEqual(registered, [])
+
+    def test_bad_config(self):
+        planned = {'PlannedTestBad': 3, 'PlannedTestGood': {'batch_size': 64}}
+        with self.assertLogs(level='WARNING'):
+            registered = self._register(json.dumps(planned))
+        self.assertListEqual([cls.__name__ for cls in registered], ['PlannedTestGood'])
+
+    def test_good_config(self):
+        planned = {'PlannedTestTuple': {'capacity': [1, 2], 'batch_size': 64, '_plan': {'memory_budget_mb': 100.0}}}
+        cls, = self._register(json.dumps(planned))
+        self.assertEqual(cls.__name__, 'PlannedTestTuple')
+        self.assertTupleEqual(cls.capacity, (1, 2))
+        self.assertEqual(cls.batch_size, 64)
+        self.assertFalse(hasattr(cls, '_plan'))
+        self.assertDictEqual(cls.__annotations__, {'capacity': Tuple[int, ...], 'batch_size': int})
@@ -0,0 +1,57 @@
+'''
+A binary cache for parsed cognate corpora. Every entry is an ``.npz`` file keyed by the content of the corpus, the
+language pair, ``max_size`` and both charsets, so that any change to them simply misses the cache.
+'''
+import hashlib
+import logging
+import os
+from pathlib import Path
+
+import numpy as np
+
+from .charset import get_charset
+
+# NOTE Bump this whenever the content of the cache changes.
+CACHE_VERSION = 1
+
+
+def _hash_file(path):
+    h = hashlib.sha1()
+    with Path(path).open('rb') as fin:
+        for block in iter(lambda: fin.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def get_cache_path(cache_dir, cognate_path, lost_lang, known_lang, max_size=0):
+    h = hashlib.sha1()
+    h.update(_hash_file(cognate_path).encode('utf8'))
+    for lang in [lost_lang, known_lang]:
+        h.update('\t'.join(get_charset(lang)._id2char).encode('utf8'))
+    key = h.hexdigest()[:16]
+    name = f'{Path(cognate_path).name}.{lost_lang}-{known_lang}.{max_size}.v{CACHE_VERSION}.{key}.npz'
+    return Path(cache_dir) / name
+
+
+def load_cache(cache_path):
+    '''
+    Return a dictionary of arrays, or None if there is no cache.
+    '''
+    cache_path = Path(cache_path)
+    if not cache_path.exists():
+        return None
+    with np.load(cache_path, allow_pickle=False) as data:
+        ret = {key: data[key] for key in data.files}
+    logging.info(f'Loaded parsed corpus from {cache_path}')
+    return ret
+
+
+def save_cache(cache_path, **arrays):
+    cache_path = Path(cache_path)
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    # Write to a temporary file first so that a partially written cache is never read.
+    tmp_path = cache_path.with_name(f'{cache_path.name}.{os.getpid()}.tmp')
+    with tmp_path.open('wb') as fout:
+        np.savez(fout, **arrays)
+    os.replace(tmp_path, cache_path)
+    logging.info(f'Saved parsed corpus to {cache_path}')
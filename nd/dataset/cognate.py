@@ -1,7 +1,7 @@
 from collections import defaultdict
 from pathlib import Path
 
-import pandas as pd
+import numpy as np
 
 from dev_misc import cache, counter
 
@@ -44,6 +44,8 @@ class CognateSet:
             return self._data[lang]
 
     def to_df(self):
+        import pandas as pd
+
         data = list()
         for l, s in self._data.items():
             for w in s:
@@ -87,46 +89,107 @@ class CognateDict:
 
     @cache(persist=True, full=False)
     def to_df(self):
+        import pandas as pd
+
         dfs = [cs.to_df() for cs in self._cs.values()]
         return pd.concat(dfs, ignore_index=True)
 
     def get_wordlist(self, lang):
-        df = self.to_df()
-        return sorted(set(df[df['lang'] == lang]['word']))
+        return sorted(self._keys[lang])
 
 
 class CognateList:
     '''
     List of cognates, possibly with noncognates as well. This is the main class used for the stream object.
+
+    Lines are parsed straight into the sorted word lists of both languages and the gold pairs between them, stored as
+    an array of (lost index, known index) rows. Indices are positions in the word lists (and therefore vocab indices).
+    The gold relation is kept as sorted pair keys and per-language has-cognate masks, so that whole arrays of
+    predictions can be scored at once.
     '''
 
     def __init__(self, cognate_path, lost_lang, known_lang, max_size=0):
+        self.lost_lang = lost_lang
+        self.known_lang = known_lang
         self.all_langs = set([lost_lang, known_lang])
 
-        cognates = list()
+        wordsets = {lang: set() for lang in self.all_langs}
+        line_pairs = list()
         with Path(cognate_path).open(encoding='utf8') as fcog:
             header_langs = fcog.readline().strip().split("\t")
             for line in counter(fcog, max_size=max_size):
                 tokens = line.strip().split('\t')
-                cog = CognateSet()
+                words = dict()
                 for l, t in zip(header_langs, tokens):
                     if l in self.all_langs:
-                        cog.add(l, *t.split('|'))
-                cognates.append(cog)
-        self._cognates = cognates
-        self._cognate_dict = CognateDict(self.all_langs)
-        self._cognate_dict.add(*cognates)
+                        words[l] = [w for w in t.split('|') if w != '_']  # '_' is a placeholder.
+                        wordsets[l].update(words[l])
+                if words.get(lost_lang) and words.get(known_lang):
+                    line_pairs.append((words[lost_lang], words[known_lang]))
+
+        wordlists = {lang: sorted(wordsets[lang]) for lang in self.all_langs}
+        lost2id = {w: i for i, w in enumerate(wordlists[lost_lang])}
+        known2id = {w: i for i, w in enumerate(wordlists[known_lang])}
+        pairs = [(lost2id[lw], known2id[kw]) for lost_words, known_words in line_pairs
+                 for lw in lost_words for kw in known_words]
+        self._setup(wordlists, np.asarray(pairs, dtype='int64').reshape(-1, 2))
+
+    @classmethod
+    def from_arrays(cls, lost_lang, known_lang, wordlists, pairs):
+        """Restore a ``CognateList`` from the arrays returned by ``to_arrays`` (e.g., from a cache)."""
+        obj = cls.__new__(cls)
+        obj.lost_lang = lost_lang
+        obj.known_lang = known_lang
+        obj.all_langs = set([lost_lang, known_lang])
+        obj._setup({lang: list(wordlists[lang]) for lang in obj.all_langs}, pairs)
+        return obj
+
+    def to_arrays(self):
+        wordlists = {lang: np.asarray(wordlist, dtype=str) for lang, wordlist in self._wordlists.items()}
+        return wordlists, self._pairs
+
+    def _setup(self, wordlists, pairs):
+        if len(pairs):
+            pairs = np.unique(pairs, axis=0)
+        self._wordlists = wordlists
+        self._pairs = pairs
+        self._form2id = {lang: {w: i for i, w in enumerate(wordlist)} for lang, wordlist in wordlists.items()}
+        # NOTE `pairs` are unique rows, so the keys are sorted.
+        self._num_known = len(wordlists[self.known_lang])
+        self._pair_keys = pairs[:, 0] * self._num_known + pairs[:, 1]
+        self._masks = dict()
+        for lang, col in [(self.lost_lang, 0), (self.known_lang, 1)]:
+            mask = np.zeros([len(wordlists[lang])], dtype=bool)
+            mask[pairs[:, col]] = True
+            self._masks[lang] = mask
 
     def get_wordlist(self, lang):
-        return self._cognate_dict.get_wordlist(lang)
+        return self._wordlists[lang]
+
+    def get_cognate_mask(self, lang, other_lang):
+        """Return a boolean mask over the words of ``lang``, indicating which have any cognate in ``other_lang``."""
+        if lang == other_lang:
+            return np.ones([len(self._wordlists[lang])], dtype=bool)
+        return self._masks[lang]
+
+    def are_cognates(self, lost_ids, known_ids):
+        '''
+        Return whether every (lost, known) pair of indices is a gold pair. Both arrays are broadcast against each
+        other, e.g., ``lost_ids[:, None]`` and a matrix of top-k known ids.
+        '''
+        keys = np.asarray(lost_ids) * self._num_known + np.asarray(known_ids)
+        pos = np.searchsorted(self._pair_keys, keys)
+        pos = np.minimum(pos, len(self._pair_keys) - 1)
+        return (len(self._pair_keys) > 0) & (self._pair_keys[pos] == keys)
 
     def has_cognate(self, w, lang):
-        cs = self._cognate_dict.find(w.form, w.lang)
-        return lang in cs
+        if w.lang == lang:
+            return w.form in self._form2id[lang]
+        return bool(self._masks[w.lang][self._form2id[w.lang][w.form]])
 
     def is_cognate(self, w1, w2):
-        cs = self._cognate_dict.find(w1.form, w1.lang)
-        if w2.lang in cs:
-            return w2.form in cs[w2.lang]
-        else:
+        if w1.lang == w2.lang:
             return False
+        if w1.lang == self.known_lang:
+            w1, w2 = w2, w1
+        return bool(self.are_cognates(self._form2id[w1.lang][w1.form], self._form2id[w2.lang][w2.form]))
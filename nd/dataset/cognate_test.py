@@ -1,6 +1,7 @@
 from dev_misc import TestCase
 
-from .cognate import CognateSet, CognateDict
+from .cognate import CognateDict, CognateList, CognateSet
+from .vocab import Word
 
 class TestCognateSet(TestCase):
     
@@ -50,3 +51,36 @@ class TestCognateDict(TestCase):
         self.assertSetEqual(cd.find('B2', 'es')['en'], {'A1', 'A2'})
         self.assertSetEqual(cd.find('B3', 'es')['en'], {'A2'})
         
+
+
+class TestCognateList(TestCase):
+
+    def test_cognate_list(self):
+        cog_list = CognateList('data/test.es-fr-en.toy.cog', 'es', 'fr')
+        self.assertListEqual(cog_list.get_wordlist('es'), ['es1', 'es2', 'es3', 'es4'])
+        self.assertListEqual(cog_list.get_wordlist('fr'), ['fr1', 'fr2', 'fr3', 'fr4'])
+        es2 = Word('es', 'es2', 1)
+        es3 = Word('es', 'es3', 2)
+        es4 = Word('es', 'es4', 3)
+        fr3 = Word('fr', 'fr3', 2)
+        self.assertTrue(cog_list.is_cognate(es2, fr3))
+        self.assertTrue(cog_list.is_cognate(fr3, es3))
+        self.assertFalse(cog_list.is_cognate(es4, fr3))
+        self.assertTrue(cog_list.has_cognate(es2, 'fr'))
+        self.assertFalse(cog_list.has_cognate(es4, 'fr'))
+
+    def test_are_cognates(self):
+        cog_list = CognateList('data/test.es-fr-en.toy.cog', 'es', 'fr')
+        ans = cog_list.are_cognates([0, 1, 1, 3], [0, 1, 2, 2])
+        self.assertListEqual(ans.tolist(), [True, True, True, False])
+        topk = cog_list.are_cognates([[0], [3]], [[1, 0], [2, 3]]).any(axis=1)
+        self.assertListEqual(topk.tolist(), [True, False])
+        self.assertListEqual(cog_list.get_cognate_mask('es', 'fr').tolist(), [True, True, True, False])
+        self.assertListEqual(cog_list.get_cognate_mask('fr', 'es').tolist(), [True, True, True, False])
+
+    def test_from_arrays(self):
+        cog_list = CognateList('data/test.es-fr-en.toy.cog', 'es', 'fr')
+        wordlists, pairs = cog_list.to_arrays()
+        restored = CognateList.from_arrays('es', 'fr', wordlists, pairs)
+        self.assertListEqual(restored.get_wordlist('es'), cog_list.get_wordlist('es'))
+        self.assertListEqual(restored._pairs.tolist(), cog_list._pairs.tolist())
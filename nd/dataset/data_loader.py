@@ -1,28 +1,15 @@
 import numpy as np
 import torch
-from torch.utils.data import DataLoader, Dataset
-from prettytable import PrettyTable as pt
+from torch.utils.data import DataLoader, Dataset, Sampler
 
 from arglib import has_properties
-from dev_misc import Map, cache, get_tensor, sort_all
+from dev_misc import Map, cache, get_tensor
+from nd.magic_tensor.axis import as_axis
 
 from .charset import EOW, get_charset
 from .vocab import Word, get_vocab, get_words
 
 
-def pad_to_dense(a, dtype='f'):
-    '''
-    Modified from https://stackoverflow.com/questions/37676539/numpy-padding-matrix-of-different-row-size.
-    '''
-    assert dtype in ['f', 'l']
-    dtype = 'float32' if dtype == 'f' else 'int64'
-    maxlen = max(map(len, a))
-    ret = np.zeros((len(a), maxlen), dtype=dtype)
-    for i, row in enumerate(a):
-        ret[i, :len(row)] += row
-    return ret
-
-
 @has_properties('lang')
 class WordlistDataset(Dataset):
     """This is for one language."""
@@ -30,20 +17,29 @@ class WordlistDataset(Dataset):
     def __init__(self, words, lang):
         assert isinstance(words[0], Word)
         self._words = words
+        # Precompute the vocab indices and the lengths of all words, so that batches can be made from positions directly.
+        self._indices = as_axis(words).ids
+        self.lengths = get_vocab(lang).lengths[self._indices]
 
     def __len__(self):
         return len(self._words)
 
-    @cache(persist=True, full=True)
     @cache(persist=True, full=True)
     def __getitem__(self, idx):
         word = self._words[idx]
         return Map(word=word, form=word.form, lang=self.lang, char_seq=word.char_seq, id_seq=word.id_seq)
 
+    def get_batch(self, positions, use_cuda=True):
+        """Return the batch of words at ``positions`` of this dataset, sorted by length in descending order."""
+        positions = np.asarray(positions, dtype='int64')
+        # NOTE Ties are kept in the given order, as `_Vocab.batch` does.
+        positions = positions[np.argsort(-self.lengths[positions], kind='stable')]
+        return get_vocab(self.lang).batch(self._indices[positions], presorted=True, use_cuda=use_cuda)
+
     @property
     @cache(persist=True)
     def entire_batch(self):
-        return collate_fn([self[i] for i in range(len(self))])
+        return self.get_batch(np.arange(len(self)))
 
 
 class VocabDataset(WordlistDataset):
@@ -52,28 +48,84 @@ class VocabDataset(WordlistDataset):
         super().__init__(get_words(lang), lang)
 
 
-def _get_item(key, batch):
-    return np.asarray([record[key] for record in batch], dtype=object)      # hs 20240219 colab numpy==1.25.2
+class _BatchDataset(Dataset):
+    """Wrap a ``WordlistDataset`` so that every item is a whole batch, indexed by an array of positions."""
+
+    def __init__(self, dataset, use_cuda):
+        self.dataset = dataset
+        self.use_cuda = use_cuda
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, positions):
+        return self.dataset.get_batch(positions, use_cuda=self.use_cuda)
+
+
+def _identity(batch):
+    return batch
+
+
+class PermutationBatchSampler(Sampler):
+    """Chunk a (random) permutation of the dataset into batches of positions."""
+
+    def __init__(self, size, batch_size, shuffle=True):
+        self.size = size
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+    def __len__(self):
+        return (self.size + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        order = np.random.permutation(self.size) if self.shuffle else np.arange(self.size)
+        for i in range(0, self.size, self.batch_size):
+            yield order[i: i + self.batch_size]
+
+
+class LengthBucketBatchSampler(Sampler):
+    '''
+    Group words of similar lengths into the same batch, so that the decoder only runs as many steps as the longest
+    word in each batch needs. Words of the same length are shuffled, and so is the order of the batches.
+    ``rng`` is a ``np.random.RandomState`` to shuffle with, or None to use the global one.
+    '''
+
+    def __init__(self, lengths, batch_size, rng=None):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.rng = np.random if rng is None else rng
 
+    def __len__(self):
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        # NOTE Sort by length first, and then by a random key to break ties.
+        order = np.lexsort([self.rng.rand(len(self.lengths)), self.lengths])
+        batches = [order[i: i + self.batch_size] for i in range(0, len(order), self.batch_size)]
+        for i in self.rng.permutation(len(batches)):
+            yield batches[i].tolist()
 
-def collate_fn(batch):
-    words = _get_item('word', batch)
-    forms = _get_item('form', batch)
-    char_seqs = _get_item('char_seq', batch)
-    id_seqs = _get_item('id_seq', batch)
-    lengths, words, forms, char_seqs, id_seqs = sort_all(words, forms, char_seqs, id_seqs)
-    lengths = get_tensor(lengths, dtype='l')
-    # Trim the id_seqs.
-    max_len = max(lengths).item()
-    id_seqs = pad_to_dense(id_seqs, dtype='l')
-    id_seqs = get_tensor(id_seqs[:, :max_len])
 
-    lang = batch[0].lang
-    return Map(
-        words=words, forms=forms, char_seqs=char_seqs, id_seqs=id_seqs, lengths=lengths, lang=lang)
+def compute_padding_waste(lengths, batches):
+    '''
+    Return the number of decoder steps and the fraction of padded steps for one epoch of ``batches``.
+    '''
+    lengths = np.asarray(lengths)
+    num_steps = 0
+    num_padded = 0
+    num_real = 0
+    for batch in batches:
+        batch_lengths = lengths[batch]
+        max_len = batch_lengths.max()
+        num_steps += max_len
+        num_padded += max_len * len(batch_lengths)
+        num_real += batch_lengths.sum()
+    return num_steps, 1.0 - num_real / num_padded
 
 
 def _prepare_stats(name, *rows):
+    from prettytable import PrettyTable as pt
+
     table = pt()
     table.field_names = 'lang', 'size'
     for row in rows:
@@ -83,10 +135,14 @@ def _prepare_stats(name, *rows):
     return table
 
 
-@has_properties('lost_lang', 'known_lang', 'cognate_only')
+@has_properties('lost_lang', 'known_lang', 'cognate_only', 'bucket')
 class LostKnownDataLoader(DataLoader):
+    '''
+    Every item of this loader is an entire known batch, made by slicing the precomputed padded ids of the vocab with
+    a permutation of positions. Known batches are only prepared in worker processes if ``num_workers`` is positive.
+    '''
 
-    def __init__(self, lost_lang, known_lang, batch_size, cognate_only=False):
+    def __init__(self, lost_lang, known_lang, batch_size, cognate_only=False, bucket=False, num_workers=0):
         self.datasets = dict()
         if not cognate_only:
             self.datasets[self.lost_lang] = VocabDataset(lost_lang)
@@ -95,21 +151,35 @@ class LostKnownDataLoader(DataLoader):
             self.datasets[self.lost_lang] = WordlistDataset(lost_words, lost_lang)
         self.datasets[self.known_lang] = VocabDataset(known_lang)
 
-        if batch_size:
-            shuffle = True
+        known_dataset = self.datasets[self.known_lang]
+        self.known_batch_size = batch_size or len(known_dataset)
+        if batch_size and bucket:
+            sampler = LengthBucketBatchSampler(self._known_lengths, batch_size)
         else:
-            batch_size = len(self.datasets[self.known_lang])
-            shuffle = False
-
-        super().__init__(self.datasets[self.known_lang], batch_size=batch_size,
-                         shuffle=shuffle, collate_fn=collate_fn)
+            sampler = PermutationBatchSampler(len(known_dataset), self.known_batch_size, shuffle=bool(batch_size))
+        kwargs = dict()
+        if num_workers:
+            kwargs['prefetch_factor'] = 2
+        super().__init__(_BatchDataset(known_dataset, use_cuda=not num_workers), sampler=sampler, batch_size=None,
+                         collate_fn=_identity, num_workers=num_workers, **kwargs)
 
     def __iter__(self):
-        for known_batch in super().__iter__():
-            lost_batch = self.datasets[self.lost_lang].entire_batch
+        lost_batch = self.datasets[self.lost_lang].entire_batch
+        if self.known_batch_size >= self.size(self.known_lang):
+            # NOTE Only one batch, which is the same as the (cached) entire batch.
+            known_batches = [self.datasets[self.known_lang].entire_batch]
+        else:
+            known_batches = map(self._to_device, super().__iter__())
+        for known_batch in known_batches:
             num_samples = len(known_batch.words)
             yield Map(lost=lost_batch, known=known_batch, num_samples=num_samples)
 
+    def _to_device(self, known_batch):
+        if self.num_workers:
+            known_batch.id_seqs = get_tensor(known_batch.id_seqs)
+            known_batch.lengths = get_tensor(known_batch.lengths)
+        return known_batch
+
     @property
     @cache(persist=True)
     def entire_batch(self):
@@ -119,6 +189,30 @@ class LostKnownDataLoader(DataLoader):
     def size(self, lang):
         return len(self.datasets[lang])
 
+    @property
+    def _known_lengths(self):
+        return self.datasets[self.known_lang].lengths
+
+    def padding_stats(self, name):
+        """Compare the padded decoder steps of one epoch with random batches and with length-bucketed batches."""
+        from prettytable import PrettyTable as pt
+
+        lengths = self._known_lengths
+        batch_size = self.known_batch_size
+        # NOTE Use a local random state, so that the stats do not change the global one (and the training that follows).
+        rng = np.random.RandomState(0)
+        perm = rng.permutation(len(lengths))
+        random_batches = [perm[i: i + batch_size] for i in range(0, len(perm), batch_size)]
+        bucketed_batches = list(LengthBucketBatchSampler(lengths, batch_size, rng=rng))
+        table = pt()
+        table.field_names = 'batching', 'decoder_steps', 'padding_waste'
+        for batching, batches in [('random', random_batches), ('bucketed', bucketed_batches)]:
+            num_steps, waste = compute_padding_waste(lengths, batches)
+            table.add_row([batching, num_steps, f'{waste:.3f}'])
+        table.align = 'l'
+        table.title = name
+        return table
+
     def stats(self, name):
         row1 = [self.lost_lang, len(self.datasets[self.lost_lang])]
         row2 = [self.known_lang, len(self.datasets[self.known_lang])]
@@ -3,7 +3,8 @@ import numpy as np
 from dev_misc import TestCase
 
 from .charset import EOW
-from .data_loader import VocabDataset, WordlistDataset
+from .data_loader import (LengthBucketBatchSampler, PermutationBatchSampler, VocabDataset, WordlistDataset,
+                          compute_padding_waste)
 from .vocab import build_vocabs, clear_vocabs, get_vocab
 
 
@@ -18,6 +19,18 @@ class TestVocabDataset(TestCase):
         ans = dataset[0].char_seq
         self.assertListEqual(ans.tolist(), np.asarray(['e', 's', '1', EOW]).tolist())
 
+    def test_entire_batch(self):
+        dataset = VocabDataset('es')
+        batch = dataset.entire_batch
+        lengths = batch.lengths.cpu().numpy()
+        self.assertTrue((lengths[:-1] >= lengths[1:]).all())
+        id_seqs = batch.id_seqs.cpu().numpy()
+        self.assertEqual(id_seqs.shape[1], lengths[0])
+        for word, ids, length in zip(batch.words, id_seqs, lengths):
+            self.assertEqual(len(word), length)
+            self.assertListEqual(ids[:length].tolist(), word.id_seq.tolist())
+            self.assertTrue((ids[length:] == 0).all())
+
 
 class TestWordlistDataset(TestCase):
 
@@ -30,3 +43,51 @@ class TestWordlistDataset(TestCase):
         dataset = WordlistDataset(vocab.words[1:], 'es')
         ans = dataset[0].char_seq
         self.assertListEqual(ans.tolist(), np.asarray(['e', 's', '2', EOW]).tolist())
+
+    def test_get_batch(self):
+        vocab = get_vocab('es')
+        dataset = WordlistDataset(vocab.words[1:], 'es')
+        positions = [2, 0, 1]
+        batch = dataset.get_batch(positions)
+        # NOTE All words have the same length, so they keep the given order.
+        self.assertListEqual(batch.forms.tolist(), ['es4', 'es2', 'es3'])
+        self.assertListEqual(batch.lengths.tolist(), [4, 4, 4])
+        self.assertListEqual(batch.id_seqs.tolist(), [dataset[i].id_seq.tolist() for i in positions])
+
+
+class TestPermutationBatchSampler(TestCase):
+
+    def test_basic(self):
+        sampler = PermutationBatchSampler(10, 4)
+        batches = list(sampler)
+        self.assertEqual(len(batches), len(sampler))
+        self.assertListEqual(sorted(np.concatenate(batches).tolist()), list(range(10)))
+
+
+class TestLengthBucketBatchSampler(TestCase):
+
+    def test_basic(self):
+        lengths = [5, 2, 3, 5, 2, 3, 4, 4, 6]
+        sampler = LengthBucketBatchSampler(lengths, 2)
+        batches = list(sampler)
+        self.assertEqual(len(batches), len(sampler))
+        self.assertListEqual(sorted(sum(batches, [])), list(range(len(lengths))))
+        for batch in batches:
+            batch_lengths = [lengths[i] for i in batch]
+            self.assertLessEqual(max(batch_lengths) - min(batch_lengths), 1)
+
+    def test_rng(self):
+        lengths = [5, 2, 3, 5, 2, 3, 4, 4, 6]
+        state = np.random.get_state()[1].copy()
+        batches = list(LengthBucketBatchSampler(lengths, 2, rng=np.random.RandomState(0)))
+        self.assertListEqual(batches, list(LengthBucketBatchSampler(lengths, 2, rng=np.random.RandomState(0))))
+        self.assertTrue((np.random.get_state()[1] == state).all())
+
+    def test_padding_waste(self):
+        lengths = [2, 2, 4, 4]
+        num_steps, waste = compute_padding_waste(lengths, [[0, 2], [1, 3]])
+        self.assertEqual(num_steps, 8)
+        self.assertAlmostEqual(waste, 0.25)
+        num_steps, waste = compute_padding_waste(lengths, [[0, 1], [2, 3]])
+        self.assertEqual(num_steps, 6)
+        self.assertAlmostEqual(waste, 0.0)
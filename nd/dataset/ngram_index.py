@@ -0,0 +1,93 @@
+from collections import defaultdict
+
+import numpy as np
+
+# NOTE Use control characters to mark word boundaries since they do not appear in any charset.
+_BOW = '\x02'
+_EOW = '\x03'
+
+
+def get_ngrams(form, n):
+    form = _BOW + form + _EOW
+    return {form[i: i + n] for i in range(max(len(form) - n + 1, 1))}
+
+
+def map_form(form, mapping):
+    '''
+    Map every character of ``form`` to its most likely counterpart. ``mapping`` is one of the dictionaries returned by
+    ``UniversalCharEmbedding.char_mapping``, whose values are space-separated top choices.
+    '''
+    ret = ''
+    for c in form:
+        ret += mapping[c].split(' ')[0] if c in mapping else c
+    return ret
+
+
+class NgramIndex:
+    '''
+    An inverted index from character n-grams to word ids, used to quickly find lexically similar words. Word lengths
+    are bucketed so that candidates of very different lengths can be filtered out, and so that queries without any
+    shared n-gram still get candidates of similar lengths.
+    '''
+
+    def __init__(self, forms, n=2, max_length_diff=2):
+        self.n = n
+        self.max_length_diff = max_length_diff
+        self.lengths = np.asarray([len(form) for form in forms])
+
+        postings = defaultdict(list)
+        for i, form in enumerate(forms):
+            for ngram in get_ngrams(form, n):
+                postings[ngram].append(i)
+        self._postings = {ngram: np.asarray(ids, dtype='int64') for ngram, ids in postings.items()}
+
+        self._buckets = dict()
+        for length in np.unique(self.lengths):
+            self._buckets[length] = np.where(self.lengths == length)[0]
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def query_one(self, alternatives, limit):
+        '''
+        Return at most ``limit`` word ids for one query. ``alternatives`` are different strings for the same query
+        (e.g., different decoded samples), and the words sharing the most n-grams with them are returned first.
+        '''
+        ngrams = set()
+        for alt in alternatives:
+            ngrams.update(get_ngrams(alt, self.n))
+        hits = [self._postings[ngram] for ngram in ngrams if ngram in self._postings]
+        lengths = np.asarray([len(alt) for alt in alternatives])
+        if hits:
+            ids, counts = np.unique(np.concatenate(hits), return_counts=True)
+            length_diff = np.abs(self.lengths[ids].reshape(-1, 1) - lengths.reshape(1, -1)).min(axis=-1)
+            keep = length_diff <= self.max_length_diff
+            ids = ids[keep]
+            counts = counts[keep]
+            if len(ids) > limit:
+                ids = ids[np.argpartition(-counts, limit - 1)[:limit]]
+        else:
+            ids = np.zeros([0], dtype='int64')
+        if len(ids) < limit:
+            ids = np.concatenate([ids, self._fill(ids, lengths, limit - len(ids))])
+        return ids
+
+    def _fill(self, found, lengths, num):
+        """Get ``num`` more words from the length buckets closest to the query."""
+        target = int(np.round(lengths.mean()))
+        ret = list()
+        for length in sorted(self._buckets, key=lambda l: abs(l - target)):
+            bucket = np.setdiff1d(self._buckets[length], found)
+            ret.append(bucket[:num - sum(map(len, ret))])
+            if sum(map(len, ret)) >= num:
+                break
+        ret = np.concatenate(ret)
+        if len(ret) < num:  # NOTE Not enough words in the index. Just repeat the last one.
+            last = ret[-1:] if len(ret) else found[-1:]
+            ret = np.concatenate([ret, np.repeat(last, num - len(ret))])
+        return ret
+
+    def query(self, queries, limit):
+        """Return a len(queries) x limit array of word ids."""
+        limit = min(limit, len(self))
+        return np.stack([self.query_one(alternatives, limit) for alternatives in queries], axis=0)
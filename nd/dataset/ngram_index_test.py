@@ -0,0 +1,25 @@
+from dev_misc import TestCase
+
+from .ngram_index import NgramIndex, map_form
+
+
+class TestNgramIndex(TestCase):
+
+    def setUp(self):
+        self.forms = ['go', 'good', 'goods', 'bad', 'gone', 'dog', 'do']
+        self.index = NgramIndex(self.forms)
+
+    def test_query(self):
+        ids = self.index.query([['goods'], ['bd']], 2)
+        self.assertHasShape(ids, (2, 2))
+        self.assertSetEqual(set(ids[0]), {1, 2})
+        self.assertIn(3, ids[1])
+
+    def test_fill(self):
+        # Nothing in common, but words of similar lengths are still returned.
+        ids = self.index.query([['xyz']], 3)
+        self.assertEqual(len(set(ids[0])), 3)
+        self.assertSetEqual({len(self.forms[i]) for i in ids[0]}, {2, 3})
+
+    def test_map_form(self):
+        self.assertEqual(map_form('abz', {'a': 'g h', 'b': 'o p'}), 'goz')
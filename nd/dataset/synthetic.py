@@ -0,0 +1,175 @@
+'''
+Generate synthetic cognate files of any size for scaling experiments, e.g.,
+``python -m nd.dataset.synthetic data/synthetic.cog --num_words 100000 --lost_distractors 0.2``.
+
+Known words come from a word list (one word per line) or are drawn at random. Every known word is turned into its lost
+cognate by a regular character mapping (``--substitutions``, or a random permutation of the charset), followed by
+random substitutions, insertions and deletions. Distractors are lost or known words without any cognate. The output
+is a tsv file with the ``lost`` and ``k1`` charsets that ``CognateList`` can read, and that the ``Synthetic`` config
+points to.
+'''
+import argparse
+import logging
+import random
+from pathlib import Path
+
+from .charset import get_charset
+
+LOST_LANG = 'lost'
+KNOWN_LANG = 'k1'
+
+
+def get_chars(lang):
+    return get_charset(lang)._id2char[4:]  # NOTE Skip the special symbols.
+
+
+def random_word(rng, chars, min_length, max_length):
+    length = rng.randint(min_length, max_length)
+    return ''.join(rng.choice(chars) for _ in range(length))
+
+
+def random_wordlist(rng, num_words, chars, min_length=3, max_length=8, exclude=()):
+    '''
+    Draw ``num_words`` distinct random words that are not in ``exclude``.
+    '''
+    words = set()
+    exclude = set(exclude)
+    while len(words) < num_words:
+        word = random_word(rng, chars, min_length, max_length)
+        if word not in exclude:
+            words.add(word)
+    return sorted(words)
+
+
+def read_wordlist(path, chars, num_words=0):
+    '''
+    Read the first tab-separated field of every line in ``path``. Words with characters outside ``chars`` are skipped.
+    '''
+    chars = set(chars)
+    words = set()
+    num_skipped = 0
+    with Path(path).open(encoding='utf8') as fin:
+        for line in fin:
+            word = line.strip().split('\t')[0]
+            if not word or word == '_':
+                continue
+            if set(word) <= chars:
+                words.add(word)
+            else:
+                num_skipped += 1
+    if num_skipped:
+        logging.warning(f'Skipped {num_skipped} words with unknown characters.')
+    words = sorted(words)
+    return words[:num_words] if num_words else words
+
+
+def parse_substitutions(specs, src_chars, tgt_chars, rng):
+    '''
+    Return a character mapping from specs like "p>b". Characters not covered by any spec are mapped by a random
+    permutation.
+    '''
+    mapping = dict()
+    for spec in specs:
+        src, tgt = spec.split('>')
+        if src not in src_chars or tgt not in tgt_chars:
+            raise ValueError(f'Unrecognized characters in substitution {spec}.')
+        mapping[src] = tgt
+    rest_src = [c for c in src_chars if c not in mapping]
+    rest_tgt = [c for c in tgt_chars if c not in mapping.values()]
+    rng.shuffle(rest_tgt)
+    # NOTE If the targets run out, the remaining characters are merged into random ones.
+    for i, c in enumerate(rest_src):
+        mapping[c] = rest_tgt[i] if i < len(rest_tgt) else rng.choice(tgt_chars)
+    return mapping
+
+
+def transform(word, mapping, rng, chars, sub_prob=0.0, ins_prob=0.0, del_prob=0.0):
+    '''
+    Map every character of ``word``, and then apply random edits: every character is deleted with ``del_prob`` or
+    replaced by a random one with ``sub_prob``, and a random character is inserted after it with ``ins_prob``. The
+    result always has at least one character.
+    '''
+    ret = list()
+    for c in word:
+        c = mapping[c]
+        r = rng.random()
+        if r < del_prob:
+            c = None
+        elif r < del_prob + sub_prob:
+            c = rng.choice(chars)
+        if c is not None:
+            ret.append(c)
+        if rng.random() < ins_prob:
+            ret.append(rng.choice(chars))
+    if not ret:
+        ret.append(mapping[word[0]])
+    return ''.join(ret)
+
+
+def generate(num_words, seed=1234, wordlist=None, substitutions=(), sub_prob=0.0, ins_prob=0.0, del_prob=0.0,
+             lost_distractors=0.0, known_distractors=0.0, min_length=3, max_length=8):
+    '''
+    Return the lines (lost, known) of a synthetic cognate file, where '_' marks a missing word.
+    '''
+    rng = random.Random(seed)
+    lost_chars = get_chars(LOST_LANG)
+    known_chars = get_chars(KNOWN_LANG)
+    if wordlist:
+        known_words = read_wordlist(wordlist, known_chars, num_words=num_words)
+    else:
+        known_words = random_wordlist(rng, num_words, known_chars, min_length=min_length, max_length=max_length)
+    mapping = parse_substitutions(substitutions, known_chars, lost_chars, rng)
+    lines = [(transform(w, mapping, rng, lost_chars, sub_prob=sub_prob, ins_prob=ins_prob, del_prob=del_prob), w)
+             for w in known_words]
+
+    lost_words = {lost for lost, _ in lines}
+    num_lost = int(len(known_words) * lost_distractors)
+    for word in random_wordlist(rng, num_lost, lost_chars, min_length=min_length, max_length=max_length,
+                                exclude=lost_words):
+        lines.append((word, '_'))
+    num_known = int(len(known_words) * known_distractors)
+    for word in random_wordlist(rng, num_known, known_chars, min_length=min_length, max_length=max_length,
+                                exclude=known_words):
+        lines.append(('_', word))
+    rng.shuffle(lines)
+    return lines
+
+
+def write_cognate_file(path, lines):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.open('w', encoding='utf8') as fout:
+        fout.write(f'{LOST_LANG}\t{KNOWN_LANG}\n')
+        for lost, known in lines:
+            fout.write(f'{lost}\t{known}\n')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('output', help='path to the output cognate file')
+    parser.add_argument('--num_words', type=int, default=10000, help='number of cognate pairs')
+    parser.add_argument('--wordlist', help='file of known words (one per line). Random words are used if not given')
+    parser.add_argument('--substitutions', nargs='*', default=(),
+                        help='regular character changes from known to lost, e.g., "p>b" "t>d"')
+    parser.add_argument('--sub_prob', type=float, default=0.05, help='probability of a random substitution')
+    parser.add_argument('--ins_prob', type=float, default=0.02, help='probability of a random insertion')
+    parser.add_argument('--del_prob', type=float, default=0.02, help='probability of a random deletion')
+    parser.add_argument('--lost_distractors', type=float, default=0.0,
+                        help='number of lost words without cognates, as a share of num_words')
+    parser.add_argument('--known_distractors', type=float, default=0.0,
+                        help='number of known words without cognates, as a share of num_words')
+    parser.add_argument('--min_length', type=int, default=3, help='minimum length of random words')
+    parser.add_argument('--max_length', type=int, default=8, help='maximum length of random words')
+    parser.add_argument('--seed', type=int, default=1234, help='random seed')
+    args = parser.parse_args(argv)
+
+    lines = generate(args.num_words, seed=args.seed, wordlist=args.wordlist, substitutions=args.substitutions,
+                     sub_prob=args.sub_prob, ins_prob=args.ins_prob, del_prob=args.del_prob,
+                     lost_distractors=args.lost_distractors, known_distractors=args.known_distractors,
+                     min_length=args.min_length, max_length=args.max_length)
+    write_cognate_file(args.output, lines)
+    print(f'Wrote {len(lines)} lines to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,30 @@
+import random
+import tempfile
+from pathlib import Path
+
+from dev_misc import TestCase
+
+from .cognate import CognateList
+from .synthetic import generate, get_chars, parse_substitutions, transform, write_cognate_file
+
+
+class TestSynthetic(TestCase):
+
+    def test_transform(self):
+        rng = random.Random(0)
+        chars = get_chars('lost')
+        mapping = parse_substitutions(['p>b'], get_chars('k1'), chars, rng)
+        self.assertEqual(mapping['p'], 'b')
+        self.assertEqual(transform('pap', mapping, rng, chars), 'b' + mapping['a'] + 'b')
+        for _ in range(100):
+            self.assertTrue(transform('pap', mapping, rng, chars, del_prob=1.0))
+
+    def test_generate(self):
+        lines = generate(100, lost_distractors=0.2, known_distractors=0.1)
+        self.assertEqual(len(lines), 130)
+        with tempfile.TemporaryDirectory() as data_dir:
+            path = Path(data_dir) / 'synthetic.cog'
+            write_cognate_file(path, lines)
+            cog_list = CognateList(path, 'lost', 'k1')
+        self.assertEqual(len(cog_list.get_wordlist('k1')), 110)
+        self.assertEqual(cog_list.get_cognate_mask('k1', 'lost').sum(), 100)
@@ -1,13 +1,17 @@
-from dataclasses import dataclass
+import hashlib
 from pathlib import Path
 
 import numpy as np
+import torch
 
 from arglib import has_properties
-from dev_misc import cache
+from dev_misc import Map, cache, get_tensor
+from nd.magic_tensor.axis import WordAxis
 
-from .charset import EOW, get_charset
+from .charset import EOW, EOW_ID, PAD_ID, get_charset
+from .cache import get_cache_path, load_cache, save_cache
 from .cognate import CognateList
+from .ngram_index import NgramIndex
 
 _VOCABS = dict()
 _COG_LIST = None
@@ -25,10 +29,26 @@ def get_words(lang):
     return get_vocab(lang).words
 
 
+def get_axis(lang):
+    return get_vocab(lang).axis
+
+
 def get_forms(lang):
     return get_vocab(lang).forms
 
 
+def get_fingerprint(*langs):
+    """Return a hash of the vocabs of ``langs``, which changes whenever any word or its index does."""
+    h = hashlib.sha1()
+    for lang in langs:
+        h.update(get_vocab(lang).fingerprint.encode('utf8'))
+    return h.hexdigest()
+
+
+def get_ngram_index(lang):
+    return get_vocab(lang).ngram_index
+
+
 def is_cognate(w1, w2):
     global _COG_LIST
     return _COG_LIST.is_cognate(w1, w2)
@@ -39,6 +59,16 @@ def has_cognate(w, lang):
     return _COG_LIST.has_cognate(w, lang)
 
 
+def get_cognate_mask(lang, other_lang):
+    global _COG_LIST
+    return _COG_LIST.get_cognate_mask(lang, other_lang)
+
+
+def are_cognates(lost_ids, known_ids):
+    global _COG_LIST
+    return _COG_LIST.are_cognates(lost_ids, known_ids)
+
+
 def clear_vocabs():
     global _COG_LIST
     global _VOCABS
@@ -46,33 +76,95 @@ def clear_vocabs():
     _VOCABS = dict()
 
 
-def build_vocabs(path, lost_lang, known_lang, max_size=0):
+def build_vocabs(path, lost_lang, known_lang, max_size=0, cache_dir=None):
+    '''
+    Build the vocabs of both languages from the cognate file at ``path``. If ``cache_dir`` is given, the parsed word
+    lists, packed ids and gold pairs are read from (or saved to) a binary cache there.
+    '''
     global _COG_LIST
 
     assert _COG_LIST is None
-    cog_list = CognateList(path, lost_lang, known_lang, max_size=max_size)
-
-    for lang in [lost_lang, known_lang]:
+    langs = [lost_lang, known_lang]
+    for lang in langs:
         if lang in _VOCABS:
             raise ValueError(f'There already is a vocab for {lang}')
-        _VOCABS[lang] = _Vocab(cog_list.get_wordlist(lang), lang)
+
+    cache_path = get_cache_path(cache_dir, path, lost_lang, known_lang, max_size=max_size) if cache_dir else None
+    cached = load_cache(cache_path) if cache_path else None
+    if cached is not None:
+        wordlists = {lang: cached[f'wordlist_{i}'].tolist() for i, lang in enumerate(langs)}
+        cog_list = CognateList.from_arrays(lost_lang, known_lang, wordlists, cached['pairs'])
+        for i, lang in enumerate(langs):
+            _VOCABS[lang] = _Vocab(wordlists[lang], lang, id_buffer=cached[f'id_buffer_{i}'])
+    else:
+        cog_list = CognateList(path, lost_lang, known_lang, max_size=max_size)
+        for lang in langs:
+            _VOCABS[lang] = _Vocab(cog_list.get_wordlist(lang), lang)
+        if cache_path:
+            wordlists, pairs = cog_list.to_arrays()
+            arrays = {'pairs': pairs}
+            for i, lang in enumerate(langs):
+                arrays[f'wordlist_{i}'] = wordlists[lang]
+                arrays[f'id_buffer_{i}'] = _VOCABS[lang].id_buffer
+            save_cache(cache_path, **arrays)
     _COG_LIST = cog_list
 
 
-@dataclass(frozen=True, order=True)
 class Word:
-    lang: str
-    form: str
-    idx: int
+    '''
+    An immutable word. Words created by a vocab are views into its packed id buffer, so they do not keep any arrays of
+    their own.
+    '''
+
+    __slots__ = ('lang', 'form', 'idx', '_vocab')
+
+    def __init__(self, lang, form, idx, vocab=None):
+        object.__setattr__(self, 'lang', lang)
+        object.__setattr__(self, 'form', form)
+        object.__setattr__(self, 'idx', idx)
+        object.__setattr__(self, '_vocab', vocab)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f'Cannot assign to field {name!r} of an immutable Word.')
+
+    def _key(self):
+        return (self.lang, self.form, self.idx)
+
+    def __eq__(self, other):
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return self._key() == other._key()
+
+    def __lt__(self, other):
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return self._key() < other._key()
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def __repr__(self):
+        return f'Word(lang={self.lang!r}, form={self.form!r}, idx={self.idx!r})'
+
+    def __reduce__(self):
+        return (Word, self._key())
+
+    def __setstate__(self, state):
+        # NOTE Words pickled by older versions (as dataclasses) come with a dictionary of fields.
+        if isinstance(state, tuple):
+            state = state[-1]
+        for name in ['lang', 'form', 'idx']:
+            object.__setattr__(self, name, state[name])
+        object.__setattr__(self, '_vocab', None)
 
     @property
-    @cache(persist=True)
     def char_seq(self):
         return np.asarray(list(self.form) + [EOW])
 
     @property
-    @cache(persist=True)
     def id_seq(self):
+        if self._vocab is not None:
+            return self._vocab.get_id_seq(self.idx)
         return get_charset(self.lang).char2id(self.char_seq)
 
     def __len__(self):
@@ -81,35 +173,101 @@ class Word:
 
 @has_properties('lang')
 class _Vocab:
+    '''
+    All words of one language. Character ids of all words (including EOW) are packed into one contiguous buffer, with
+    ``offsets`` and ``lengths`` indexing into it, and a padded id matrix is precomputed so that batches are just
+    row selections.
+    '''
 
-    def __init__(self, wordlist, lang):
+    def __init__(self, wordlist, lang, id_buffer=None):
         assert len(wordlist) == len(set(wordlist))  # Make sure they are all unique.
-        self._build(wordlist)
+        self._build(wordlist, id_buffer=id_buffer)
 
-    def _build(self, wordlist):
+    def _build(self, wordlist, id_buffer=None):
         self._id2word = list()
         self._form2id = dict()
         for w in wordlist:
-            w = Word(self.lang, w, len(self._id2word))
+            w = Word(self.lang, w, len(self._id2word), vocab=self)
             self._id2word.append(w)
             self._form2id[w.form] = len(self._form2id)
 
+        # Pack the ids.
+        self.lengths = np.asarray([len(w) for w in self._id2word], dtype='int64')
+        self.offsets = np.concatenate([[0], np.cumsum(self.lengths)[:-1]]).astype('int64')
+        if id_buffer is not None:  # NOTE Packed ids might come from a cache.
+            assert len(id_buffer) == self.lengths.sum()
+            self.id_buffer = np.asarray(id_buffer, dtype='int32')
+        else:
+            charset = get_charset(self.lang)
+            chars = list(''.join(wordlist))
+            self.id_buffer = np.full([self.lengths.sum()], EOW_ID, dtype='int32')
+            is_char = np.ones([len(self.id_buffer)], dtype=bool)
+            is_char[self.offsets + self.lengths - 1] = False
+            if chars:
+                self.id_buffer[is_char] = charset.char2id(chars)
+        # Precompute the padded ids. Row-major masking preserves the order of the buffer.
+        max_length = self.lengths.max() if len(self.lengths) else 0
+        padded = np.full([len(self.lengths), max_length], PAD_ID, dtype='int64')
+        padded[np.arange(max_length) < self.lengths.reshape(-1, 1)] = self.id_buffer
+        self._padded_ids = torch.from_numpy(padded)
+
     def __len__(self):
         return len(self._id2word)
 
+    def get_id_seq(self, idx):
+        start = self.offsets[idx]
+        return self.id_buffer[start: start + self.lengths[idx]]
+
+    def batch(self, indices, presorted=False, use_cuda=True):
+        '''
+        Return the batch of the words with ``indices``, sorted by length in descending order (ties are kept in the given
+        order), without any per-word work. If ``presorted`` is set, ``indices`` are assumed to be sorted already. If ``use_cuda`` is not set, tensors are left on cpu (e.g., in data loader workers).
+        '''
+        indices = np.asarray(indices, dtype='int64')
+        if not presorted:
+            order = np.argsort(-self.lengths[indices], kind='stable')
+            indices = indices[order]
+        lengths = self.lengths[indices]
+        max_len = lengths[0] if len(lengths) else 0
+        id_seqs = self._padded_ids.index_select(0, torch.from_numpy(indices))[:, :max_len]
+        lengths = torch.from_numpy(lengths)
+        if use_cuda:
+            id_seqs = get_tensor(id_seqs)
+            lengths = get_tensor(lengths)
+        words = WordAxis(self.words[indices], ids=indices)
+        return Map(words=words, forms=self.forms[indices], id_seqs=id_seqs, lengths=lengths, lang=self.lang)
+
     @property
     @cache(persist=True)
     def words(self):
-        return np.asarray(self._id2word)
+        ret = np.empty([len(self._id2word)], dtype=object)
+        ret[:] = self._id2word
+        return ret
+
+    @property
+    @cache(persist=True)
+    def axis(self):
+        return WordAxis(self.words)
 
     @property
     @cache(persist=True)
     def forms(self):
         return np.asarray([word.form for word in self.words])
 
+    @property
+    @cache(persist=True)
+    def fingerprint(self):
+        h = hashlib.sha1(self.lang.encode('utf8'))
+        h.update('\n'.join(self.forms).encode('utf8'))
+        return h.hexdigest()
+
+    @property
+    @cache(persist=True)
+    def ngram_index(self):
+        return NgramIndex(self.forms)
+
     def cognate_to(self, lang):
-        global _COG_LIST
-        return np.asarray([w for w in self.words if _COG_LIST.has_cognate(w, lang)])
+        return self.words[get_cognate_mask(self.lang, lang)]
 
     def get_word_from_form(self, form):
-        return self._id2word[self._word2id[form]]
+        return self._id2word[self._form2id[form]]
@@ -1,10 +1,10 @@
 from dataclasses import dataclass
 
-from prettytable import PrettyTable as pt
+import torch
 
 from arglib import use_arguments_as_properties
 from dev_misc import log_pp
-from nd.dataset.vocab import is_cognate
+from nd.dataset.vocab import are_cognates
 
 
 @dataclass(frozen=True)
@@ -21,7 +21,7 @@ class EvalSetting:
         return f'lost_{self.lost}__known_{self.known}__mode_{self.mode}__edit_{self.edit}__capacity_{self.capacity}'
 
 
-@use_arguments_as_properties('lost_lang', 'known_lang', 'capacity', 'num_cognates')
+@use_arguments_as_properties('lost_lang', 'known_lang', 'capacity', 'num_cognates', 'eval_topk')
 class Evaluator:
 
     def __init__(self, model, data_loader):
@@ -44,6 +44,8 @@ class Evaluator:
                     EvalSetting(self.lost_lang, self.known_lang, lost_size, known_size, mode, edit, c))
 
     def __str__(self):
+        from prettytable import PrettyTable as pt
+
         table = pt()
         table.field_names = 'lost', 'known', 'lost_size', 'known_size', 'mode', 'edit', 'capacity'
         for s in self._settings:
@@ -52,6 +54,8 @@ class Evaluator:
         return str(table)
 
     def evaluate(self, epoch, num_cognates):
+        from prettytable import PrettyTable as pt
+
         self.model.eval()
         table = pt()
         table.field_names = 'lost', 'known', 'mode', 'edit', 'capacity', 'score'
@@ -59,24 +63,37 @@ class Evaluator:
         eval_scores = dict()
         for s in self._settings:
             batch = self.data_loader.entire_batch
-            model_ret = self.model(batch, mode=s.mode, num_cognates=num_cognates, edit=s.edit, capacity=s.capacity)
+            with torch.no_grad():
+                model_ret = self.model(batch, mode=s.mode, num_cognates=num_cognates, edit=s.edit,
+                                       capacity=s.capacity)
             # Magic tensor to the rescue!
             almt = model_ret.valid_log_probs if s.mode == 'mle' else model_ret.flow
-            preds = almt.get_best()
-            acc = self._evaluate_one_setting(preds)
-            score = acc / len(preds)
-            fmt_score = f'{acc}/{len(preds)}={score:.3f}'
+            _, _, lost_ids, known_ids = almt.get_best_ids()
+            acc = self._evaluate_one_setting(lost_ids, known_ids)
+            total = len(lost_ids)
+            score = acc / total
+            fmt_score = f'{acc}/{total}={score:.3f}'
             table.add_row([getattr(s, field) for field in table.field_names[:-1]] + [fmt_score])
             eval_scores[str(s)] = score
+            # Top-k accuracy only makes sense for scores, not for (integral) flows.
+            if s.mode == 'mle' and self.eval_topk:
+                acc = self._evaluate_topk(almt, self.eval_topk)
+                score = acc / total
+                table.add_row([s.lost, s.known, f'{s.mode}@{self.eval_topk}', s.edit, s.capacity,
+                               f'{acc}/{total}={score:.3f}'])
+                eval_scores[f'{s}__top{self.eval_topk}'] = score
 
         table.align = 'l'
         table.title = f'Epoch: {epoch}'
         log_pp(table)
         return eval_scores
 
-    def _evaluate_one_setting(self, preds):
-        acc = 0
-        for lost, known in preds.items():
-            if is_cognate(lost, known):
-                acc += 1
-        return acc
+    def _evaluate_one_setting(self, lost_ids, known_ids):
+        return are_cognates(lost_ids, known_ids).sum()
+
+    def _evaluate_topk(self, almt, k):
+        """Count the lost words that have a cognate among their ``k`` best known words."""
+        _, best_idx = almt.topk_over_cols(k)
+        lost_ids = almt.row_words.ids.reshape(-1, 1)
+        known_ids = almt.col_words.ids[best_idx.cpu().numpy()]
+        return are_cognates(lost_ids, known_ids).any(axis=1).sum()
@@ -5,18 +5,89 @@ import torch
 
 import editdistance
 from dev_misc import get_tensor
+from nd.profile.core import add_count, phase
 
 
-def compute_expected_edits(known_charset, log_probs, wordlist, valid_log_probs, num_samples=10, alpha=1e1, edit=False):
-    logging.debug('Computing expected edits')
+def _log1mexp(x):
+    """Compute log(1 - exp(x)) for x <= 0 in a numerically stable way."""
+    return torch.where(x > -0.693, torch.log(-torch.expm1(x)), torch.log1p(-torch.exp(x)))
+
+
+def _sample_without_replacement(log_probs, num_samples):
+    '''
+    Draw ``num_samples`` distinct character sequences (bs x tl x ns) by stochastic beam search with Gumbel-top-k
+    (Kool et al., 2019). Since all positions are independent here, this is exact sampling without replacement over
+    whole strings.
+    '''
+    bs, tl, nc = log_probs.shape
+    phi = log_probs.new_zeros(bs, 1)  # log probs of the partial sequences.
+    g = log_probs.new_zeros(bs, 1)  # perturbed log probs of the partial sequences.
+    seqs = log_probs.new_zeros(bs, 1, 0, dtype=torch.long)
+    for t in range(tl):
+        k = phi.shape[1]
+        child_phi = phi.unsqueeze(dim=-1) + log_probs[:, t].unsqueeze(dim=1)  # bs x k x nc
+        gumbel = -torch.log(-torch.log(torch.rand_like(child_phi).clamp(min=1e-20)))
+        child_g = child_phi + gumbel
+        # Condition the children's perturbed values on their maximum being equal to the parent's.
+        z = child_g.max(dim=-1, keepdim=True)[0]
+        v = g.unsqueeze(dim=-1) - child_g + _log1mexp(child_g - z)
+        child_g = g.unsqueeze(dim=-1) - v.clamp(min=0.0) - torch.log1p(torch.exp(-v.abs()))
+        # Keep the top ones.
+        num_kept = min(num_samples, k * nc)
+        g, idx = child_g.view(bs, -1).topk(num_kept, dim=-1)
+        phi = child_phi.view(bs, -1).gather(1, idx)
+        parent = idx // nc
+        char = idx % nc
+        seqs = seqs.gather(1, parent.unsqueeze(dim=-1).expand(-1, -1, t))
+        seqs = torch.cat([seqs, char.unsqueeze(dim=-1)], dim=-1)
+    return seqs.transpose(1, 2)  # bs x tl x ns
+
+
+def _sample(probs, log_probs, num_samples, sampling):
+    """Return samples of size bs x tl x ns."""
+    bs, tl, nc = probs.shape
+    if sampling == 'multinomial':
+        samples = torch.multinomial(probs.reshape(bs * tl, nc), num_samples, replacement=True)
+        samples = samples.view(bs, tl, num_samples)
+    elif sampling == 'stratified':
+        # NOTE Latin hypercube sampling: for every position, each of the ``num_samples`` strata of [0, 1) is used
+        # exactly once, and strata are randomly permuted among the samples.
+        strata = torch.rand(bs, tl, num_samples, device=probs.device).argsort(dim=-1).float()
+        u = (strata + torch.rand_like(strata)) / num_samples
+        cdf = probs.cumsum(dim=-1).contiguous()
+        samples = torch.searchsorted(cdf, u.contiguous()).clamp(max=nc - 1)
+    elif sampling == 'gumbel':
+        samples = _sample_without_replacement(log_probs, num_samples)
+    else:
+        raise ValueError(f'Sampling method {sampling} not supported.')
+    return samples
+
+
+def _get_num_samples(probs, log_probs, lengths, num_samples, entropy_per_sample):
+    '''
+    Decide how many samples each lost word needs based on the total entropy of its decoder distributions. Only the
+    first ``lengths`` (bs) steps of every word count, since the steps after EOW never change its samples.
+    '''
+    bs, tl, _ = probs.shape
+    mask = torch.arange(tl, device=probs.device).view(1, -1) < lengths.view(-1, 1)  # bs x tl
+    entropy = (-(probs * log_probs).sum(dim=-1) * mask.float()).sum(dim=-1)  # bs
+    return (entropy / entropy_per_sample).ceil().clamp(1, num_samples).long()
+
+
+def _get_samples(known_charset, log_probs, wordlist, valid_log_probs, num_samples, alpha, sampling='multinomial',
+                 adaptive=False, entropy_per_sample=1.0):
+    '''
+    Return tokens (bs x ns), their log probs (bs x ns), and which samples are active (bs x ns, or None if all are).
+    '''
     log_probs = log_probs.transpose(0, 2).transpose(1, 2)  # size: bs x tl x C
     log_probs = torch.log_softmax(log_probs * alpha, dim=-1)
     probs = log_probs.exp()
     bs, tl, nc = probs.shape
+    active = None
     # get samples
     if num_samples > 0:
-        samples = torch.multinomial(probs.reshape(bs * tl, nc), num_samples, replacement=True)
-        samples = samples.view(bs, tl, num_samples)
+        samples = _sample(probs, log_probs, num_samples, sampling)
+        num_samples = samples.shape[-1]  # NOTE Sampling without replacement might return fewer samples.
         # get tokens
         tokens = known_charset.get_tokens(samples.transpose(1, 2))  # size: bs x num_samples
         # get probs
@@ -26,52 +97,139 @@ def compute_expected_edits(known_charset, log_probs, wordlist, valid_log_probs,
         mask = get_tensor(torch.arange(tl)).float().view(
             1, -1, 1).expand(bs, tl, num_samples) < lengths.unsqueeze(dim=1)
         sample_log_probs = (mask.float() * sample_log_probs).sum(dim=1)  # bs x num_samples
+        if adaptive:
+            # NOTE The longest sample (including its EOW) of every word covers all the steps that matter.
+            word_num_samples = _get_num_samples(probs, log_probs, lengths.max(dim=-1)[0], num_samples,
+                                                entropy_per_sample)
+            active = torch.arange(num_samples, device=probs.device).view(1, -1) < word_num_samples.view(-1, 1)
+            active = active.cpu().numpy()
     else:  # This means we are taking the argmax according to token-level probs, not character-level probs.
         # Take argmax
-        _, idx = valid_log_probs.max(dim=-1)
+        _, idx = valid_log_probs.max_over_cols()
         tokens = wordlist[idx.cpu().numpy()].reshape(bs, 1)
-        num_samples = 1
-        sample_log_probs = get_tensor(np.ones([bs, 1]))
+        sample_log_probs = get_tensor(np.ones([bs, 1]), dtype='f')
+    return tokens, sample_log_probs, active
+
+
+def _compute_expected_edit_chunk(dists, duplicates, word_log_probs, sample_log_probs):
+    """``dists`` and ``duplicates`` are bs x c_s x (1 + ns), ``word_log_probs`` is bs x c_s."""
+    bs, num_samples = sample_log_probs.shape
+    # NOTE Scores might be in bfloat16. The softmax below is computed in fp32.
+    word_log_probs = word_log_probs.float()
+    dists = get_tensor(dists, 'f')
+    duplicates = get_tensor(duplicates, 'f')
+    edit_chunk = dists * duplicates
+    # compute expected edits
+    ex_sample_log_probs = sample_log_probs.view(
+        bs, 1, num_samples).expand(-1, word_log_probs.shape[-1], -1)
+    all_sample_log_probs = torch.cat([word_log_probs.unsqueeze(dim=-1), ex_sample_log_probs], dim=-1)
+    # make it less sharp
+    all_sample_log_probs = all_sample_log_probs + (1.0 - duplicates) * (-999.)
+    logits = all_sample_log_probs  # * alpha
+    sm_log_probs = torch.log_softmax(logits, dim=-1)  # NOTE sm stands for softmax
+    sm_probs = sm_log_probs.exp()
+    return (edit_chunk * sm_probs).sum(dim=-1)
+
+
+def compute_expected_edits(known_charset, log_probs, wordlist, valid_log_probs, num_samples=10, alpha=1e1, edit=False,
+                           chunk_size=1000, sampling='multinomial', adaptive=False, entropy_per_sample=1.0):
+    '''
+    ``sampling`` can be "multinomial" (i.i.d. samples), "stratified" (Latin hypercube samples) or "gumbel" (sampling
+    without replacement over whole strings). If ``adaptive`` is True, lost words only use one sample per
+    ``entropy_per_sample`` nats of decoder entropy, and distances are not computed for the unused samples.
+    '''
+    logging.debug('Computing expected edits')
+    with phase('sampling'):
+        tokens, sample_log_probs, active = _get_samples(known_charset, log_probs, wordlist, valid_log_probs,
+                                                        num_samples, alpha, sampling=sampling, adaptive=adaptive,
+                                                        entropy_per_sample=entropy_per_sample)
     # use chunks to get all edits
-    chunk_size = 1000
     num_chunks = len(wordlist) // chunk_size + (len(wordlist) % chunk_size > 0)
     expected_edits = list()
-    for i in range(num_chunks):
+    for i, (start, end, valid_log_prob_chunk) in enumerate(valid_log_probs.iter_chunks(chunk_size)):
         logging.debug('Computing chunk %d/%d' % (i + 1, num_chunks))
-        start = i * chunk_size
-        end = min(start + chunk_size, len(wordlist))
-
-        valid_log_prob_chunk = valid_log_probs[:, start: end]
         if edit:
             # get dists
-            dists = compute_dists(tokens, wordlist[start: end])  # bs x c_s x (1 + ns)
-            dists = get_tensor(dists, 'f')
+            with phase('distances'):
+                add_count('pairs', tokens.size * (end - start))
+                dists = compute_dists(tokens, wordlist[start: end], active=active)  # bs x c_s x (1 + ns)
             # remove accidental hits
-            duplicates = compute_duplicates(tokens, wordlist[start: end])  # bs x c_s x (1 + ns)
-            duplicates = get_tensor(duplicates, 'f')
-            edit_chunk = dists * duplicates
-            # compute expected edits
-            ex_sample_log_probs = sample_log_probs.view(
-                bs, 1, num_samples).expand(-1, valid_log_prob_chunk.shape[-1], -1)
-            all_sample_log_probs = torch.cat([valid_log_prob_chunk.unsqueeze(dim=-1), ex_sample_log_probs], dim=-1)
-            # make it less sharp
-            all_sample_log_probs = all_sample_log_probs + (1.0 - duplicates) * (-999.)
-            logits = all_sample_log_probs  # * alpha
-            sm_log_probs = torch.log_softmax(logits, dim=-1)  # NOTE sm stands for softmax
-            sm_probs = sm_log_probs.exp()
-            expected_edits.append((edit_chunk * sm_probs).sum(dim=-1))
+            with phase('dedup'):
+                duplicates = compute_duplicates(tokens, wordlist[start: end], active=active)  # bs x c_s x (1 + ns)
+            expected_edits.append(_compute_expected_edit_chunk(
+                dists, duplicates, valid_log_prob_chunk.tensor, sample_log_probs))
             # expected_edits.append(dists[..., 1:].sum(dim=-1))
         else:
-            expected_edits.append(-valid_log_prob_chunk.tensor)
+            expected_edits.append(-valid_log_prob_chunk.tensor.float())
     return torch.cat(expected_edits, dim=1)
 
 
-def compute_dists(sample_forms, wordlist):
+def select_candidates(valid_log_probs, num_candidates, forced=None, extra=None):
+    '''
+    Return the ids of the ``num_candidates`` best known words for every lost word according to ``valid_log_probs``,
+    followed by ``extra`` candidates (bs x L) if provided, e.g., from a lexical index.
+    ``forced`` has one known id per lost word (-1 for none). If the forced id is not among the candidates, it replaces
+    the last candidate.
+    Negative ids in ``extra`` are padding, and are replaced by the first valid candidate of the same row. Rows without
+    any valid candidate keep them.
+    '''
+    all_candidates = list()
+    if num_candidates > 0:
+        _, candidates = valid_log_probs.topk_over_cols(num_candidates)  # bs x K
+        all_candidates.append(candidates)
+    if extra is not None:
+        all_candidates.append(get_tensor(extra, dtype='l'))
+    candidates = torch.cat(all_candidates, dim=-1)
+    if forced is not None:
+        forced = get_tensor(forced, dtype='l')
+        present = (candidates == forced.unsqueeze(dim=-1)).any(dim=-1)
+        replace = (forced >= 0) & ~present
+        candidates[replace, -1] = forced[replace]
+    padding = candidates < 0
+    if padding.any():
+        # NOTE Duplicate arcs are removed by `min_cost_flow_sparse`, so the filled entries add no arcs.
+        first = (~padding).long().argmax(dim=-1, keepdim=True)  # bs x 1
+        candidates = torch.where(padding, candidates.gather(1, first).expand_as(candidates), candidates)
+    return candidates
+
+
+def compute_candidate_expected_edits(known_charset, log_probs, wordlist, valid_log_probs, candidates, num_samples=10,
+                                     alpha=1e1, edit=False, sampling='multinomial', adaptive=False,
+                                     entropy_per_sample=1.0):
+    '''
+    Same as ``compute_expected_edits``, but only for the known words in ``candidates`` (bs x K). Return a bs x K tensor.
+    '''
+    logging.debug('Computing expected edits for candidates')
+    # NOTE Padding (see `select_candidates`) has no arcs in the flow, so any word can stand in for it here.
+    candidates = candidates.clamp(min=0)
+    candidate_log_probs = valid_log_probs.gather_cols(candidates)  # bs x K
+    if not edit:
+        return -candidate_log_probs.float()
+    with phase('sampling'):
+        tokens, sample_log_probs, active = _get_samples(known_charset, log_probs, wordlist, valid_log_probs,
+                                                        num_samples, alpha, sampling=sampling, adaptive=adaptive,
+                                                        entropy_per_sample=entropy_per_sample)
+    candidate_forms = wordlist[candidates.cpu().numpy()]  # bs x K
+    with phase('distances'):
+        add_count('pairs', tokens.shape[1] * candidate_forms.size)
+        dists = compute_candidate_dists(tokens, candidate_forms, active=active)  # bs x K x (1 + ns)
+    with phase('dedup'):
+        duplicates = compute_candidate_duplicates(tokens, candidate_forms, active=active)  # bs x K x (1 + ns)
+    return _compute_expected_edit_chunk(dists, duplicates, candidate_log_probs, sample_log_probs)
+
+
+def compute_dists(sample_forms, wordlist, active=None):
     # global _DISTS_CACHE
     bs, ns = sample_forms.shape
     sample_forms = sample_forms.flatten()
     # dists = np.zeros([bs, len(wordlist), 1 + ns]) # NOTE always include the true tokens
-    edits = editdistance.eval_all(wordlist, sample_forms)  # len(wl) x (bs x ns)
+    if active is None:
+        edits = editdistance.eval_all(wordlist, sample_forms)  # len(wl) x (bs x ns)
+    else:
+        # NOTE Inactive samples are removed by `compute_duplicates` anyway, so skip them here.
+        active = active.flatten()
+        edits = np.zeros([len(wordlist), bs * ns], dtype='int64')
+        edits[:, active] = editdistance.eval_all(wordlist, sample_forms[active])
     edits = edits.reshape(len(wordlist), bs, ns)
     dists = np.transpose(edits, [1, 0, 2])
     dists = np.concatenate([np.zeros([bs, len(wordlist), 1], dtype='int64'), dists], axis=-1)
@@ -89,19 +247,20 @@ def compute_dists(sample_forms, wordlist):
     min_lengths = np.minimum(lengths.reshape(1, -1, 1), sample_lengths.reshape(bs, 1, ns))
     min_lengths = np.concatenate([np.repeat(lengths.reshape(1, -1), bs, axis=0).reshape(bs, -1, 1),
                                   min_lengths], axis=-1) + 1  # NOTE add one to avoid divide-by-zero error
-    dists = dists / min_lengths
+    # NOTE Keep float32 -- dividing by integers would give float64 arrays of this size.
+    dists = dists / min_lengths.astype('float32')
     # dists = dists ** 2
     return dists
 
 
-def compute_duplicates(sample_forms, wordlist):
+def compute_duplicates(sample_forms, wordlist, active=None):
     bs, ns = sample_forms.shape
-    dups = np.ones([bs, len(wordlist), 1 + ns])
+    dups = np.ones([bs, len(wordlist), 1 + ns], dtype='float32')
     for i, b_samples in enumerate(sample_forms):
         sampled = {}
         # remove duplicated within the samples
         for k, b_sample in enumerate(b_samples, 1):
-            if b_sample in sampled:
+            if b_sample in sampled or (active is not None and not active[i, k - 1]):
                 dups[i, :, k] = 0.0
                 continue
             sampled[b_sample] = k
@@ -111,3 +270,37 @@ def compute_duplicates(sample_forms, wordlist):
                 k = sampled[orig]
                 dups[i, j, k] = 0.0
     return dups
+
+
+def compute_candidate_dists(sample_forms, candidate_forms, active=None):
+    """Like ``compute_dists``, but every lost word has its own list of candidates."""
+    bs, ns = sample_forms.shape
+    num_candidates = candidate_forms.shape[1]
+    dists = np.zeros([bs, num_candidates, 1 + ns], dtype='float32')
+    for i in range(bs):
+        if active is None:
+            dists[i, :, 1:] = editdistance.eval_all(candidate_forms[i], sample_forms[i])  # K x ns
+        else:
+            dists[i, :, 1:][:, active[i]] = editdistance.eval_all(candidate_forms[i], sample_forms[i][active[i]])
+    lengths = np.vectorize(len)(candidate_forms)  # bs x K
+    sample_lengths = np.vectorize(len)(sample_forms)  # bs x ns
+    min_lengths = np.minimum(lengths.reshape(bs, -1, 1), sample_lengths.reshape(bs, 1, ns))
+    min_lengths = np.concatenate([lengths.reshape(bs, -1, 1), min_lengths], axis=-1) + 1
+    return dists / min_lengths.astype('float32')
+
+
+def compute_candidate_duplicates(sample_forms, candidate_forms, active=None):
+    """Like ``compute_duplicates``, but every lost word has its own list of candidates."""
+    bs, ns = sample_forms.shape
+    dups = np.ones([bs, candidate_forms.shape[1], 1 + ns], dtype='float32')
+    for i, b_samples in enumerate(sample_forms):
+        sampled = {}
+        for k, b_sample in enumerate(b_samples, 1):
+            if b_sample in sampled or (active is not None and not active[i, k - 1]):
+                dups[i, :, k] = 0.0
+                continue
+            sampled[b_sample] = k
+        for j, orig in enumerate(candidate_forms[i]):
+            if orig in sampled:
+                dups[i, j, sampled[orig]] = 0.0
+    return dups
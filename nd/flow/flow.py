@@ -1,72 +1,171 @@
 import logging
 
 import numpy as np
+import torch
 
 from arglib import has_properties
 from dev_misc import get_tensor, log_this
-from nd.dataset.vocab import get_forms, get_words, has_cognate, is_cognate
+from nd.dataset.vocab import are_cognates, get_axis, get_cognate_mask, get_fingerprint, get_forms
+from nd.magic_tensor.axis import as_axis
 from nd.magic_tensor.core import MagicTensor
+from nd.profile.core import phase
+
+# Residual entries below this fraction of the largest flow value are dropped after every update.
+PRUNE_RATIO = 1e-6
 
 
 @has_properties('lost_lang', 'known_lang', 'momentum', 'num_cognates')
 class Flow:
+    '''
+    The flow between all lost words and all known words. Warming up fills it with a constant, and every update blends
+    in an integral flow with few nonzero entries, so it is stored as a uniform base value plus a sparse residual indexed
+    by word ids. Only the subtensors requested by ``select`` are ever made dense.
+    '''
 
     def __init__(self, lost_lang, known_lang, momentum, num_cognates):
         super().__init__()
-        lost_words = get_words(lost_lang)
-        known_words = get_words(known_lang)
-        flow = get_tensor(np.zeros([len(lost_words), len(known_words)]))
-        self.flow = MagicTensor(flow, lost_words, known_words)
+        self._lost_words = get_axis(lost_lang)
+        self._known_words = get_axis(known_lang)
+        self._base = 0.0
+        self._set_residual(torch.zeros([2, 0], dtype=torch.long), torch.zeros([0]))
         self._warmed_up = False
+        self._last_preds = None
+
+    @property
+    def shape(self):
+        return torch.Size([len(self._lost_words), len(self._known_words)])
+
+    @property
+    def nnz(self):
+        return self._residual._nnz()
+
+    @property
+    def flow(self):
+        """The dense flow over the entire vocabs. Use ``select`` instead whenever possible."""
+        return self.select(self._lost_words, self._known_words)['flow']
+
+    def _set_residual(self, indices, values):
+        residual = torch.sparse_coo_tensor(indices, values.float(), self.shape)
+        self._residual = get_tensor(residual.coalesce())
 
     def state_dict(self):
-        """Use words as the indices."""
+        """Use word indices as the indices, with a fingerprint of both vocabs to check against when loading."""
 
-        return {'lost_forms': get_forms(self.lost_lang),
-                'known_forms': get_forms(self.known_lang),
-                'flow': self.flow}
+        return {'fingerprint': get_fingerprint(self.lost_lang, self.known_lang),
+                'base': self._base,
+                'indices': self._residual._indices().cpu(),
+                'values': self._residual._values().cpu()}
 
     def load_state_dict(self, state_dict):
-        lost_forms = get_forms(self.lost_lang)
-        known_forms = get_forms(self.known_lang)
-        saved_lost_forms = state_dict['lost_forms']
-        saved_known_forms = state_dict['known_forms']
-        assert (lost_forms == saved_lost_forms).all()
-        assert (known_forms == saved_known_forms).all()
-        self.flow.data.copy_(state_dict['flow'])
+        if 'fingerprint' in state_dict:
+            assert state_dict['fingerprint'] == get_fingerprint(self.lost_lang, self.known_lang)
+        else:
+            # NOTE Older versions saved all forms instead.
+            assert (get_forms(self.lost_lang) == state_dict['lost_forms']).all()
+            assert (get_forms(self.known_lang) == state_dict['known_forms']).all()
+        if 'flow' in state_dict:
+            self._load_dense(state_dict['flow'])
+        else:
+            self._base = state_dict['base']
+            self._set_residual(state_dict['indices'], state_dict['values'])
+
+    def _load_dense(self, flow):
+        """Load a dense flow saved by older versions, taking its minimum as the base."""
+        if isinstance(flow, MagicTensor):
+            rows = as_axis(flow.row_words).ids
+            cols = as_axis(flow.col_words).ids
+            flow = flow.tensor
+        else:
+            rows = np.arange(flow.shape[0])
+            cols = np.arange(flow.shape[1])
+        flow = flow.cpu()
+        self._base = flow.min().item()
+        nonzero = (flow - self._base).nonzero()
+        indices = torch.stack([torch.from_numpy(rows)[nonzero[:, 0]], torch.from_numpy(cols)[nonzero[:, 1]]], dim=0)
+        self._set_residual(indices, flow[nonzero[:, 0], nonzero[:, 1]] - self._base)
 
     @log_this('IMP')
     def warm_up(self):
-        value = self.num_cognates / self.flow.numel()
-        self.flow.tensor[:] = value
+        self._base = self.num_cognates / (len(self._lost_words) * len(self._known_words))
+        self._set_residual(torch.zeros([2, 0], dtype=torch.long), torch.zeros([0]))
 
     @log_this('IMP')
     def update(self, model, data_loader, num_cognates, edit, capacity):
         model.eval()
         entire_batch = data_loader.entire_batch
-        model_ret = model(entire_batch, mode='flow', capacity=capacity, num_cognates=num_cognates, edit=edit)
+        forced = self._get_forced(entire_batch)
+        model_ret = model(entire_batch, mode='flow', capacity=capacity, num_cognates=num_cognates, edit=edit,
+                          forced=forced)
         new_flow = model_ret.flow
-        self._check_acc(new_flow)
-        self.flow = self.momentum * self.flow + (1.0 - self.momentum) * new_flow
+        self._last_preds = new_flow.get_best_ids(nonzero=True)
+        self._check_acc(self._last_preds)
+        with phase('momentum update'):
+            # Only the nonzero entries of the new flow are kept, indexed by word ids.
+            nonzero = new_flow.tensor.nonzero()
+            rows = get_tensor(new_flow.row_words.ids)[nonzero[:, 0]]
+            cols = get_tensor(new_flow.col_words.ids)[nonzero[:, 1]]
+            new_residual = torch.sparse_coo_tensor(torch.stack([rows, cols], dim=0),
+                                                   new_flow.tensor[nonzero[:, 0], nonzero[:, 1]].float(), self.shape)
+            self._base = self.momentum * self._base
+            residual = (self.momentum * self._residual + (1.0 - self.momentum) * new_residual).coalesce()
+            self._residual = self._prune(residual)
+        logging.info(f'Flow residual has {self.nnz} nonzero entries.')
+
+    def _prune(self, residual):
+        """Drop the entries that have decayed to (almost) nothing, so that the residual does not grow every update."""
+        values = residual._values()
+        if len(values) == 0:
+            return residual
+        # NOTE The base and old entries decay at the same rate, so the threshold is relative to the largest value.
+        threshold = PRUNE_RATIO * (self._base + values.abs().max().item())
+        keep = values.abs() >= threshold
+        if keep.all():
+            return residual
+        # NOTE Still coalesced since only entries are dropped.
+        return torch.sparse_coo_tensor(residual._indices()[:, keep], values[keep], self.shape).coalesce()
+
+    def _get_forced(self, batch):
+        """Known ids (in batch order) matched to each lost word by the previous flow, so that they stay candidates."""
+        if self._last_preds is None:
+            return None
+        _, _, lost_ids, known_ids = self._last_preds
+        forced = np.full([len(batch.lost.words)], -1, dtype='int64')
+        forced[batch.lost.words.positions(lost_ids)] = batch.known.words.positions(known_ids)
+        return forced
 
-    def _check_acc(self, flow):
-        preds = flow.get_best(nonzero=True)
+    def _check_acc(self, preds):
+        _, _, lost_ids, known_ids = preds
+        total = len(lost_ids)
         # Checking lost.
-        acc = sum([has_cognate(w, self.known_lang) for w in preds.keys()])
-        rate = acc / len(preds)
-        logging.imp(f'Accuracy on the lost side {acc} / {len(preds)} = {rate:.3f} ')
+        acc = get_cognate_mask(self.lost_lang, self.known_lang)[lost_ids].sum()
+        rate = acc / total
+        logging.imp(f'Accuracy on the lost side {acc} / {total} = {rate:.3f} ')
         # Checking known.
-        acc = sum([has_cognate(w, self.lost_lang) for w in preds.values()])
-        rate = acc / len(preds)
-        logging.imp(f'Accuracy on the known side {acc} / {len(preds)} = {rate:.3f} ')
+        acc = get_cognate_mask(self.known_lang, self.lost_lang)[known_ids].sum()
+        rate = acc / total
+        logging.imp(f'Accuracy on the known side {acc} / {total} = {rate:.3f} ')
         # Checking lost and known.
-        acc = sum([is_cognate(w1, w2) for w1, w2 in preds.items()])
-        rate = acc / len(preds)
-        logging.imp(f'Accuracy for lost-known {acc} / {len(preds)} = {rate:.3f} ')
+        acc = are_cognates(lost_ids, known_ids).sum()
+        rate = acc / total
+        logging.imp(f'Accuracy for lost-known {acc} / {total} = {rate:.3f} ')
 
     def select(self, lost_words, known_words):
         """Take the subtensor, specified by the words."""
-        flow = self.flow.select_rows(lost_words).select_cols(known_words)
+        lost_words = as_axis(lost_words)
+        known_words = as_axis(known_words)
+        indices = self._residual._indices()
+        values = self._residual._values()
+        # Map word ids to positions in the subtensor (-1 for words not selected).
+        lost_pos = np.full([len(self._lost_words)], -1, dtype='int64')
+        lost_pos[lost_words.ids] = np.arange(len(lost_words))
+        known_pos = np.full([len(self._known_words)], -1, dtype='int64')
+        known_pos[known_words.ids] = np.arange(len(known_words))
+        rows = get_tensor(lost_pos)[indices[0]]
+        cols = get_tensor(known_pos)[indices[1]]
+        keep = (rows >= 0) & (cols >= 0)
+        tensor = get_tensor(torch.full([len(lost_words), len(known_words)], self._base))
+        tensor.index_put_((rows[keep], cols[keep]), values[keep], accumulate=True)
+        flow = MagicTensor(tensor, lost_words, known_words)
         flow_k = flow.tensor.sum(dim=0)
         flow_l = flow.tensor.sum(dim=1)
         return {'flow': flow,
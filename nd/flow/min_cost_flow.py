@@ -4,12 +4,16 @@ import random
 
 import numpy as np
 import torch
-from cvxopt import matrix, solvers, spmatrix
-from ortools.graph.python.min_cost_flow import SimpleMinCostFlow    #hs 20240105
 
 from dev_misc import Map
 
 
+def _get_solver():
+    # NOTE OR-tools is slow to import, so only import it when a flow is actually solved.
+    from ortools.graph.python.min_cost_flow import SimpleMinCostFlow    #hs 20240105
+    return SimpleMinCostFlow()
+
+
 def min_cost_flow(dists, demand, n_similar=None, capacity=1):
     '''
     Modified from https://developers.google.com/optimization/flow/mincostflow.
@@ -82,7 +86,7 @@ def min_cost_flow(dists, demand, n_similar=None, capacity=1):
     supplies = [demand, -demand]  # + [0] * (nt + ns)
 
     # Instantiate a SimpleMinCostFlow solver.
-    min_cost_flow = SimpleMinCostFlow()                         #hs20240105
+    min_cost_flow = _get_solver()                               #hs20240105
 
     # Add each arc.
     for i in range(0, len(start_nodes)):
@@ -99,7 +103,7 @@ def min_cost_flow(dists, demand, n_similar=None, capacity=1):
     # Find the minimum cost flow between node 0 and node 4.
     if min_cost_flow.solve() == min_cost_flow.OPTIMAL:          #hs20240105
         cost = min_cost_flow.optimal_cost()                     #hs20240105
-        flow = np.zeros([nt, ns])
+        flow = np.zeros([nt, ns], dtype='float32')
         for i in range(min_cost_flow.num_arcs()):               #hs20240105
             t = min_cost_flow.tail(i)                           #hs20240105
             s = min_cost_flow.head(i)                           #hs20240105
@@ -109,3 +113,51 @@ def min_cost_flow(dists, demand, n_similar=None, capacity=1):
     else:
         logging.error('There was an issue with the min cost flow input.')
         raise RuntimeError('Min cost flow solver error')
+
+
+def min_cost_flow_sparse(candidates, dists, num_known, demand, capacity=1):
+    '''
+    Same as ``min_cost_flow``, but only the arcs between every lost word and its candidates (``candidates[t]``) are
+    added. ``dists`` has the same shape as ``candidates``. Negative candidates are padding, and have no arcs.
+
+    If pruning makes ``demand`` infeasible, the maximum flow with the minimum cost is returned instead.
+    '''
+    logging.debug('Solving sparse flow')
+    dists = (dists * 100.0).astype('int64')
+    nt, ns = len(candidates), num_known
+    rows, cols = np.nonzero(candidates >= 0)
+    # Remove duplicate arcs since they would increase the capacity between two words.
+    keys, first = np.unique(rows * ns + candidates[rows, cols], return_index=True)
+    pair_t = keys // ns
+    pair_s = keys % ns
+    pair_costs = dists[rows, cols][first]
+    known_ids = np.unique(pair_s)
+    max_demand = min(nt, len(known_ids) if capacity == -1 else len(known_ids) * capacity)
+    if demand > max_demand:
+        logging.warning('demand too big, set to %d instead' % (max_demand))
+        demand = max_demand
+
+    # NOTE 0 is reserved for source, and 1 for sink. Lost word t is node t + 2, and known word s is node s + 2 + nt.
+    known_capacity = nt + ns if capacity == -1 else capacity  # NOTE -1 means ignoring capacity constraint.
+    start_nodes = np.concatenate([np.zeros(nt), known_ids + 2 + nt, pair_t + 2]).astype('int64')
+    end_nodes = np.concatenate([np.arange(nt) + 2, np.ones(len(known_ids)), pair_s + 2 + nt]).astype('int64')
+    capacities = np.concatenate([np.ones(nt), np.full(len(known_ids), known_capacity), np.ones(len(keys))]).astype('int64')
+    unit_costs = np.concatenate([np.zeros(nt + len(known_ids)), pair_costs]).astype('int64')
+
+    min_cost_flow = _get_solver()
+    arcs = min_cost_flow.add_arcs_with_capacity_and_unit_cost(start_nodes, end_nodes, capacities, unit_costs)
+    min_cost_flow.set_nodes_supplies(np.asarray([0, 1]), np.asarray([demand, -demand]))
+
+    status = min_cost_flow.solve()
+    if status == min_cost_flow.INFEASIBLE:
+        logging.warning('Pruned flow is infeasible, solving for the maximum flow with the minimum cost instead.')
+        status = min_cost_flow.solve_max_flow_with_min_cost()
+    if status == min_cost_flow.OPTIMAL:
+        cost = min_cost_flow.optimal_cost()
+        pair_arcs = arcs[nt + len(known_ids):]
+        flow = np.zeros([nt, ns], dtype='float32')
+        flow[pair_t, pair_s] = min_cost_flow.flows(pair_arcs)
+        return flow, cost
+    else:
+        logging.error('There was an issue with the min cost flow input.')
+        raise RuntimeError('Min cost flow solver error')
@@ -0,0 +1,76 @@
+import numpy as np
+import torch
+
+
+class WordAxis:
+    '''
+    An immutable sequence of words that indexes one dimension of a MagicTensor. The word ids (``Word.idx``) are cached
+    as an index array, and the inverse mapping from ids to positions is built lazily, so that selecting and permuting
+    can be done by index arrays instead of dictionaries of words.
+
+    Axes are meant to be shared: create one per batch (or vocab) and pass it around instead of the raw words.
+    '''
+
+    __slots__ = ('_words', '_ids', '_inverse')
+
+    def __init__(self, words, ids=None):
+        if not isinstance(words, np.ndarray):
+            arr = np.empty([len(words)], dtype=object)
+            arr[:] = list(words)
+            words = arr
+        self._words = words
+        if ids is None:
+            ids = np.fromiter((w.idx for w in words), dtype='int64', count=len(words))
+        self._ids = np.asarray(ids, dtype='int64')
+        self._inverse = None
+
+    @property
+    def words(self):
+        return self._words
+
+    @property
+    def ids(self):
+        return self._ids
+
+    def __len__(self):
+        return len(self._words)
+
+    def __iter__(self):
+        return iter(self._words)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            return self._words[key]
+        return WordAxis(self._words[key], ids=self._ids[key])
+
+    def __repr__(self):
+        return f'WordAxis(size={len(self)})'
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if not isinstance(other, WordAxis):
+            return NotImplemented
+        return np.array_equal(self._ids, other._ids)
+
+    __hash__ = None
+
+    def positions(self, ids):
+        """Return the positions of words with ``ids`` on this axis. Raise KeyError if any of them is missing."""
+        if self._inverse is None:
+            size = self._ids.max() + 1 if len(self._ids) else 0
+            self._inverse = np.full([size], -1, dtype='int64')
+            self._inverse[self._ids] = np.arange(len(self._ids))
+        ids = np.asarray(ids)
+        if len(ids) and (ids.max() >= len(self._inverse) or (self._inverse[ids] < 0).any()):
+            raise KeyError('Some words are not on this axis.')
+        return self._inverse[ids]
+
+    def index_tensor(self, ids, device=None):
+        return torch.as_tensor(self.positions(ids), device=device)
+
+
+def as_axis(words):
+    if isinstance(words, WordAxis):
+        return words
+    return WordAxis(words)
@@ -1,12 +1,15 @@
 import types
 from functools import wraps
 
+import numpy as np
 import torch
 
 from arglib import has_properties
 from dev_misc import log_this
 from nd.dataset.vocab import Word
 
+from .axis import as_axis
+
 _SAFE_METHODS = {'numel', '__str__', 'data', 'shape', 'unsqueeze'}
 _SAFE_METHODS_WITH_WRAPPER = {'log'}
 
@@ -21,28 +24,15 @@ class MagicTensor:
         assert len(row_words) == tensor.shape[0]
         assert len(col_words) == tensor.shape[1]
 
-        def freeze(words):
-            if isinstance(words, tuple):
-                return words
-            else:
-                return tuple(words)
-
-        # NOTE Freeze these to speed up checking procedure.
-        self._row_words = freeze(row_words)
-        self._col_words = freeze(col_words)
-        # Fast indexing.
-        self._word2row = {w: i for i, w in enumerate(self._row_words)}
-        self._word2col = {w: i for i, w in enumerate(self._col_words)}
+        # NOTE Use (shared) axis objects to speed up checking and indexing.
+        self._row_words = as_axis(row_words)
+        self._col_words = as_axis(col_words)
 
     def _check_value(self, other):
         if isinstance(other, MagicTensor):
-            try:
-                assert self.row_words == other.row_words
-                assert self.col_words == other.col_words
-                return other.tensor
-            except AssertionError:
+            if self.row_words != other.row_words or self.col_words != other.col_words:
                 self._permute(other)
-                return other.tensor
+            return other.tensor
         elif isinstance(other, (float, int)):
             return other
         else:
@@ -51,15 +41,15 @@ class MagicTensor:
     @log_this()
     def _permute(self, other):
         # Have to re-index the my own tensor. But make sure that the set of words are identical first.
-        assert set(self.row_words) == set(other.row_words)
-        assert set(self.col_words) == set(other.col_words)
-        my_rows = [self._word2row[w] for w in other.row_words]
-        my_cols = [self._word2col[w] for w in other.col_words]
+        # NOTE Words are unique, so `positions` (which fails on missing words) and the same size imply the same set.
+        assert len(self.row_words) == len(other.row_words)
+        assert len(self.col_words) == len(other.col_words)
+        device = self._tensor.device
+        my_rows = self.row_words.index_tensor(other.row_words.ids, device=device)
+        my_cols = self.col_words.index_tensor(other.col_words.ids, device=device)
         self._row_words = other.row_words
         self._col_words = other.col_words
-        self._word2row = other._word2row
-        self._word2col = other._word2col
-        self._tensor = self._tensor[my_rows][:, my_cols]
+        self._tensor = self._tensor.index_select(0, my_rows).index_select(1, my_cols)
 
     def __repr__(self):
         return f'MagicTensor({self.tensor!r})'
@@ -112,20 +102,162 @@ class MagicTensor:
             return MagicTensor(new_tensor, self.row_words[key], self.col_words)
 
     def select_rows(self, words):
-        ids = [self._word2row[w] for w in words]
-        return MagicTensor(self.tensor[ids], words, self.col_words)
+        words = as_axis(words)
+        ids = self.row_words.index_tensor(words.ids, device=self.tensor.device)
+        return MagicTensor(self.tensor.index_select(0, ids), words, self.col_words)
 
     def select_cols(self, words):
-        ids = [self._word2col[w] for w in words]
-        return MagicTensor(self.tensor[:, ids], self.row_words, words)
+        words = as_axis(words)
+        ids = self.col_words.index_tensor(words.ids, device=self.tensor.device)
+        return MagicTensor(self.tensor.index_select(1, ids), self.row_words, words)
+
+    def iter_chunks(self, chunk_size):
+        """Iterate over chunks of columns. Each chunk is a MagicTensor of size num_rows x chunk_size."""
+        num_cols = self.tensor.shape[1]
+        for start in range(0, num_cols, chunk_size):
+            end = min(start + chunk_size, num_cols)
+            yield start, end, self[:, start: end]
+
+    def max_over_cols(self):
+        return self.tensor.max(dim=-1)
+
+    def topk_over_cols(self, k):
+        return self.tensor.topk(min(k, self.tensor.shape[1]), dim=-1)
+
+    def logsumexp_over_cols(self):
+        # NOTE Accumulate in fp32 even if the scores are in a lower precision.
+        return torch.logsumexp(self.tensor.float(), dim=-1)
+
+    def gather_cols(self, idx):
+        """``idx`` is num_rows x k, containing column indices for every row."""
+        return self.tensor.gather(1, idx)
+
+    def logsumexp_over_rows(self, offset=None):
+        if offset is None:
+            tensor = self.tensor
+        else:
+            # NOTE `_check_value` might permute this tensor, so get the value first.
+            value = self._check_value(offset)
+            tensor = self.tensor + value
+        return torch.logsumexp(tensor.float(), dim=0)
+
+    def get_best_ids(self, nonzero=False):
+        best_value, best_idx = self.max_over_cols()
+        return _get_best_ids(self.row_words, self.col_words, best_value, best_idx, nonzero)
 
     def get_best(self, nonzero=False):
-        ret = dict()
-        best_idx = self.tensor.max(dim=-1)[1].cpu().numpy()
-        for lost_idx, known_idx in enumerate(best_idx):
-            if not nonzero or self.tensor[lost_idx, known_idx].item() > 0:
-                lost = self.row_words[lost_idx]
-                known = self.col_words[known_idx]
-                assert lost not in ret
-                ret[lost] = known
+        return _get_best_dict(*self.get_best_ids(nonzero=nonzero))
+
+
+def _get_best_ids(row_words, col_words, best_value, best_idx, nonzero):
+    """Return the row axis, the column axis, and word ids (``Word.idx``) for the best (nonzero) entries of every row."""
+    best_idx = best_idx.cpu().numpy()
+    row_pos = np.arange(len(best_idx))
+    if nonzero:
+        keep = (best_value > 0).cpu().numpy()
+        row_pos = row_pos[keep]
+        best_idx = best_idx[keep]
+    return row_words, col_words, row_words.ids[row_pos], col_words.ids[best_idx]
+
+
+def _get_best_dict(row_words, col_words, row_ids, col_ids):
+    rows = row_words.words[row_words.positions(row_ids)]
+    cols = col_words.words[col_words.positions(col_ids)]
+    return dict(zip(rows, cols))
+
+
+@has_properties('score_fn', 'row_words', 'col_words', 'chunk_size')
+class ChunkedMagicTensor:
+    '''
+    A lazy version of MagicTensor. Columns are computed chunk by chunk by calling ``score_fn(start, end)``, so the entire
+    matrix never exists at once. Only reductions that can be done in a streaming fashion are supported.
+    '''
+
+    def __init__(self, score_fn, row_words, col_words, chunk_size):
+        assert chunk_size > 0
+        self._row_words = as_axis(row_words)
+        self._col_words = as_axis(col_words)
+
+    def __repr__(self):
+        return f'ChunkedMagicTensor(shape={tuple(self.shape)}, chunk_size={self.chunk_size})'
+
+    @property
+    def shape(self):
+        return torch.Size([len(self.row_words), len(self.col_words)])
+
+    def iter_chunks(self, chunk_size=None):
+        chunk_size = chunk_size or self.chunk_size
+        num_cols = len(self.col_words)
+        for start in range(0, num_cols, chunk_size):
+            end = min(start + chunk_size, num_cols)
+            chunk = self.score_fn(start, end)
+            yield start, end, MagicTensor(chunk, self.row_words, self.col_words[start: end])
+
+    def max_over_cols(self):
+        """Running max."""
+        best_value = best_idx = None
+        for start, _, chunk in self.iter_chunks():
+            value, idx = chunk.max_over_cols()
+            idx = idx + start
+            if best_value is None:
+                best_value, best_idx = value, idx
+            else:
+                # NOTE Use strict inequality so that ties are resolved in favor of earlier columns, like `max`.
+                better = value > best_value
+                best_value = torch.where(better, value, best_value)
+                best_idx = torch.where(better, idx, best_idx)
+        return best_value, best_idx
+
+    def topk_over_cols(self, k):
+        """Running top-k: merge the top-k of each chunk with the top-k found so far."""
+        best_value = best_idx = None
+        for start, _, chunk in self.iter_chunks():
+            value, idx = chunk.topk_over_cols(k)
+            idx = idx + start
+            if best_value is not None:
+                value = torch.cat([best_value, value], dim=-1)
+                idx = torch.cat([best_idx, idx], dim=-1)
+                value, pos = value.topk(min(k, value.shape[-1]), dim=-1)
+                idx = idx.gather(-1, pos)
+            best_value, best_idx = value, idx
+        return best_value, best_idx
+
+    def logsumexp_over_cols(self):
+        """Online logsumexp: keep a running max and a running sum of exponentials relative to that max."""
+        running_max = running_sum = None
+        for _, _, chunk in self.iter_chunks():
+            tensor = chunk.tensor.float()
+            chunk_max = tensor.max(dim=-1)[0]
+            if running_max is None:
+                new_max = chunk_max
+                running_sum = torch.zeros_like(chunk_max)
+            else:
+                new_max = torch.max(running_max, chunk_max)
+                running_sum = running_sum * (running_max - new_max).exp()
+            running_sum = running_sum + (tensor - new_max.unsqueeze(dim=-1)).exp().sum(dim=-1)
+            running_max = new_max
+        return running_max + running_sum.log()
+
+    def gather_cols(self, idx):
+        ret = None
+        for start, end, chunk in self.iter_chunks():
+            in_chunk = (idx >= start) & (idx < end)
+            if in_chunk.any():
+                value = chunk.gather_cols((idx - start).clamp(0, end - start - 1))
+                ret = value if ret is None else torch.where(in_chunk, value, ret)
         return ret
+
+    def logsumexp_over_rows(self, offset=None):
+        """Every column is reduced independently, so just concatenate the results from all chunks."""
+        ret = list()
+        for start, end, chunk in self.iter_chunks():
+            chunk_offset = None if offset is None else offset[:, start: end]
+            ret.append(chunk.logsumexp_over_rows(offset=chunk_offset))
+        return torch.cat(ret, dim=0)
+
+    def get_best_ids(self, nonzero=False):
+        best_value, best_idx = self.max_over_cols()
+        return _get_best_ids(self.row_words, self.col_words, best_value, best_idx, nonzero)
+
+    def get_best(self, nonzero=False):
+        return _get_best_dict(*self.get_best_ids(nonzero=nonzero))
@@ -0,0 +1,46 @@
+import torch
+
+from dev_misc import TestCase
+from nd.dataset.vocab import Word
+
+from .axis import WordAxis
+from .core import MagicTensor
+
+
+class TestMagicTensor(TestCase):
+
+    def setUp(self):
+        self.rows = [Word('lost', f'l{i}', i) for i in range(4)]
+        self.cols = [Word('known', f'k{i}', i) for i in range(5)]
+        self.tensor = torch.randn(4, 5)
+
+    def test_permute(self):
+        mt1 = MagicTensor(self.tensor.clone(), self.rows, self.cols)
+        row_perm = [2, 0, 3, 1]
+        col_perm = [4, 3, 2, 1, 0]
+        mt2 = MagicTensor(self.tensor[row_perm][:, col_perm],
+                          [self.rows[i] for i in row_perm],
+                          [self.cols[i] for i in col_perm])
+        ret = mt1 + mt2
+        self.assertIs(ret.row_words, mt2.row_words)
+        self.assertTrue(torch.allclose(ret.tensor, 2 * mt2.tensor))
+
+    def test_select(self):
+        mt = MagicTensor(self.tensor, WordAxis(self.rows), WordAxis(self.cols))
+        ret = mt.select_rows([self.rows[3], self.rows[1]]).select_cols([self.cols[0]])
+        self.assertTrue(torch.allclose(ret.tensor, self.tensor[[3, 1]][:, [0]]))
+
+    def test_get_best(self):
+        mt = MagicTensor(self.tensor, self.rows, self.cols)
+        best = mt.get_best()
+        best_idx = self.tensor.max(dim=1)[1]
+        for i, w in enumerate(self.rows):
+            self.assertIs(best[w], self.cols[best_idx[i]])
+
+    def test_bfloat16(self):
+        mt = MagicTensor(self.tensor.bfloat16(), self.rows, self.cols)
+        lse = mt.logsumexp_over_cols()
+        self.assertEqual(lse.dtype, torch.float32)
+        self.assertTrue(torch.allclose(lse, torch.logsumexp(self.tensor, dim=-1), atol=0.05))
+        _, _, lost_ids, _ = mt.get_best_ids(nonzero=True)
+        self.assertEqual(len(lost_ids), (self.tensor.max(dim=1)[0] > 0).sum().item())
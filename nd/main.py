@@ -1,14 +1,13 @@
+import logging
 import os
 import random
 from pprint import pformat
 
 import numpy as np
-import torch
 
 from arglib import parser
 from dev_misc import Map, create_logger, log_pp
 from nd.config import registry
-from nd.train.manager import Manager
 
 
 def parse_args():
@@ -43,15 +42,65 @@ def parse_args():
     parser.add_argument('--residual', dtype=bool, default=True, help='flag to use residual connection')
     parser.add_argument('--reg_hyper', default=1.0, dtype=float, help='hyperparameter for regularization')
     parser.add_argument('--batch_size', '-bs', dtype=int, help='batch size')
+    parser.add_argument('--bucket_by_length', dtype=bool, help='flag to batch known words of similar lengths together')
+    parser.add_argument('--ckpt_format', default='torch', dtype=str,
+                        help='checkpoint format: torch (one file) or mmap (a directory of memory-mappable tensor files)')
+    parser.add_argument('--ckpt_fp16_flow', dtype=bool, help='flag to store the flow in fp16 in mmap checkpoints')
+    parser.add_argument('--async_save', dtype=bool, help='flag to write checkpoints in a background thread')
+    parser.add_argument('--tensorboard', dtype=bool, default=True, help='flag to log metrics to tensorboard')
+    parser.add_argument('--eval_topk', default=0, dtype=int,
+                        help='also evaluate top-k accuracy of the scores if positive')
+    parser.add_argument('--cache_dir', dtype=str, help='directory to cache parsed cognate files')
+    parser.add_argument('--num_workers', default=0, dtype=int,
+                        help='number of worker processes that prepare known batches')
+    parser.add_argument('--profile_phases', dtype=bool,
+                        help='flag to time every phase of training and write the timeline to phases.jsonl in log_dir')
+    parser.add_argument('--profile_memory', dtype=bool,
+                        help='flag to track peak memory and the largest tensors of every phase, reported to memory.jsonl in log_dir after every round')
+    parser.add_argument('--trace_stage', dtype=str,
+                        help='capture a torch.profiler trace of the first stage with this name ("E step" or "M step")')
+    parser.add_argument('--trace_batches', default=0, dtype=int,
+                        help='if positive, traces of the M step cover this many batches instead of a whole stage')
+    parser.add_argument('--trace_on_demand', dtype=bool,
+                        help='flag to capture a trace whenever log_dir/trace.trigger is created or SIGUSR1 is received')
+    parser.add_argument('--decoder_ckpt_segment', dtype=int, default=0,
+                        help='recompute the activations of every this many decoder steps in backward instead of keeping them. 0 means no checkpointing')
+    parser.add_argument('--precision', dtype=str, default='fp32',
+                        help='precision of the forward pass without gradients: "fp32", or "bf16" for bfloat16 autocast on the cpu')
+    parser.add_argument('--quantize_inference', dtype=bool,
+                        help='flag to use a dynamically quantized (int8) copy of the model for inference without gradients. cpu only')
+    parser.add_argument('--num_threads', default=0, dtype=int,
+                        help='number of threads for torch (intra-op) and the edit distance kernel. 0 means their defaults')
+    parser.add_argument('--inter_op_threads', default=0, dtype=int,
+                        help='number of torch inter-op threads. 0 means the default')
     parser.add_argument('--momentum', default=0.25, dtype=float, help='momentum for flow')
     parser.add_argument('--gpu', '-g', dtype=str, help='which gpu to choose')
     parser.add_argument('--random', dtype=bool, help='random, ignore seed')
     parser.add_argument('--seed', dtype=int, default=1234, help='random seed')
     parser.add_argument('--log_level', default='INFO', dtype=str, help='log level')
     parser.add_argument('--n_similar', dtype=int, help='number of most similar source tokens to keep')
+    parser.add_argument('--n_candidates', dtype=int, default=0,
+                        help='number of known candidates per lost word (by model score) to compute expected edits for. 0 means all')
+    parser.add_argument('--n_lexical_candidates', dtype=int, default=0,
+                        help='number of known candidates per lost word from the character n-gram index')
+    parser.add_argument('--num_samples', '-ns', dtype=int, default=10,
+                        help='maximum number of samples per lost word to estimate expected edits')
+    parser.add_argument('--sampling', dtype=str, default='multinomial',
+                        help='how to draw samples for expected edits: multinomial, stratified or gumbel')
+    parser.add_argument('--adaptive_samples', dtype=bool,
+                        help='flag to use fewer samples for lost words with lower decoder entropy')
+    parser.add_argument('--entropy_per_sample', dtype=float, default=1.0,
+                        help='with adaptive samples, use one sample for every this many nats of decoder entropy')
+    parser.add_argument('--edit_chunk_size', dtype=int, default=1000,
+                        help='compute expected edits in chunks of this many known words')
+    parser.add_argument('--score_chunk_size', dtype=int, default=0,
+                        help='compute word scores in chunks of this many known words when no gradients are needed. 0 means no chunking')
     parser.add_cfg_registry(registry)
     args = Map(**parser.parse_args())
 
+    # NOTE Heavy modules are imported after parsing so that `--help` and argument errors are fast.
+    import torch
+
     if args.gpu is not None:
         torch.cuda.set_device(int(args.gpu))  # HACK
         os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
@@ -63,6 +112,36 @@ def parse_args():
 
     create_logger(filepath=args.log_dir + '/log', log_level=args.log_level)
     log_pp(pformat(args))
+    configure_threads(args.num_threads, args.inter_op_threads, num_workers=args.num_workers)
+
+
+def configure_threads(num_threads=0, inter_op_threads=0, num_workers=0):
+    '''
+    Configure every source of parallelism together, and log the result. ``num_threads`` is used by torch (intra-op)
+    and by the edit distance kernel (OpenMP), which never run at the same time. Data loader workers are separate
+    processes with one torch thread each, and the flow solver is single-threaded.
+    '''
+    import editdistance
+    import torch
+
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+    if inter_op_threads > 0:
+        try:
+            torch.set_num_interop_threads(inter_op_threads)
+        except RuntimeError:
+            # NOTE This can only be set once, before any inter-op parallel work has started.
+            logging.warning('Torch inter-op threads can no longer be changed.')
+    if hasattr(editdistance, 'set_num_threads'):
+        if num_threads > 0:
+            editdistance.set_num_threads(num_threads)
+        edit_threads = editdistance.get_num_threads()
+    else:
+        logging.warning('This build of editdistance has a fixed number of threads. Reinstall it from ./editdistance.')
+        edit_threads = None
+    log_pp(f'Threads: torch intra-op {torch.get_num_threads()}, torch inter-op {torch.get_num_interop_threads()}, '
+           f'edit distance {edit_threads}, data loader workers {num_workers}, flow solver 1, '
+           f'cpu count {os.cpu_count()}')
 
 
 def main():
@@ -71,6 +150,8 @@ def main():
 
 
 def train():
+    from nd.train.manager import Manager
+
     manager = Manager()
     manager.train()
 
@@ -0,0 +1,24 @@
+import subprocess
+import sys
+import time
+
+from dev_misc import TestCase
+
+# NOTE Generous enough for a cold start on a slow machine, but much less than importing everything.
+STARTUP_BUDGET = 10.0
+HEAVY_MODULES = ['cvxopt', 'ortools', 'pandas', 'pytrie', 'tensorboard', 'tensorflow']
+
+
+class TestStartup(TestCase):
+
+    def test_no_heavy_imports(self):
+        code = 'import sys; import nd.main; print(" ".join(sorted(sys.modules)))'
+        out = subprocess.run([sys.executable, '-c', code], check=True, capture_output=True, text=True).stdout
+        imported = {name.split('.')[0] for name in out.split()}
+        for name in HEAVY_MODULES:
+            self.assertNotIn(name, imported)
+
+    def test_help_budget(self):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-m', 'nd.main', '--help'], check=True, capture_output=True)
+        self.assertLess(time.perf_counter() - start, STARTUP_BUDGET)
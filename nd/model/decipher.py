@@ -1,19 +1,31 @@
+import numpy as np
 import torch
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
 
 from arglib import use_arguments_as_properties
 from dev_misc import Map, clear_cache, get_tensor, get_zeros
 from nd.dataset.charset import PAD_ID, get_charset
-from nd.flow.edit_dist import compute_expected_edits
-from nd.flow.min_cost_flow import min_cost_flow
-from nd.magic_tensor.core import MagicTensor
+from nd.dataset.ngram_index import map_form
+from nd.dataset.vocab import get_ngram_index
+from nd.flow.edit_dist import (compute_candidate_expected_edits,
+                               compute_expected_edits, select_candidates)
+from nd.flow.min_cost_flow import min_cost_flow, min_cost_flow_sparse
+from nd.magic_tensor.core import ChunkedMagicTensor, MagicTensor
+from nd.profile.core import add_count, phase
 
+from .input_cache import InputCache
 from .lstm_state import LSTMState
 from .modules import (GlobalAttention, MultiLayerLSTMCell,
                       NormControlledResidual, UniversalCharEmbedding)
+from .quantize import QuantizedInference
 
 
-@use_arguments_as_properties('char_emb_dim', 'hidden_size', 'num_layers', 'dropout', 'universal_charset_size', 'lost_lang', 'known_lang', 'norms_or_ratios', 'control_mode', 'residual')
+def _identity(x):
+    return x
+
+
+@use_arguments_as_properties('char_emb_dim', 'hidden_size', 'num_layers', 'dropout', 'universal_charset_size', 'lost_lang', 'known_lang', 'norms_or_ratios', 'control_mode', 'residual', 'score_chunk_size', 'quantize_inference', 'precision', 'decoder_ckpt_segment')
 class DecipherModel(nn.Module):
 
     def __init__(self, trie):
@@ -34,75 +46,169 @@ class DecipherModel(nn.Module):
             self.controlled_residual = NormControlledResidual(
                 norms_or_ratios=self.norms_or_ratios, control_mode=self.control_mode)
         self.trie = trie
+        if self.precision not in ['fp32', 'bf16']:
+            raise ValueError(f'Precision {self.precision} not supported.')
+        self.quantized = QuantizedInference() if self.quantize_inference else None
+        self.input_cache = InputCache()
+        # NOTE This can be changed at runtime, e.g., by `nd.benchmark.checkpointing`.
+        self.ckpt_segment = self.decoder_ckpt_segment
+
+    def _prepare_lost_inputs(self, lost):
+        '''
+        Return everything that only depends on the lost batch: how to pack the encoder inputs, the mask, and the zero
+        initial states.
+        '''
+        bs, sl = lost.id_seqs.shape
+        # NOTE Pack the positions instead of the inputs, so that packing the inputs is only an index lookup.
+        positions = torch.arange(bs * sl, device=lost.id_seqs.device).view(bs, sl)
+        #packed = nn.utils.rnn.pack_padded_sequence(positions, lost.lengths.cpu(), batch_first=True)     # hs 20230106 kagayaki
+        packed = nn.utils.rnn.pack_padded_sequence(positions, lost.lengths, batch_first=True)           # hs 20240207 colab
+        return Map(
+            packed_positions=packed,
+            mask=(lost.id_seqs != PAD_ID).float(),  # bs x sl
+            h=get_zeros(2 * self.num_layers, bs, self.hidden_size),  # NOTE bidirectional, therefore 2
+            c=get_zeros(2 * self.num_layers, bs, self.hidden_size),
+            h_tilde=get_zeros(bs, self.hidden_size))
 
-    def encode(self, id_seqs, lengths):
+    def encode(self, id_seqs, inputs, drop):
         inp_enc = self.char_emb(id_seqs, self.lost_lang)  # bs x L x d
         # inp_enc = self.drop(inp_enc)
-        bs = inp_enc.shape[0]
-        #inp_packed = nn.utils.rnn.pack_padded_sequence(self.drop(inp_enc), lengths.cpu(), batch_first=True)     # hs 20230106 kagayaki
-        inp_packed = nn.utils.rnn.pack_padded_sequence(self.drop(inp_enc), lengths, batch_first=True)           # hs 20240207 colab
-        h = get_zeros(2 * self.num_layers, bs, self.hidden_size)  # NOTE bidirectional, therefore 2
-        c = get_zeros(2 * self.num_layers, bs, self.hidden_size)
-        h_s_packed, encoding = self.encoder(inp_packed, (h, c))
+        bs, sl, d = inp_enc.shape
+        packed = inputs.packed_positions
+        inp_packed = nn.utils.rnn.PackedSequence(drop(inp_enc).reshape(bs * sl, d)[packed.data], packed.batch_sizes,
+                                                 packed.sorted_indices, packed.unsorted_indices)
+        h_s_packed, encoding = self.encoder(inp_packed, (inputs.h, inputs.c))
         h_s = nn.utils.rnn.pad_packed_sequence(h_s_packed, batch_first=True)[0]
         encoding = LSTMState.from_pytorch(encoding)
         return inp_enc, h_s, encoding
 
     def forward(self, batch):
+        with phase('forward'):
+            add_count('lost_words', len(batch.lost.words))
+            add_count('known_words', len(batch.known.words))
+            if self.quantized is not None and not self.training and not torch.is_grad_enabled():
+                # NOTE The trie and the input cache are shared with the copy, and so is `self.quantized` itself.
+                copy = self.quantized.get(self, share=(self.trie, self.quantized, self.input_cache))
+                return copy._forward(batch)
+            if self.precision == 'bf16' and not self.training and not torch.is_grad_enabled():
+                # NOTE Only matmuls and linear layers run in bfloat16. Log softmaxes upcast their inputs.
+                with torch.autocast('cpu', dtype=torch.bfloat16):
+                    return self._forward(batch)
+            return self._forward(batch)
+
+    def _forward(self, batch):
         # Remember to clear cache.
         clear_cache()
 
         lost = batch.lost.lang
         known = batch.known.lang
+        # NOTE Without gradients or dropout, skip the dropout calls, the regularization loss and the alignments it needs.
+        lean = not self.training and not torch.is_grad_enabled()
+        drop = _identity if lean else self.drop
+        inputs = self.input_cache.get(batch.lost, self._prepare_lost_inputs)
         # Encode.
-        emb_s, h_s, encoding = self.encode(batch.lost.id_seqs, batch.lost.lengths)
-        mask_lost = (batch.lost.id_seqs != PAD_ID).float()  # bs x sl
+        emb_s, h_s, encoding = self.encode(batch.lost.id_seqs, inputs, drop)
+        mask_lost = inputs.mask  # bs x sl
         # Start decoding.
         bs, sl, _ = h_s.shape
         input_emb = self.char_emb.get_start_emb(known).expand(bs, -1)  # bs x d
         state = encoding
-        h_tilde = get_zeros(bs, self.hidden_size)
-        empty_ctx_s = get_zeros(bs, self.hidden_size * 2)
-        max_len = max(batch.known.lengths)
+        h_tilde = inputs.h_tilde
+        # NOTE Computed once here instead of inside the decoder steps, so that checkpointed steps recompute the same.
+        Wh_s = self.attention.get_Wh_s(h_s)  # bs x sl x d
+        max_len = int(max(batch.known.lengths))
+        segment = self.ckpt_segment if torch.is_grad_enabled() and self.ckpt_segment > 0 else max_len
+        all_log_probs = list()
+        all_almt_distrs = list()
+        for start in range(0, max_len, segment):
+            args = (min(segment, max_len - start), known, h_tilde, input_emb, state, h_s, Wh_s, emb_s, mask_lost,
+                    drop, lean)
+            if segment < max_len:
+                # NOTE Only the inputs of every segment are kept for backward, and its activations are recomputed.
+                h_tilde, input_emb, state, log_probs, almt_distrs = checkpoint(self._decode, *args, use_reentrant=False)
+            else:
+                h_tilde, input_emb, state, log_probs, almt_distrs = self._decode(*args)
+            all_log_probs.extend(log_probs)
+            all_almt_distrs.extend(almt_distrs)
+
+        log_probs = torch.stack(all_log_probs, dim=0)  # tl x nc x bs
+        almt_distr = None if lean else torch.stack(all_almt_distrs, dim=1)  # bs x tl x sl
+
+        # NOTE Only stream the scores when no gradients are needed -- the autograd graph would keep every chunk anyway.
+        chunk_size = 0 if torch.is_grad_enabled() else self.score_chunk_size
+        with phase('trie.analyze'):
+            ret = self.trie.analyze(log_probs, almt_distr,
+                                    batch.known.words, batch.lost.lengths, chunk_size=chunk_size)
+        ret.log_probs = log_probs
+        if chunk_size > 0:
+            ret.valid_log_probs = ChunkedMagicTensor(ret.score_chunk, batch.lost.words, batch.known.words, chunk_size)
+        else:
+            ret.valid_log_probs = MagicTensor(ret.valid_log_probs, batch.lost.words, batch.known.words)
+        return ret
+
+    def _decode(self, num_steps, known, h_tilde, input_emb, state, h_s, Wh_s, emb_s, mask_lost, drop, lean):
+        '''
+        Run ``num_steps`` decoder steps. Return the last h_tilde, input embedding and state (to continue decoding), and
+        the log probs and alignments of every step. Alignments are not kept if ``lean``.
+        '''
+        bs, sl, _ = h_s.shape
         all_log_probs = list()
         all_almt_distrs = list()
-        for dec_step in range(max_len):
+        for dec_step in range(num_steps):
             input_ = torch.cat([h_tilde, input_emb], dim=-1)
-            input_ = self.drop(input_)
+            input_ = drop(input_)
             state = self.decoder(input_, state)
             ctx_t = state.get_output()  # bs x d
             # get ctx_s
-            almt_distr = self.attention(ctx_t, h_s, mask_lost)
+            almt_distr = self.attention(ctx_t, h_s, mask_lost, Wh_s=Wh_s)
             ctx_s = (almt_distr.view(bs, sl, 1) * h_s).sum(dim=1)  # bs x 2d
             # get h_tilde
             cat = torch.cat([ctx_s, ctx_t], dim=-1)
-            h_tilde_rnn = self.hidden(self.drop(cat))
+            h_tilde_rnn = self.hidden(drop(cat))
             if self.residual:
                 ctx_s_emb = (almt_distr.view(bs, sl, 1) * emb_s).sum(dim=1)  # bs x d
                 h_tilde = self.controlled_residual(ctx_s_emb, h_tilde_rnn)
             else:
                 h_tilde = h_tilde_rnn
             # get probs
-            logits = self.char_emb.project(self.drop(h_tilde), known)
-            log_probs = torch.log_softmax(logits, dim=-1)  # bs x num_char
+            logits = self.char_emb.project(drop(h_tilde), known)
+            log_probs = torch.log_softmax(logits.float(), dim=-1)  # bs x num_char
             probs = log_probs.exp()
             input_emb = self.char_emb.soft_emb(probs, known)
             # Collect stuff.
             all_log_probs.append(log_probs.t())
-            all_almt_distrs.append(almt_distr)
+            if not lean:
+                all_almt_distrs.append(almt_distr)
+        return h_tilde, input_emb, state, all_log_probs, all_almt_distrs
 
-        log_probs = torch.stack(all_log_probs, dim=0)  # tl x nc x bs
-        almt_distr = torch.stack(all_almt_distrs, dim=1)  # bs x tl x sl
 
-        ret = self.trie.analyze(log_probs, almt_distr,
-                                batch.known.words, batch.lost.lengths)
-        ret.log_probs = log_probs
-        ret.valid_log_probs = MagicTensor(ret.valid_log_probs, batch.lost.words, batch.known.words)
-        return ret
+@use_arguments_as_properties('n_similar', 'n_candidates', 'n_lexical_candidates', 'num_samples', 'sampling',
+                             'adaptive_samples', 'entropy_per_sample', 'edit_chunk_size')
+class DecipherModelWithFlow(DecipherModel):
 
+    @property
+    def _sampling_kwargs(self):
+        return {'num_samples': self.num_samples, 'sampling': self.sampling, 'adaptive': self.adaptive_samples,
+                'entropy_per_sample': self.entropy_per_sample}
 
-@use_arguments_as_properties('n_similar')
-class DecipherModelWithFlow(DecipherModel):
+    def _get_lexical_candidates(self, batch, log_probs):
+        '''
+        Query the n-gram index of the known vocab with the greedily decoded form of every lost word, and the lost form
+        itself mapped through the learned character mapping. Return column indices into ``batch.known``, with -1 for
+        words outside this batch.
+        '''
+        lost = batch.lost.lang
+        known = batch.known.lang
+        known_charset = get_charset(known)
+        decoded = known_charset.get_tokens(log_probs.max(dim=1)[1].t())  # bs
+        (mapping, _), _ = self.char_emb.char_mapping(lost, known)
+        queries = [[dec, map_form(form, mapping)] for dec, form in zip(decoded, batch.lost.forms)]
+        index = get_ngram_index(known)
+        ids = index.query(queries, self.n_lexical_candidates)
+        # Map vocab ids to columns of this batch.
+        id2col = np.full([len(index)], -1, dtype='int64')
+        id2col[batch.known.words.ids] = np.arange(len(batch.known.words))
+        return id2col[ids]
 
     def forward(
             self,
@@ -110,7 +216,8 @@ class DecipherModelWithFlow(DecipherModel):
             num_cognates=None,
             mode='mle',
             edit=True,
-            capacity=1):
+            capacity=1,
+            forced=None):
         assert mode in ['mle', 'flow']
         if mode == 'mle':
             ret = super().forward(batch)
@@ -121,10 +228,30 @@ class DecipherModelWithFlow(DecipherModel):
                 known = batch.known.lang
                 known_forms = batch.known.forms
                 known_charset = get_charset(known)
-                expected_edits = compute_expected_edits(
-                    known_charset, ret.log_probs, known_forms, ret.valid_log_probs, edit=edit)
-                flow, cost = min_cost_flow(expected_edits.cpu().numpy(), num_cognates,
-                                           capacity=capacity, n_similar=self.n_similar)
+                if self.n_candidates or self.n_lexical_candidates:
+                    # Only compute expected edits for the most likely known words (and the forced ones).
+                    extra = None
+                    if self.n_lexical_candidates:
+                        extra = self._get_lexical_candidates(batch, ret.log_probs)
+                    candidates = select_candidates(ret.valid_log_probs, self.n_candidates, forced=forced, extra=extra)
+                    with phase('expected edits'):
+                        expected_edits = compute_candidate_expected_edits(
+                            known_charset, ret.log_probs, known_forms, ret.valid_log_probs, candidates, edit=edit,
+                            **self._sampling_kwargs)
+                    with phase('flow solve'):
+                        add_count('arcs', candidates.numel())
+                        flow, cost = min_cost_flow_sparse(candidates.cpu().numpy(), expected_edits.cpu().numpy(),
+                                                          len(known_forms), num_cognates, capacity=capacity)
+                    ret.candidates = candidates
+                else:
+                    with phase('expected edits'):
+                        expected_edits = compute_expected_edits(
+                            known_charset, ret.log_probs, known_forms, ret.valid_log_probs, edit=edit,
+                            chunk_size=self.edit_chunk_size, **self._sampling_kwargs)
+                    with phase('flow solve'):
+                        add_count('arcs', expected_edits.numel())
+                        flow, cost = min_cost_flow(expected_edits.cpu().numpy(), num_cognates,
+                                                   capacity=capacity, n_similar=self.n_similar)
                 flow = MagicTensor(get_tensor(flow), batch.lost.words, batch.known.words)
                 ret.update(flow=flow, cost=cost, expected_edits=expected_edits)
         return ret
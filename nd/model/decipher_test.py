@@ -0,0 +1,39 @@
+import sys
+
+import torch
+
+from dev_misc import TestCase, patch
+from nd.dataset.vocab import clear_vocabs
+from nd.main import parse_args
+from nd.train.manager import Manager
+
+
+class TestDecipherModel(TestCase):
+
+    @patch('nd.main.parser.add_cfg_registry')
+    def setUp(self, patched_add_cfg):
+        clear_vocabs()
+        sys.argv = 'dummy.py -cp data/test.es-fr-en.toy.cog -l es -k en -nc 3 --dropout 0.5'.split()
+        parse_args()
+        manager = Manager()
+        self.model = manager.model
+        self.batch = next(iter(manager.train_data_loader))
+
+    def _run_M_step(self, segment):
+        self.model.ckpt_segment = segment
+        self.model.train()
+        self.model.zero_grad()
+        torch.manual_seed(1234)
+        ret = self.model(self.batch)
+        (ret.valid_log_probs.tensor.sum() + ret.reg_loss.sum()).backward()
+        grads = {name: param.grad.clone() for name, param in self.model.named_parameters() if param.grad is not None}
+        return ret.valid_log_probs.tensor.detach(), ret.reg_loss.detach(), grads
+
+    def test_ckpt_segment(self):
+        valid_log_probs, reg_loss, grads = self._run_M_step(0)
+        ckpt_valid_log_probs, ckpt_reg_loss, ckpt_grads = self._run_M_step(2)
+        self.assertTrue(torch.allclose(valid_log_probs, ckpt_valid_log_probs))
+        self.assertTrue(torch.allclose(reg_loss, ckpt_reg_loss))
+        self.assertSetEqual(set(grads), set(ckpt_grads))
+        for name, grad in grads.items():
+            self.assertTrue(torch.allclose(grad, ckpt_grads[name], atol=1e-6), name)
@@ -0,0 +1,35 @@
+from collections import OrderedDict
+
+
+class InputCache:
+    '''
+    Cache structures that only depend on a batch (e.g., masks and packing indices), keyed by the identity of the batch.
+    The lost batch is the same object on every step, so these are only computed once.
+    '''
+
+    def __init__(self, max_size=4):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, batch, fn):
+        '''
+        Return ``fn(batch)``, computed only if ``batch`` is not cached yet.
+        '''
+        key = id(batch)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] is batch:
+            self._entries.move_to_end(key)
+            return entry[1]
+        value = fn(batch)
+        # NOTE Keep the batch alive so that its id is not reused by another object.
+        self._entries[key] = (batch, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        self._entries.clear()
@@ -0,0 +1,37 @@
+from dev_misc import TestCase
+
+from .input_cache import InputCache
+
+
+class _Batch:
+    pass
+
+
+class TestInputCache(TestCase):
+
+    def setUp(self):
+        self.cache = InputCache(max_size=2)
+        self.calls = list()
+
+    def _fn(self, batch):
+        self.calls.append(batch)
+        return len(self.calls)
+
+    def test_identity(self):
+        batch = _Batch()
+        self.assertEqual(self.cache.get(batch, self._fn), 1)
+        self.assertEqual(self.cache.get(batch, self._fn), 1)
+        self.assertEqual(self.cache.get(_Batch(), self._fn), 2)
+        self.assertEqual(len(self.calls), 2)
+
+    def test_evict(self):
+        b1, b2, b3 = _Batch(), _Batch(), _Batch()
+        self.cache.get(b1, self._fn)
+        self.cache.get(b2, self._fn)
+        self.cache.get(b1, self._fn)  # NOTE b2 is now the least recently used.
+        self.cache.get(b3, self._fn)
+        self.assertEqual(len(self.cache), 2)
+        self.cache.get(b1, self._fn)
+        self.assertEqual(len(self.calls), 3)
+        self.cache.get(b2, self._fn)
+        self.assertEqual(len(self.calls), 4)
@@ -131,21 +131,31 @@ class GlobalAttention(nn.Module):
 
         self.Wa = nn.Parameter(torch.Tensor(input_src_size, input_tgt_size))
         self.drop = nn.Dropout(self.dropout)
+        # NOTE Only set for quantized copies (see `nd.model.quantize`), so that checkpoints are not affected.
+        self.Wa_linear = None
+
+    def get_Wa_linear(self):
+        """Return a linear layer that computes the same as multiplying by ``Wa``."""
+        linear = nn.Linear(self.input_src_size, self.input_tgt_size, bias=False)
+        linear.weight.data.copy_(self.Wa.detach().t())
+        return linear
 
     @cache(full=False)
-    def _get_Wh_s(self, h_s):
+    def get_Wh_s(self, h_s):
         bs, l, _ = h_s.shape
         # There is some weird bug with dropout layer if dropout rate is zero
-        Wh_s = self.drop(h_s).reshape(bs * l, -1).mm(self.Wa).view(bs, l, -1)
-        return Wh_s
+        h_s = self.drop(h_s).reshape(bs * l, -1)
+        Wh_s = h_s.mm(self.Wa) if self.Wa_linear is None else self.Wa_linear(h_s)
+        return Wh_s.view(bs, l, -1)
 
-    def forward(self, h_t, h_s, mask_src):
+    def forward(self, h_t, h_s, mask_src, Wh_s=None):
         bs, sl, ds = h_s.size()
         dt = h_t.shape[-1]
-        Wh_s = self._get_Wh_s(h_s)  # bs x sl x dt
+        if Wh_s is None:
+            Wh_s = self.get_Wh_s(h_s)  # bs x sl x dt
         scores = Wh_s.matmul(self.drop(h_t).unsqueeze(dim=-1)).squeeze(dim=-1)  # bs x sl
 
-        scores = scores * mask_src + (-9999.) * (1.0 - mask_src)
+        scores = scores.float() * mask_src + (-9999.) * (1.0 - mask_src)
         almt_distr = nn.functional.log_softmax(scores, dim=-1).exp()  # bs x sl
         return almt_distr
 
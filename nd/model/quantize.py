@@ -0,0 +1,60 @@
+'''
+Dynamically quantized (int8 weights) copies of a model for inference without gradients on the cpu.
+
+The encoder ``nn.LSTM``, the decoder ``nn.LSTMCell``s, the attention weight ``Wa`` (as a linear layer) and every
+``nn.Linear`` are quantized. Activations are quantized on the fly, so no calibration is needed. Everything else (e.g.,
+the character embeddings and the trie) stays in fp32.
+'''
+import logging
+import warnings
+from copy import deepcopy
+
+import torch
+import torch.nn as nn
+
+QUANTIZED_TYPES = {nn.LSTM, nn.LSTMCell, nn.Linear}
+
+
+def get_weight_version(module):
+    '''
+    Return a key that changes whenever any parameter of ``module`` is modified in place (e.g., by an optimizer step or
+    ``load_state_dict``) or replaced.
+    '''
+    return tuple((id(p), p._version) for p in module.parameters())
+
+
+def quantize_dynamic_copy(model, share=()):
+    '''
+    Return a dynamically quantized copy of ``model`` in eval mode. Objects in ``share`` are not copied.
+    '''
+    memo = {id(obj): obj for obj in share}
+    copy = deepcopy(model, memo)
+    copy.eval()
+    for module in list(copy.modules()):
+        if hasattr(module, 'Wa_linear'):
+            module.Wa_linear = module.get_Wa_linear()
+    with warnings.catch_warnings():
+        # NOTE Eager mode quantization is deprecated in favor of torchao, which is not a dependency of this repo.
+        warnings.simplefilter('ignore')
+        return torch.ao.quantization.quantize_dynamic(copy, QUANTIZED_TYPES, dtype=torch.qint8, inplace=True)
+
+
+class QuantizedInference:
+    '''
+    Keep a quantized copy of a model, and build it again when the weights of the model have changed.
+    '''
+
+    def __init__(self):
+        self._copy = None
+        self._version = None
+
+    def get(self, model, share=()):
+        if any(p.is_cuda for p in model.parameters()):
+            raise RuntimeError('Quantized inference only runs on the cpu.')
+        version = get_weight_version(model)
+        if self._copy is None or version != self._version:
+            self._copy = None  # NOTE Free the old copy first.
+            self._copy = quantize_dynamic_copy(model, share=share)
+            self._version = version
+            logging.debug('Built a new quantized copy of the model.')
+        return self._copy
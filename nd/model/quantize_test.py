@@ -0,0 +1,67 @@
+import torch
+import torch.nn as nn
+
+from dev_misc import TestCase
+
+from .quantize import QuantizedInference, get_weight_version, quantize_dynamic_copy
+
+
+class _Attention(nn.Module):
+
+    def __init__(self):
+        super().__init__()
+        self.Wa = nn.Parameter(torch.randn(6, 4))
+        self.Wa_linear = None
+
+    def get_Wa_linear(self):
+        linear = nn.Linear(6, 4, bias=False)
+        linear.weight.data.copy_(self.Wa.detach().t())
+        return linear
+
+    def forward(self, x):
+        return x.mm(self.Wa) if self.Wa_linear is None else self.Wa_linear(x)
+
+
+class _Model(nn.Module):
+
+    def __init__(self):
+        super().__init__()
+        self.cell = nn.LSTMCell(4, 6)
+        self.attention = _Attention()
+        self.shared = nn.Embedding(3, 4)
+
+    def forward(self, x):
+        h, _ = self.cell(x)
+        return self.attention(h)
+
+
+class TestQuantize(TestCase):
+
+    def setUp(self):
+        torch.manual_seed(1234)
+        self.model = _Model()
+        self.x = torch.randn(5, 4)
+
+    def test_copy(self):
+        copy = quantize_dynamic_copy(self.model, share=(self.model.shared,))
+        self.assertIs(copy.shared, self.model.shared)
+        self.assertIsNone(self.model.attention.Wa_linear)
+        self.assertNotIn('Wa_linear', ''.join(self.model.state_dict()))
+        with torch.no_grad():
+            diff = (copy(self.x) - self.model(self.x)).abs().max().item()
+        self.assertLess(diff, 0.1)
+
+    def test_refresh(self):
+        quantized = QuantizedInference()
+        copy = quantized.get(self.model)
+        self.assertIs(copy, quantized.get(self.model))
+
+        version = get_weight_version(self.model)
+        with torch.no_grad():
+            self.model.attention.Wa.mul_(2.0)
+        self.assertNotEqual(version, get_weight_version(self.model))
+        new_copy = quantized.get(self.model)
+        self.assertIsNot(copy, new_copy)
+        with torch.no_grad():
+            diff = (new_copy(self.x) - self.model(self.x)).abs().max().item()
+        self.assertLess(diff, 0.1)
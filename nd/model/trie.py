@@ -5,12 +5,12 @@ from collections import Counter, defaultdict
 import numpy as np
 import torch
 import torch.sparse
-from pytrie import SortedStringTrie
 
 from arglib import has_properties
 from dev_misc import Map, get_tensor, get_zeros
 from nd.dataset.charset import EOW, EOW_ID, PAD_ID, get_charset
 from nd.dataset.vocab import get_words
+from nd.magic_tensor.axis import as_axis
 
 from .lstm_state import LSTMState
 
@@ -26,6 +26,7 @@ class Trie:
         words = get_words(lang)
         self._max_length = max(map(len, words))  # NOTE EOW has been taken care of by __len__
         self._prepare_weight()
+        self._positions = dict()
         self.clear_cache()
 
     def clear_cache(self):
@@ -39,13 +40,13 @@ class Trie:
         words = get_words(self.lang)
         charset = get_charset(self.lang)
 
-        self._word2rows = defaultdict(list)
         for row, word in enumerate(words):
             for i, c in enumerate(word.char_seq):
                 cid = charset.char2id(c)
-                self._word2rows[word].append(len(rows))
                 rows.append(row)
                 cols.append(len(charset) * i + cid)
+        # NOTE Rows are sorted, so each word occupies a contiguous range of the sparse entries.
+        self._row_ptr = np.cumsum([0] + [len(word) for word in words])
         data = np.ones(len(rows))
         # NOTE This is ugly, but it avoids this issue in 0.4.1: https://github.com/pytorch/pytorch/issues/8856.
         weight = torch.sparse.FloatTensor(
@@ -55,21 +56,17 @@ class Trie:
         self._weight = get_tensor(weight)
 
     def _sample(self, words):
-        all_words = get_words(self.lang)
-        word_indices = list()
-        old_to_new = np.zeros([len(all_words)], dtype='int64')
-        self._eff_id2word = list()
-        self._eff_word2id = dict()
-        self._eff_max_length = max(map(len, words))
-        for w in words:
-            word_indices.extend(self._word2rows[w])
-            old_to_new[w.idx] = len(self._eff_id2word)
-            self._eff_id2word.append(w)
-            self._eff_word2id[w] = len(self._eff_word2id)
-        old_to_new = get_tensor(old_to_new)
-        indices = get_tensor(word_indices, dtype='l')
-        old_rows, cols = self._weight._indices()[:, word_indices].unbind(dim=0)
-        rows = old_to_new[old_rows]
+        words = as_axis(words)
+        ids = words.ids
+        starts = self._row_ptr[ids]
+        sizes = self._row_ptr[ids + 1] - starts
+        self._eff_max_length = int(sizes.max())  # NOTE Every word has one entry per character (including EOW).
+        # Gather the contiguous entry ranges of all words at once.
+        new_ptr = np.cumsum(np.concatenate([[0], sizes]))
+        word_indices = np.repeat(starts - new_ptr[:-1], sizes) + np.arange(new_ptr[-1])
+        word_indices = get_tensor(word_indices, dtype='l')
+        cols = self._weight._indices()[1, word_indices]
+        rows = get_tensor(np.repeat(np.arange(len(words)), sizes), dtype='l')
         data = self._weight._values()[word_indices]
         charset = get_charset(self.lang)
         weight = torch.sparse.FloatTensor(
@@ -77,8 +74,33 @@ class Trie:
             data,
             (len(words), self._eff_max_length * len(charset)))
         self._eff_weight = get_tensor(weight)
+        self._eff_row_ptr = new_ptr
 
-    def analyze(self, log_probs, almt_distr, words, lost_lengths):
+    def _get_chunk_scorer(self, log_probs):
+        """Return a function that computes the valid log probs for words[start: end] only."""
+        tl, nc, bs = log_probs.shape
+        flat_log_probs = log_probs.view(-1, bs)
+        indices = self._eff_weight._indices()
+        values = self._eff_weight._values()
+        row_ptr = self._eff_row_ptr
+
+        def score_chunk(start, end):
+            lo, hi = row_ptr[start], row_ptr[end]
+            rows, cols = indices[:, lo: hi].unbind(dim=0)
+            weight = torch.sparse.FloatTensor(
+                torch.stack([rows - start, cols], dim=0),
+                values[lo: hi],
+                (end - start, tl * nc))
+            return weight.matmul(flat_log_probs).t()  # bs x (end - start)
+
+        return score_chunk
+
+    def analyze(self, log_probs, almt_distr, words, lost_lengths, chunk_size=0):
+        '''
+        If ``chunk_size`` is positive, ``valid_log_probs`` is not computed. Instead, ``score_chunk`` is returned so that
+        the caller can compute the scores for a chunk of words at a time. If ``almt_distr`` is None, ``reg_loss`` is not
+        computed either.
+        '''
         self.clear_cache()
         self._sample(words)
 
@@ -88,11 +110,19 @@ class Trie:
         charset = get_charset(self.lang)
         assert nc == len(charset)
 
-        # V x bs, or c_s x c_t -> bs x V
-        valid_log_probs = self._eff_weight.matmul(log_probs.view(-1, bs)).t()
+        if chunk_size > 0:
+            valid_log_probs = None
+            score_chunk = self._get_chunk_scorer(log_probs)
+        else:
+            # V x bs, or c_s x c_t -> bs x V
+            valid_log_probs = self._eff_weight.matmul(log_probs.view(-1, bs)).t()
+            score_chunk = None
+
+        if almt_distr is None:
+            return Map(reg_loss=None, valid_log_probs=valid_log_probs, score_chunk=score_chunk)
 
         sl = almt_distr.shape[-1]
-        pos = get_tensor(torch.arange(sl).float(), requires_grad=False)
+        pos = self._get_positions(sl)
         mean_pos = (pos * almt_distr).sum(dim=-1)  # bs x tl
         mean_pos = torch.cat([get_zeros(bs, 1, requires_grad=False).fill_(-1.0), mean_pos],
                              dim=-1)
@@ -104,4 +134,9 @@ class Trie:
         reg_loss = margin.float() * (rel_pos_diff ** 2)  # bs x tl
         reg_loss = (reg_loss * reg_weight).sum()
 
-        return Map(reg_loss=reg_loss, valid_log_probs=valid_log_probs)
+        return Map(reg_loss=reg_loss, valid_log_probs=valid_log_probs, score_chunk=score_chunk)
+
+    def _get_positions(self, sl):
+        if sl not in self._positions:
+            self._positions[sl] = get_tensor(torch.arange(sl).float(), requires_grad=False)
+        return self._positions[sl]
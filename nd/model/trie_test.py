@@ -36,3 +36,23 @@ class TestTrie(TestCase):
         ret = self.trie.analyze(log_probs, almt_distr, self.sampled_words,
                                 torch.LongTensor([7] * 32 + [6] * 16 + [2] * 16))
         self.assertHasShape(ret.valid_log_probs, (64, 2))
+
+    def test_chunks(self):
+        log_probs = self._get_probs(6, 30, 64)
+        almt_distr = self._get_probs(64, 6, 7)
+        lost_lengths = torch.LongTensor([7] * 32 + [6] * 16 + [2] * 16)
+        dense = self.trie.analyze(log_probs, almt_distr, self.words, lost_lengths).valid_log_probs
+        ret = self.trie.analyze(log_probs, almt_distr, self.words, lost_lengths, chunk_size=2)
+        self.assertIsNone(ret.valid_log_probs)
+        chunks = torch.cat([ret.score_chunk(0, 2), ret.score_chunk(2, 3)], dim=1)
+        self.assertHasShape(chunks, (64, 3))
+        self.assertTrue(torch.allclose(chunks, dense))
+
+    def test_no_alignment(self):
+        log_probs = self._get_probs(6, 30, 64)
+        almt_distr = self._get_probs(64, 6, 7)
+        lost_lengths = torch.LongTensor([7] * 32 + [6] * 16 + [2] * 16)
+        full = self.trie.analyze(log_probs, almt_distr, self.words, lost_lengths)
+        ret = self.trie.analyze(log_probs, None, self.words, lost_lengths)
+        self.assertIsNone(ret.reg_loss)
+        self.assertTrue(torch.allclose(ret.valid_log_probs, full.valid_log_probs))
@@ -0,0 +1,102 @@
+'''
+Lightweight hooks for profilers. Code marks its phases with ``phase(name)`` (a context manager) and reports work done
+with ``add_count(name, n)``. Phases can be nested, and every profiler sees the full path of a phase, e.g.,
+"M step/forward/trie.analyze".
+
+Profilers are registered with ``enable`` and removed with ``disable``. When none is registered, ``phase`` returns a
+shared no-op context manager and ``add_count`` returns immediately, so the hooks cost next to nothing.
+
+A profiler can implement any of these methods:
+- ``enter(path)``: called when a phase starts.
+- ``exit(path)``: called when a phase ends.
+- ``count(path, name, n)``: called by ``add_count`` within the phase ``path``.
+'''
+_PROFILERS = list()
+_STACK = list()
+
+
+class _NullPhase:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_PHASE = _NullPhase()
+
+
+class _Phase:
+
+    __slots__ = ('name', 'path')
+
+    def __init__(self, name):
+        self.name = name
+        self.path = None
+
+    def __enter__(self):
+        _STACK.append(self.name)
+        self.path = '/'.join(_STACK)
+        for profiler in _PROFILERS:
+            if hasattr(profiler, 'enter'):
+                profiler.enter(self.path)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # NOTE Exit in the reverse order so that nested profilers do not measure each other.
+        for profiler in reversed(_PROFILERS):
+            if hasattr(profiler, 'exit'):
+                profiler.exit(self.path)
+        _STACK.pop()
+        return False
+
+
+def phase(name):
+    if not _PROFILERS:
+        return _NULL_PHASE
+    return _Phase(name)
+
+
+def add_count(name, n):
+    if not _PROFILERS:
+        return
+    path = '/'.join(_STACK)
+    for profiler in _PROFILERS:
+        if hasattr(profiler, 'count'):
+            profiler.count(path, name, n)
+
+
+def timed_iter(name, iterable):
+    '''
+    Yield from ``iterable``, and time every ``next`` call as the phase ``name``, e.g., to measure batch collation.
+    '''
+    if not _PROFILERS:
+        yield from iterable
+        return
+    iterator = iter(iterable)
+    while True:
+        with phase(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def enable(profiler):
+    if profiler not in _PROFILERS:
+        _PROFILERS.append(profiler)
+
+
+def disable(profiler):
+    if profiler in _PROFILERS:
+        _PROFILERS.remove(profiler)
+
+
+def is_enabled():
+    return bool(_PROFILERS)
+
+
+def current_path():
+    return '/'.join(_STACK)
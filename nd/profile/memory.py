@@ -0,0 +1,236 @@
+'''
+An opt-in memory profiler for the phases marked by ``nd.profile.core.phase``.
+
+Two things are measured for every phase:
+- The peak resident set size of the process, sampled by a background thread (from ``/proc/self/statm``).
+- The peak bytes of live tensors created by torch functions called from python, tracked by a ``TorchFunctionMode``.
+  Every tensor of at least ``min_bytes`` is attributed to the phase and the code (the innermost frame outside of torch
+  and this package) that created it. Tensors that share storage are only counted once. Allocations inside C++ (e.g.,
+  the buffers of autograd) are not seen, so the tracked peak is a lower bound.
+
+``report`` writes the summary of every phase since the last report, and the largest tensors that are still alive, to
+a jsonl file.
+'''
+import heapq
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import weakref
+from collections import defaultdict
+from pathlib import Path
+
+import torch
+from torch.overrides import TorchFunctionMode
+
+from dev_misc import log_pp
+
+from . import core
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+_MB = 1024 * 1024
+# Frames from torch and the profiler are skipped when looking for the code that created a tensor.
+_TORCH_DIR = os.path.dirname(torch.__file__)
+_SKIPPED_FILES = {__file__, core.__file__}
+
+
+def read_rss():
+    """Return the resident set size in bytes, or None if not available."""
+    try:
+        with open('/proc/self/statm') as fin:
+            return int(fin.read().split()[1]) * _PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def _get_origin():
+    frame = sys._getframe(2)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if not filename.startswith(_TORCH_DIR) and filename not in _SKIPPED_FILES:
+            return f'{frame.f_globals.get("__name__", filename)}.{frame.f_code.co_name}:{frame.f_lineno}'
+        frame = frame.f_back
+    return 'unknown'
+
+
+class _AllocationMode(TorchFunctionMode):
+
+    def __init__(self, profiler):
+        super().__init__()
+        self.profiler = profiler
+
+    def __torch_function__(self, func, types, args=(), kwargs=None):
+        ret = func(*args, **(kwargs or dict()))
+        if isinstance(ret, torch.Tensor):
+            self.profiler._track(ret)
+        elif isinstance(ret, (tuple, list)):
+            for item in ret:
+                if isinstance(item, torch.Tensor):
+                    self.profiler._track(item)
+        return ret
+
+
+class _PhaseMemory:
+
+    __slots__ = ('calls', 'peak_rss', 'rss_increase', 'tracked_increase', 'top')
+
+    def __init__(self):
+        self.calls = 0
+        self.peak_rss = 0
+        self.rss_increase = 0
+        self.tracked_increase = 0
+        self.top = list()  # A min-heap of the largest allocations.
+
+
+class MemoryProfiler:
+    '''
+    Use it as a context manager around the code to profile, and register it with ``nd.profile.core.enable`` to get
+    numbers per phase.
+    '''
+
+    def __init__(self, report_path, min_bytes=_MB, interval=0.01, top_k=5):
+        self.report_path = report_path
+        self.min_bytes = min_bytes
+        self.interval = interval
+        self.top_k = top_k
+        self._lock = threading.Lock()
+        self._mode = _AllocationMode(self)
+        # Live tracked storages: data pointer -> [number of tensors, info].
+        self._live = dict()
+        self._live_bytes = 0
+        self._rss = read_rss()
+        # Open phases: path -> [rss at enter, peak rss, tracked bytes at enter, peak tracked bytes].
+        self._open = dict()
+        self._stats = defaultdict(_PhaseMemory)
+        self._stop = threading.Event()
+        self._sampler = None
+        self._path = ''
+
+    def __enter__(self):
+        if self._rss is not None:
+            self._stop.clear()
+            self._sampler = threading.Thread(target=self._sample, name='memory-sampler', daemon=True)
+            self._sampler.start()
+        self._mode.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._mode.__exit__(exc_type, exc_value, traceback)
+        if self._sampler is not None:
+            self._stop.set()
+            self._sampler.join()
+            self._sampler = None
+        return False
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self._update_rss(read_rss())
+
+    def _update_rss(self, rss):
+        if rss is None:
+            return
+        with self._lock:
+            self._rss = rss
+            for record in self._open.values():
+                record[1] = max(record[1], rss)
+
+    def _track(self, tensor):
+        if tensor.layout != torch.strided:
+            return
+        try:
+            storage = tensor.untyped_storage()
+            ptr = storage.data_ptr()
+            nbytes = storage.nbytes()
+        except (RuntimeError, NotImplementedError):
+            return
+        if nbytes < self.min_bytes or ptr == 0:
+            return
+        with self._lock:
+            if ptr in self._live:
+                self._live[ptr][0] += 1
+            else:
+                info = {'mb': nbytes / _MB, 'shape': list(tensor.shape),
+                        'dtype': str(tensor.dtype).replace('torch.', ''), 'device': str(tensor.device),
+                        'origin': _get_origin(), 'phase': self._path}
+                self._live[ptr] = [1, info]
+                self._live_bytes += nbytes
+                for record in self._open.values():
+                    record[3] = max(record[3], self._live_bytes)
+                top = self._stats[self._path].top
+                item = (nbytes, id(info), info)
+                if len(top) < self.top_k:
+                    heapq.heappush(top, item)
+                elif nbytes > top[0][0]:
+                    heapq.heapreplace(top, item)
+        weakref.finalize(tensor, self._release, ptr, nbytes)
+
+    def _release(self, ptr, nbytes):
+        with self._lock:
+            entry = self._live.get(ptr)
+            if entry is None:
+                return
+            entry[0] -= 1
+            if entry[0] == 0:
+                del self._live[ptr]
+                self._live_bytes -= nbytes
+
+    def enter(self, path):
+        rss = read_rss()
+        with self._lock:
+            rss = rss if rss is not None else (self._rss or 0)
+            self._open[path] = [rss, rss, self._live_bytes, self._live_bytes]
+            self._path = path
+
+    def exit(self, path):
+        self._update_rss(read_rss())
+        with self._lock:
+            rss_start, peak_rss, tracked_start, peak_tracked = self._open.pop(path)
+            stats = self._stats[path]
+            stats.calls += 1
+            stats.peak_rss = max(stats.peak_rss, peak_rss)
+            stats.rss_increase = max(stats.rss_increase, peak_rss - rss_start)
+            stats.tracked_increase = max(stats.tracked_increase, peak_tracked - tracked_start)
+            self._path = path.rpartition('/')[0]
+
+    def largest_live(self):
+        with self._lock:
+            infos = [info for _, info in self._live.values()]
+        return sorted(infos, key=lambda info: info['mb'], reverse=True)[:self.top_k]
+
+    def report(self, step, **info):
+        '''
+        Write a summary of every phase since the last report, tagged with ``info`` (e.g., round), and reset.
+        '''
+        with self._lock:
+            stats = dict(self._stats)
+            self._stats.clear()
+        phases = list()
+        for path, s in stats.items():
+            if not s.calls:
+                continue
+            top = [item[2] for item in sorted(s.top, reverse=True)]
+            phases.append({'phase': path, 'calls': s.calls, 'peak_rss_mb': s.peak_rss / _MB,
+                           'rss_increase_mb': s.rss_increase / _MB, 'tracked_increase_mb': s.tracked_increase / _MB,
+                           'largest_allocations': top})
+        record = dict(time=time.time(), step=step, **info, phases=phases, largest_live=self.largest_live(),
+                      live_tracked_mb=self._live_bytes / _MB)
+        Path(self.report_path).parent.mkdir(parents=True, exist_ok=True)
+        with open(self.report_path, 'a', encoding='utf8') as fout:
+            fout.write(json.dumps(record) + '\n')
+        self._log(phases)
+
+    def _log(self, phases):
+        from prettytable import PrettyTable as pt
+
+        table = pt()
+        table.field_names = 'phase', 'calls', 'peak rss (MB)', 'rss increase (MB)', 'tensor increase (MB)', 'largest'
+        for p in phases:
+            largest = p['largest_allocations'][0] if p['largest_allocations'] else None
+            largest = f"{largest['mb']:.1f}MB {largest['shape']} @ {largest['origin']}" if largest else ''
+            table.add_row([p['phase'], p['calls'], f"{p['peak_rss_mb']:.1f}", f"{p['rss_increase_mb']:.1f}",
+                           f"{p['tracked_increase_mb']:.1f}", largest])
+        table.align = 'l'
+        log_pp(table)
+        logging.info(f'Memory report written to {self.report_path}')
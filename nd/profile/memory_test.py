@@ -0,0 +1,45 @@
+import json
+import tempfile
+from pathlib import Path
+
+import torch
+
+from dev_misc import TestCase
+
+from .core import disable, enable, phase
+from .memory import MemoryProfiler
+
+
+class TestMemoryProfiler(TestCase):
+
+    def setUp(self):
+        self.log_dir = tempfile.TemporaryDirectory()
+        self.report_path = Path(self.log_dir.name) / 'memory.jsonl'
+        self.profiler = MemoryProfiler(self.report_path)
+        enable(self.profiler)
+
+    def tearDown(self):
+        disable(self.profiler)
+        self.log_dir.cleanup()
+
+    def test_report(self):
+        with self.profiler:
+            with phase('E step'):
+                x = torch.zeros(1024, 1024)  # 4MB
+                y = x.view(-1)  # Shares the storage, so it is not counted again.
+                z = torch.ones(1024, 512) * 2  # 2MB for the temporary, and 2MB for the result.
+                small = torch.zeros(10)  # Not tracked.
+                del x, y, z, small
+                kept = torch.zeros(256, 1024)  # 1MB
+            self.profiler.report(1, round=1)
+        with self.report_path.open() as fin:
+            record = json.loads(fin.readline())
+        self.assertEqual(record['round'], 1)
+        e_step = record['phases'][0]
+        self.assertEqual(e_step['phase'], 'E step')
+        self.assertAlmostEqual(e_step['tracked_increase_mb'], 8.0)
+        self.assertListEqual(e_step['largest_allocations'][0]['shape'], [1024, 1024])
+        self.assertIn('memory_test', e_step['largest_allocations'][0]['origin'])
+        self.assertEqual(len(record['largest_live']), 1)
+        self.assertAlmostEqual(record['live_tracked_mb'], 1.0)
+        del kept
@@ -0,0 +1,82 @@
+'''
+Wall-clock and cpu timers for the phases marked by ``nd.profile.core.phase``.
+'''
+import json
+import time
+from collections import defaultdict
+
+import torch
+
+
+class _PhaseStats:
+
+    __slots__ = ('calls', 'wall', 'cpu', 'counts')
+
+    def __init__(self):
+        self.calls = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.counts = defaultdict(int)
+
+
+class PhaseTimer:
+    '''
+    Accumulate the wall-clock time, cpu time (of all threads of this process) and counts (e.g., lost words or arcs)
+    of every phase, until ``flush`` writes them out as one record per phase to a jsonl timeline and to tensorboard.
+    Throughput is reported as counts per second of wall-clock time of the phase in which they were counted.
+
+    Cuda is synchronized at the boundaries of phases so that asynchronous kernels are attributed to the right phase.
+    '''
+
+    def __init__(self, timeline_path, tb_writer=None):
+        self.timeline_path = timeline_path
+        self.tb_writer = tb_writer
+        self._stats = defaultdict(_PhaseStats)
+        self._starts = dict()
+
+    def enter(self, path):
+        if torch.cuda.is_initialized():
+            torch.cuda.synchronize()
+        self._starts[path] = (time.perf_counter(), time.process_time())
+
+    def exit(self, path):
+        if torch.cuda.is_initialized():
+            torch.cuda.synchronize()
+        wall_start, cpu_start = self._starts.pop(path)
+        stats = self._stats[path]
+        stats.calls += 1
+        stats.wall += time.perf_counter() - wall_start
+        stats.cpu += time.process_time() - cpu_start
+
+    def count(self, path, name, n):
+        self._stats[path].counts[name] += n
+
+    def get_records(self):
+        records = list()
+        for path, stats in self._stats.items():
+            record = {'phase': path, 'calls': stats.calls, 'wall': stats.wall, 'cpu': stats.cpu}
+            if stats.counts:
+                record['counts'] = dict(stats.counts)
+                if stats.wall > 0:
+                    record['throughput'] = {f'{name}_per_sec': n / stats.wall for name, n in stats.counts.items()}
+            records.append(record)
+        return records
+
+    def flush(self, step, **info):
+        '''
+        Write the records accumulated so far, tagged with ``info`` (e.g., round and stage), and reset.
+        '''
+        records = self.get_records()
+        if not records:
+            return
+        now = time.time()
+        with open(self.timeline_path, 'a', encoding='utf8') as fout:
+            for record in records:
+                fout.write(json.dumps(dict(time=now, step=step, **info, **record)) + '\n')
+        if self.tb_writer:
+            for record in records:
+                self.tb_writer.add_scalar(f'phase/{record["phase"]}/wall', record['wall'], global_step=step)
+                self.tb_writer.add_scalar(f'phase/{record["phase"]}/cpu', record['cpu'], global_step=step)
+                for name, value in record.get('throughput', dict()).items():
+                    self.tb_writer.add_scalar(f'phase/{record["phase"]}/{name}', value, global_step=step)
+        self._stats.clear()
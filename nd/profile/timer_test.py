@@ -0,0 +1,52 @@
+import json
+import tempfile
+from pathlib import Path
+
+from dev_misc import TestCase
+
+from .core import add_count, disable, enable, is_enabled, phase, timed_iter
+from .timer import PhaseTimer
+
+
+class TestPhaseTimer(TestCase):
+
+    def setUp(self):
+        self.log_dir = tempfile.TemporaryDirectory()
+        self.timeline_path = Path(self.log_dir.name) / 'phases.jsonl'
+        self.timer = PhaseTimer(self.timeline_path)
+        enable(self.timer)
+
+    def tearDown(self):
+        disable(self.timer)
+        self.log_dir.cleanup()
+
+    def test_disabled(self):
+        disable(self.timer)
+        self.assertFalse(is_enabled())
+        with phase('E step'):
+            add_count('arcs', 10)
+        self.assertEqual(self.timer.get_records(), list())
+
+    def test_nested(self):
+        with phase('M step'):
+            for _ in timed_iter('collate', range(3)):
+                with phase('forward'):
+                    add_count('lost_words', 5)
+        records = {r['phase']: r for r in self.timer.get_records()}
+        self.assertSetEqual(set(records), {'M step', 'M step/collate', 'M step/forward'})
+        # NOTE The last `next` call that raises StopIteration is also timed.
+        self.assertEqual(records['M step/collate']['calls'], 4)
+        self.assertEqual(records['M step/forward']['counts']['lost_words'], 15)
+        self.assertIn('lost_words_per_sec', records['M step/forward']['throughput'])
+
+    def test_flush(self):
+        for step in range(2):
+            with phase('E step'):
+                pass
+            self.timer.flush(step, round=1)
+        self.timer.flush(2)  # Nothing to write.
+        with self.timeline_path.open() as fin:
+            records = [json.loads(line) for line in fin]
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[1]['step'], 1)
+        self.assertEqual(records[1]['round'], 1)
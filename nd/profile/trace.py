@@ -0,0 +1,159 @@
+'''
+On-demand ``torch.profiler`` traces of single stages (an E step or an M-step epoch) or a few M-step batches.
+
+A capture is requested by ``--trace_stage`` at the start of training, or, with ``--trace_on_demand``, at any time
+during training by either
+- creating the file ``<log_dir>/trace.trigger``, optionally containing the stage name and/or the number of batches,
+  e.g., "E step" or "M step 20", or
+- sending SIGUSR1 to the process.
+
+The capture starts at the next matching stage, and the trace (with shapes and stacks) is exported to ``log_dir`` in the
+Chrome trace format, which can be opened by Perfetto or chrome://tracing. The capture then turns itself off until the
+next request. Phases marked by ``nd.profile.core.phase`` show up as labeled ranges in the trace.
+'''
+import logging
+import os
+import signal
+import threading
+from pathlib import Path
+
+import torch
+from torch.autograd.profiler import record_function
+from torch.profiler import ProfilerActivity, profile
+
+from . import core
+
+TRIGGER = 'trace.trigger'
+
+
+class _Request:
+
+    __slots__ = ('stage', 'num_batches')
+
+    def __init__(self, stage=None, num_batches=0):
+        self.stage = stage
+        self.num_batches = num_batches
+
+
+def parse_trigger(content):
+    '''
+    Parse the content of a trigger file like "M step 20" into a stage name (None for any stage) and a number of batches.
+    '''
+    tokens = content.split()
+    num_batches = None
+    if tokens and tokens[-1].isdigit():
+        num_batches = int(tokens.pop())
+    stage = ' '.join(tokens) or None
+    return stage, num_batches
+
+
+class TraceCapture:
+    '''
+    ``poll`` is called before every stage, ``step`` after every M-step batch, and ``end_stage`` after every stage.
+    If ``num_batches`` is positive, captures cover that many M-step batches (possibly across epochs) instead of
+    whole stages. Requests for other stages still capture the whole stage.
+    '''
+
+    def __init__(self, log_dir, num_batches=0, on_demand=False):
+        self.log_dir = log_dir
+        self.num_batches = num_batches
+        self.trigger_path = Path(log_dir) / TRIGGER if on_demand else None
+        self._request = None
+        self._profiler = None
+        self._trace_path = None
+        self._batches_left = 0
+        self._ranges = dict()
+        if on_demand and threading.current_thread() is threading.main_thread() and hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, self._on_signal)
+
+    @property
+    def active(self):
+        return self._profiler is not None
+
+    def request(self, stage=None, num_batches=None):
+        num_batches = self.num_batches if num_batches is None else num_batches
+        self._request = _Request(stage=stage, num_batches=num_batches)
+        logging.imp(f'Trace requested for stage {stage or "any"} and {num_batches or "all"} batches.')
+
+    def _on_signal(self, signum, frame):
+        # NOTE Only set a flag here. The capture itself starts at the next stage.
+        self._request = _Request(num_batches=self.num_batches)
+
+    def _check_trigger(self):
+        if self.trigger_path is None or not self.trigger_path.exists():
+            return
+        try:
+            content = self.trigger_path.read_text(encoding='utf8')
+            self.trigger_path.unlink()
+        except OSError:
+            return
+        self.request(*parse_trigger(content))
+
+    def poll(self, stage, epoch):
+        # A capture of batches does not extend into other stages.
+        if self.active and stage != 'M step':
+            self._stop()
+        self._check_trigger()
+        request = self._request
+        if self.active or request is None:
+            return
+        if request.stage is not None and request.stage != stage:
+            return
+        num_batches = request.num_batches
+        if num_batches and stage != 'M step':
+            # NOTE Only M-step batches are counted, so a request for any other stage captures the whole stage, and a
+            # request for any stage waits for the M step.
+            if request.stage is None:
+                return
+            num_batches = 0
+        self._request = None
+        self._start(stage, epoch, num_batches)
+
+    def step(self):
+        if self.active and self._batches_left:
+            self._batches_left -= 1
+            if self._batches_left == 0:
+                self._stop()
+
+    def end_stage(self):
+        if self.active and not self._batches_left:
+            self._stop()
+
+    def close(self):
+        """Write out the trace of an unfinished capture, e.g., when training ends."""
+        if self.active:
+            self._stop()
+
+    def _start(self, stage, epoch, num_batches):
+        activities = [ProfilerActivity.CPU]
+        if torch.cuda.is_available() and torch.cuda.is_initialized():
+            activities.append(ProfilerActivity.CUDA)
+        name = stage.replace(' ', '_')
+        suffix = f'{num_batches}batches' if num_batches else 'stage'
+        self._trace_path = os.path.join(self.log_dir, f'trace.{name}.{epoch}.{suffix}.json')
+        self._batches_left = num_batches
+        self._profiler = profile(activities=activities, record_shapes=True, with_stack=True)
+        self._profiler.start()
+        core.enable(self)
+        logging.imp(f'Started capturing a trace for {stage} at epoch {epoch}.')
+
+    def _stop(self):
+        core.disable(self)
+        for rf in reversed(list(self._ranges.values())):
+            rf.__exit__(None, None, None)
+        self._ranges.clear()
+        self._profiler.stop()
+        self._profiler.export_chrome_trace(self._trace_path)
+        logging.imp(f'Trace written to {self._trace_path}')
+        self._profiler = None
+        self._batches_left = 0
+
+    def enter(self, path):
+        rf = record_function(path)
+        rf.__enter__()
+        self._ranges[path] = rf
+
+    def exit(self, path):
+        rf = self._ranges.pop(path, None)
+        if rf is not None:
+            rf.__exit__(None, None, None)
@@ -0,0 +1,69 @@
+import tempfile
+from pathlib import Path
+
+import torch
+
+from dev_misc import TestCase
+
+from .core import phase
+from .trace import TRIGGER, TraceCapture, parse_trigger
+
+
+class TestTraceCapture(TestCase):
+
+    def setUp(self):
+        self.log_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.log_dir.cleanup()
+
+    def _run_stage(self, capture, stage, epoch, num_batches=2):
+        capture.poll(stage, epoch)
+        with phase(stage):
+            for _ in range(num_batches):
+                torch.randn(10, 10).sum()
+                if stage == 'M step':
+                    capture.step()
+        capture.end_stage()
+
+    def _get_traces(self):
+        return sorted(path.name for path in Path(self.log_dir.name).glob('trace.*.json'))
+
+    def test_parse_trigger(self):
+        self.assertEqual(parse_trigger(''), (None, None))
+        self.assertEqual(parse_trigger('E step\n'), ('E step', None))
+        self.assertEqual(parse_trigger('M step 20'), ('M step', 20))
+        self.assertEqual(parse_trigger('5'), (None, 5))
+
+    def test_stage(self):
+        capture = TraceCapture(self.log_dir.name)
+        capture.request(stage='M step')
+        self._run_stage(capture, 'E step', 1)
+        self.assertFalse(capture.active)
+        self._run_stage(capture, 'M step', 1)
+        self._run_stage(capture, 'M step', 2)
+        self.assertListEqual(self._get_traces(), ['trace.M_step.1.stage.json'])
+
+    def test_batches_and_trigger(self):
+        capture = TraceCapture(self.log_dir.name, num_batches=3, on_demand=True)
+        (Path(self.log_dir.name) / TRIGGER).write_text('')
+        self._run_stage(capture, 'E step', 1)
+        self.assertFalse(capture.active)
+        # Three batches span two epochs.
+        self._run_stage(capture, 'M step', 1)
+        self.assertTrue(capture.active)
+        self._run_stage(capture, 'M step', 2)
+        self.assertFalse(capture.active)
+        self.assertListEqual(self._get_traces(), ['trace.M_step.1.3batches.json'])
+        self.assertFalse((Path(self.log_dir.name) / TRIGGER).exists())
+
+    def test_e_step_with_batches(self):
+        capture = TraceCapture(self.log_dir.name, num_batches=3, on_demand=True)
+        capture.request(stage='E step')
+        self._run_stage(capture, 'M step', 1)
+        self.assertFalse(capture.active)
+        self._run_stage(capture, 'E step', 2)
+        self.assertFalse(capture.active)
+        (Path(self.log_dir.name) / TRIGGER).write_text('E step 5')
+        self._run_stage(capture, 'E step', 3)
+        self.assertListEqual(self._get_traces(), ['trace.E_step.2.stage.json', 'trace.E_step.3.stage.json'])
@@ -0,0 +1,240 @@
+'''
+Checkpoint writing and loading. Checkpoints are always written to a temporary file first and then renamed, so that a
+crash never leaves a partially written checkpoint behind. ``CheckpointWriter`` does the writing in a background thread.
+
+There are two formats:
+- 'torch': one pickled ``torch.save`` file.
+- 'mmap': a directory with a small json header, one pickled skeleton of all non-tensor states, and one tensor file per
+  top-level entry (e.g., model, optim), which are loaded with ``mmap=True``. File names (other than the header) carry a
+  nonce, and the header is replaced last, so the header always points at a complete set of files.
+'''
+import atexit
+import copy
+import json
+import logging
+import os
+import queue
+import shutil
+import threading
+import uuid
+from pathlib import Path
+
+import numpy as np
+import torch
+
+
+def snapshot(obj):
+    '''
+    Recursively copy ``obj`` (typically a dictionary of state dicts) so that it can be written while training goes on.
+    Tensors are detached and copied to cpu.
+    '''
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    elif isinstance(obj, dict):
+        return type(obj)((k, snapshot(v)) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+    elif isinstance(obj, np.ndarray):
+        return obj.copy()
+    else:
+        return copy.deepcopy(obj)
+
+
+def _replace(tmp_path, path):
+    '''
+    Rename ``tmp_path`` to ``path``. A checkpoint in the other format (a file instead of a directory or vice versa)
+    cannot be replaced by one rename, so it is moved aside first and only removed once ``tmp_path`` is in place.
+    '''
+    path = Path(path)
+    if not path.exists() or path.is_dir() == Path(tmp_path).is_dir():
+        os.replace(tmp_path, path)
+        return
+    old_path = path.with_name(f'{path.name}.old.{os.getpid()}')
+    os.replace(path, old_path)
+    os.replace(tmp_path, path)
+    if old_path.is_dir():
+        shutil.rmtree(old_path)
+    else:
+        old_path.unlink()
+
+
+def save_atomic(obj, path):
+    tmp_path = f'{path}.tmp.{os.getpid()}'
+    torch.save(obj, tmp_path)
+    _replace(tmp_path, path)
+
+
+CKPT_VERSION = 1
+HEADER = 'header.json'
+
+
+class _TensorRef:
+    """A placeholder for a tensor in the skeleton of a checkpoint."""
+
+    __slots__ = ('key', )
+
+    def __init__(self, key):
+        self.key = key
+
+    def __getstate__(self):
+        return self.key
+
+    def __setstate__(self, state):
+        self.key = state
+
+
+def _split_tensors(obj, tensors, prefix):
+    if torch.is_tensor(obj):
+        tensors[prefix] = obj
+        return _TensorRef(prefix)
+    elif isinstance(obj, dict):
+        return type(obj)((k, _split_tensors(v, tensors, f'{prefix}.{k}')) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(_split_tensors(v, tensors, f'{prefix}.{i}') for i, v in enumerate(obj))
+    else:
+        return obj
+
+
+def _join_tensors(obj, tensors):
+    if isinstance(obj, _TensorRef):
+        return tensors[obj.key]
+    elif isinstance(obj, dict):
+        return type(obj)((k, _join_tensors(v, tensors)) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(_join_tensors(v, tensors) for v in obj)
+    else:
+        return obj
+
+
+def save_mmap(obj, path, fingerprint=None, half=()):
+    '''
+    Save a dictionary of states ``obj`` in the 'mmap' format. Floating point tensors of entries in ``half`` are stored in
+    fp16.
+
+    An existing checkpoint in the 'mmap' format is updated in place (see the module docstring). Otherwise, the checkpoint
+    is written to a temporary directory first, which then replaces ``path``.
+    '''
+    path = Path(path)
+    if path.is_dir():
+        _write_mmap(obj, path, fingerprint, half)
+    else:
+        tmp_path = path.with_name(f'{path.name}.tmp.{os.getpid()}')
+        if tmp_path.is_dir():  # NOTE Left behind by a crash.
+            shutil.rmtree(tmp_path)
+        _write_mmap(obj, tmp_path, fingerprint, half)
+        _replace(tmp_path, path)
+
+
+def _write_mmap(obj, path, fingerprint, half):
+    path.mkdir(parents=True, exist_ok=True)
+    nonce = uuid.uuid4().hex[:8]
+    files = dict()
+    skeleton = dict()
+    for name, state in obj.items():
+        tensors = dict()
+        skeleton[name] = _split_tensors(state, tensors, name)
+        if name in half:
+            tensors = {k: v.half() if v.is_floating_point() else v for k, v in tensors.items()}
+        files[name] = f'{name}.{nonce}.pt'
+        torch.save(tensors, path / files[name])
+    meta = f'meta.{nonce}.pt'
+    torch.save(skeleton, path / meta)
+
+    header = {'version': CKPT_VERSION, 'fingerprint': fingerprint, 'meta': meta, 'files': files, 'half': list(half)}
+    tmp_path = path / f'{HEADER}.tmp'
+    with tmp_path.open('w', encoding='utf8') as fout:
+        json.dump(header, fout, indent=2)
+    os.replace(tmp_path, path / HEADER)
+    # Clean up files from previous saves.
+    current = set(files.values()) | {meta, HEADER}
+    for file_path in path.iterdir():
+        if file_path.name not in current:
+            file_path.unlink()
+
+
+def read_header(path):
+    with (Path(path) / HEADER).open(encoding='utf8') as fin:
+        header = json.load(fin)
+    if header['version'] != CKPT_VERSION:
+        raise RuntimeError(f'Checkpoint version {header["version"]} is not supported.')
+    return header
+
+
+def load_checkpoint(path, fingerprint=None, names=None, mmap=True):
+    '''
+    Load a checkpoint saved in either format. For the 'mmap' format, only entries in ``names`` (all if None) are
+    loaded, tensors are memory-mapped, and ``fingerprint`` (if given) is checked against the header first.
+    '''
+    path = Path(path)
+    if not path.is_dir():
+        return torch.load(path, map_location='cpu', weights_only=False)
+
+    header = read_header(path)
+    if fingerprint is not None and header['fingerprint'] != fingerprint:
+        raise RuntimeError(f'Checkpoint {path} was saved with different vocabs.')
+    skeleton = torch.load(path / header['meta'], weights_only=False)
+    ret = dict()
+    for name, file_name in header['files'].items():
+        if names is not None and name not in names:
+            continue
+        tensors = torch.load(path / file_name, mmap=mmap, map_location='cpu', weights_only=True)
+        if name in header['half']:
+            tensors = {k: v.float() if v.is_floating_point() else v for k, v in tensors.items()}
+        ret[name] = _join_tensors(skeleton[name], tensors)
+    return ret
+
+
+class CheckpointWriter:
+    '''
+    Write checkpoints in a background thread. At most ``max_pending`` checkpoints can wait in the queue, after which
+    ``submit`` blocks until the writer catches up. Errors from the writer are raised by the next ``submit`` or ``flush``.
+    '''
+
+    def __init__(self, max_pending=2, save_fn=save_atomic):
+        self._save_fn = save_fn
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name='checkpoint-writer', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    break
+                obj, paths = item
+                for path in paths:
+                    self._save_fn(obj, path)
+                    logging.info(f'Finished saving checkpoint to {path}')
+            except Exception as e:
+                logging.exception('Failed to save checkpoint.')
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error = self._error
+            self._error = None
+            raise RuntimeError('Checkpoint writer failed.') from error
+
+    def submit(self, obj, *paths):
+        '''
+        Snapshot ``obj`` now and write it to every path in ``paths`` later.
+        '''
+        self._raise_error()
+        if not self._thread.is_alive():
+            raise RuntimeError('Checkpoint writer has been closed.')
+        self._queue.put((snapshot(obj), paths))
+
+    def flush(self):
+        """Block until all submitted checkpoints have been written."""
+        self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
@@ -0,0 +1,74 @@
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from dev_misc import TestCase
+
+from .checkpoint import CheckpointWriter, load_checkpoint, save_atomic, save_mmap, snapshot
+
+
+class TestCheckpointWriter(TestCase):
+
+    def test_snapshot(self):
+        state = {'a': torch.zeros(3), 'b': [np.zeros(2), 1]}
+        ret = snapshot(state)
+        state['a'] += 1
+        state['b'][0] += 1
+        self.assertEqual(ret['a'].sum().item(), 0)
+        self.assertEqual(ret['b'][0].sum(), 0)
+
+    def test_submit(self):
+        writer = CheckpointWriter(max_pending=1)
+        with tempfile.TemporaryDirectory() as log_dir:
+            paths = [str(Path(log_dir) / f'saved.{i}') for i in range(3)]
+            tensor = torch.zeros(3)
+            for i, path in enumerate(paths):
+                writer.submit({'tensor': tensor}, path)
+                tensor += 1
+            writer.flush()
+            for i, path in enumerate(paths):
+                self.assertEqual(torch.load(path)['tensor'][0].item(), i)
+            # No temporary files are left behind.
+            self.assertSetEqual(set(p.name for p in Path(log_dir).iterdir()), {'saved.0', 'saved.1', 'saved.2'})
+        writer.close()
+
+
+class TestMmapCheckpoint(TestCase):
+
+    def _get_ckpt(self):
+        return {'model': {'weight': torch.randn(3, 4), 'step': 10},
+                'flow': {'base': 0.1, 'indices': torch.arange(6).view(2, 3), 'values': torch.rand(3)}}
+
+    def test_save_load(self):
+        ckpt = self._get_ckpt()
+        with tempfile.TemporaryDirectory() as log_dir:
+            path = Path(log_dir) / 'saved.latest'
+            save_mmap(ckpt, path, fingerprint='abc', half=('flow', ))
+            # Saving again replaces the previous files.
+            save_mmap(ckpt, path, fingerprint='abc', half=('flow', ))
+            self.assertEqual(len(list(path.iterdir())), 4)
+            ret = load_checkpoint(path, fingerprint='abc')
+            self.assertTrue(torch.equal(ret['model']['weight'], ckpt['model']['weight']))
+            self.assertEqual(ret['model']['step'], 10)
+            self.assertTrue(torch.equal(ret['flow']['indices'], ckpt['flow']['indices']))
+            self.assertTrue(torch.allclose(ret['flow']['values'], ckpt['flow']['values'], atol=1e-3))
+            self.assertEqual(ret['flow']['values'].dtype, torch.float32)
+            ret = load_checkpoint(path, names=['model'])
+            self.assertSetEqual(set(ret), {'model'})
+            with self.assertRaises(RuntimeError):
+                load_checkpoint(path, fingerprint='xyz')
+
+    def test_switch_format(self):
+        ckpt = self._get_ckpt()
+        with tempfile.TemporaryDirectory() as log_dir:
+            path = Path(log_dir) / 'saved.latest'
+            save_atomic(ckpt, path)
+            save_mmap(ckpt, path)
+            self.assertTrue(path.is_dir())
+            self.assertEqual(load_checkpoint(path)['model']['step'], 10)
+            save_atomic(ckpt, path)
+            self.assertTrue(path.is_file())
+            self.assertEqual(load_checkpoint(path)['model']['step'], 10)
+            self.assertListEqual([p.name for p in Path(log_dir).iterdir()], ['saved.latest'])
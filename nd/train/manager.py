@@ -13,7 +13,8 @@ from nd.model.trie import Trie
 from .trainer import Trainer
 
 
-@use_arguments_as_properties('cog_path', 'lost_lang', 'known_lang', 'batch_size')
+@use_arguments_as_properties('cog_path', 'lost_lang', 'known_lang', 'batch_size', 'bucket_by_length',
+                             'num_workers', 'cache_dir')
 class Manager:
 
     model_cls = DecipherModelWithFlow
@@ -38,14 +39,16 @@ class Manager:
         self._show_data()
 
     def _get_data_loaders(self):
-        build_vocabs(self.cog_path, self.lost_lang, self.known_lang)
-        self.train_data_loader = LostKnownDataLoader(self.lost_lang, self.known_lang, self.batch_size, cognate_only=False)
+        build_vocabs(self.cog_path, self.lost_lang, self.known_lang, cache_dir=self.cache_dir)
+        self.train_data_loader = LostKnownDataLoader(self.lost_lang, self.known_lang, self.batch_size, cognate_only=False,
+                                                     bucket=self.bucket_by_length, num_workers=self.num_workers)
         self.eval_data_loader = LostKnownDataLoader(self.lost_lang, self.known_lang, self.batch_size, cognate_only=True)
         self.flow_data_loader = self.train_data_loader # NOTE The flow instance shares its entire_batch property with train_data_loader.
 
     def _show_data(self):
         log_pp(self.train_data_loader.stats('train'))
         log_pp(self.eval_data_loader.stats('eval'))
+        log_pp(self.train_data_loader.padding_stats('train padding'))
 
     def _get_model(self):
         trie = Trie(self.known_lang)
@@ -1,16 +1,23 @@
 import logging
+from contextlib import nullcontext
 
 import torch
 import torch.nn as nn
 import torch.optim as optim
-from torch.utils.tensorboard import SummaryWriter
 
 from arglib import use_arguments_as_properties
 from dev_misc import Map, Metric, Metrics, Tracker, log_this
+from nd.dataset.vocab import get_fingerprint
 from nd.flow.flow import Flow
+from nd.profile.core import enable, phase, timed_iter
+from nd.profile.memory import MemoryProfiler
+from nd.profile.timer import PhaseTimer
+from nd.profile.trace import TraceCapture
 
+from .checkpoint import CheckpointWriter, load_checkpoint, save_atomic, save_mmap
 
-@use_arguments_as_properties('num_rounds', 'num_epochs_per_M_step', 'saved_path', 'learning_rate', 'log_dir', 'num_cognates', 'inc', 'warm_up_steps', 'capacity', 'save_all', 'eval_interval', 'reg_hyper', 'lost_lang', 'known_lang', 'momentum', 'check_interval')
+
+@use_arguments_as_properties('num_rounds', 'num_epochs_per_M_step', 'saved_path', 'learning_rate', 'log_dir', 'num_cognates', 'inc', 'warm_up_steps', 'capacity', 'save_all', 'eval_interval', 'reg_hyper', 'lost_lang', 'known_lang', 'momentum', 'check_interval', 'tensorboard', 'async_save', 'ckpt_format', 'ckpt_fp16_flow', 'profile_phases', 'profile_memory', 'trace_stage', 'trace_batches', 'trace_on_demand')
 class Trainer:
 
     def __init__(self, model, train_data_loader, flow_data_loader):
@@ -24,7 +31,26 @@ class Trainer:
         self.flow_data_loader = flow_data_loader
         self._init_optimizer()
         self.flow = Flow(self.lost_lang, self.known_lang, self.momentum, self.num_cognates)
-        self.tb_writer = SummaryWriter(self.log_dir)
+        self._ckpt_writer = CheckpointWriter(save_fn=self._save_fn) if self.async_save else None
+        self.tb_writer = None
+        if self.tensorboard:
+            # NOTE Importing tensorboard is slow, so only do it when needed.
+            from torch.utils.tensorboard import SummaryWriter
+            self.tb_writer = SummaryWriter(self.log_dir)
+        self.phase_timer = None
+        if self.profile_phases:
+            self.phase_timer = PhaseTimer(self.log_dir + '/phases.jsonl', tb_writer=self.tb_writer)
+            enable(self.phase_timer)
+        self.memory_profiler = None
+        if self.profile_memory:
+            self.memory_profiler = MemoryProfiler(self.log_dir + '/memory.jsonl')
+            enable(self.memory_profiler)
+        self.trace_capture = None
+        if self.trace_stage or self.trace_on_demand:
+            self.trace_capture = TraceCapture(self.log_dir, num_batches=self.trace_batches,
+                                              on_demand=self.trace_on_demand)
+            if self.trace_stage:
+                self.trace_capture.request(stage=self.trace_stage)
 
     @log_this('IMP')
     def _init_optimizer(self):
@@ -52,10 +78,11 @@ class Trainer:
                     yield param
 
     def load(self):
-        ckpt = torch.load(self.saved_path)
+        ckpt = load_checkpoint(self.saved_path, fingerprint=get_fingerprint(self.lost_lang, self.known_lang))
 
         def try_load(name):
-            src = ckpt[name]
+            # NOTE The optimizer is saved as 'optim'.
+            src = ckpt['optim' if name == 'optimizer' else name]
             dest = getattr(self, name)
             try:
                 dest.load_state_dict(src)
@@ -68,21 +95,43 @@ class Trainer:
         try_load('flow')
         logging.imp(f'Loaded saved states from {self.saved_path}')
 
-    def save(self, suffix='latest'):
+    def save(self, *suffixes):
+        """Save one checkpoint for every suffix (default to 'latest'). With `async_save`, this only takes a snapshot."""
         if self.log_dir:
+            suffixes = suffixes or ('latest', )
             logging.info('Saving to %s' % self.log_dir)
             ckpt = {'model': self.model.state_dict(), 'optim': self.optimizer.state_dict(),
                     'tracker': self.tracker.state_dict(), 'flow': self.flow.state_dict()}
-            torch.save(ckpt, self.log_dir + '/saved.%s' % suffix)
-            logging.info('Finished saving decipher trainer')
+            paths = [self.log_dir + '/saved.%s' % suffix for suffix in suffixes]
+            if self._ckpt_writer:
+                self._ckpt_writer.submit(ckpt, *paths)
+            else:
+                for path in paths:
+                    self._save_fn(ckpt, path)
+                logging.info('Finished saving decipher trainer')
+
+    def _save_fn(self, ckpt, path):
+        if self.ckpt_format == 'mmap':
+            half = ('flow', ) if self.ckpt_fp16_flow else ()
+            save_mmap(ckpt, path, fingerprint=get_fingerprint(self.lost_lang, self.known_lang), half=half)
+        else:
+            save_atomic(ckpt, path)
 
     def train(self, evaluator):
         if self.saved_path:
             self.load()
         else:
             self._init_params()
-        while not self.tracker.finished:
-            self._train_loop(evaluator)
+        try:
+            with self.memory_profiler or nullcontext():
+                while not self.tracker.finished:
+                    self._train_loop(evaluator)
+        finally:
+            # NOTE Also write out an unfinished trace and the queued checkpoints if training fails.
+            if self.trace_capture:
+                self.trace_capture.close()
+            if self._ckpt_writer:
+                self._ckpt_writer.flush()
 
     @property
     def round_num(self):
@@ -93,12 +142,22 @@ class Trainer:
         return self.tracker.current_stage
 
     def _train_loop(self, evaluator):
-        if self.stage.name == 'E step':
-            self._do_E_step()
-        elif self.stage.name == 'M step':
-            self._do_M_step(evaluator)
-        else:
-            raise RuntimeError(f'Not recognized stage name {self.stage.name}')
+        if self.trace_capture:
+            self.trace_capture.poll(self.stage.name, self.epoch)
+        with phase(self.stage.name):
+            if self.stage.name == 'E step':
+                self._do_E_step()
+            elif self.stage.name == 'M step':
+                self._do_M_step(evaluator)
+            else:
+                raise RuntimeError(f'Not recognized stage name {self.stage.name}')
+        if self.trace_capture:
+            self.trace_capture.end_stage()
+        if self.phase_timer:
+            self.phase_timer.flush(self.epoch, round=self.round_num, stage=self.stage.name)
+        round_ends = self.stage.name == 'M step' and self.stage.step + 1 == self.num_epochs_per_M_step
+        if self.memory_profiler and round_ends:
+            self.memory_profiler.report(self.epoch, round=self.round_num)
         self.tracker.update()
 
     def _do_E_step(self):
@@ -113,7 +172,8 @@ class Trainer:
             self.flow.warm_up()
         else:
             with torch.no_grad():
-                self.flow.update(self.model, self.flow_data_loader, num_cognates, edit, self.capacity[0])
+                with phase('flow update'):
+                    self.flow.update(self.model, self.flow_data_loader, num_cognates, edit, self.capacity[0])
                 self._init_params()
                 self._init_optimizer()
 
@@ -123,7 +183,8 @@ class Trainer:
 
     def _prepare_flow(self, batch):
         """Add flow-related info to the batch."""
-        flow_info = self.flow.select(batch.lost.words, batch.known.words)
+        with phase('flow select'):
+            flow_info = self.flow.select(batch.lost.words, batch.known.words)
         batch.update(flow_info)
 
     def _do_M_step(self, evaluator):
@@ -131,8 +192,10 @@ class Trainer:
         self._do_post_M_step(evaluator)
 
     def _M_step_kernel(self):
-        for batch in self.train_data_loader:
+        for batch in timed_iter('collate', self.train_data_loader):
             self._M_step_kernel_loop(batch)
+            if self.trace_capture:
+                self.trace_capture.step()
 
     def _M_step_kernel_loop(self, batch, update=True):
         self._prepare_flow(batch)
@@ -146,19 +209,24 @@ class Trainer:
 
     def _do_eval(self, evaluator):
         num_cognates = min(self.round_num * self.inc, self.num_cognates)
-        eval_scores = evaluator.evaluate(self.epoch, num_cognates)
+        with phase('eval'):
+            eval_scores = evaluator.evaluate(self.epoch, num_cognates)
         # Tensorboard
-        for setting, score in eval_scores.items():
-            self.tb_writer.add_scalar(setting, score, global_step=self.epoch)
-        self.tb_writer.flush()
+        if self.tb_writer:
+            for setting, score in eval_scores.items():
+                self.tb_writer.add_scalar(setting, score, global_step=self.epoch)
+            self.tb_writer.flush()
         # Save
-        self.save()
-        if self.save_all:
-            self.save(suffix=self.epoch)
+        with phase('checkpoint'):
+            if self.save_all:
+                self.save('latest', self.epoch)
+            else:
+                self.save()
 
     def _do_check(self):
         self.tracker.check_metrics(self.epoch)
-        self.tb_writer.add_scalar('loss', self.tracker.metrics.loss.mean, global_step=self.epoch)
+        if self.tb_writer:
+            self.tb_writer.add_scalar('loss', self.tracker.metrics.loss.mean, global_step=self.epoch)
         self.tracker.clear_metrics()
 
     def _do_M_step_batch(self, batch, update=True):
@@ -175,10 +243,12 @@ class Trainer:
         num_samples = Metric('num_samples', batch.num_samples, 0, report_mean=False)
         metrics = self._analyze_model_return(model_ret, batch)
         # Compute gradients and backprop.
-        metrics.loss.mean.backward()
-        grad_norm = nn.utils.clip_grad_norm_(self._get_trainable_params(), 5.0)
+        with phase('backward'):
+            metrics.loss.mean.backward()
+        with phase('optimizer step'):
+            grad_norm = nn.utils.clip_grad_norm_(self._get_trainable_params(), 5.0)
+            self.optimizer.step()
         grad_norm = Metric('grad_norm', grad_norm * num_samples.total, num_samples.total)
-        self.optimizer.step()
         # Update metrics.
         metrics += Metrics(num_samples, grad_norm)
         self.tracker.update_metrics(metrics)
@@ -186,7 +256,7 @@ class Trainer:
     def _analyze_model_return(self, model_ret, batch):
         reg_loss = Metric('reg_loss', model_ret.reg_loss, batch.total_flow_k)
         # NOTE This means we are conditioning on one specific flow.
-        nll_losses = torch.logsumexp((model_ret.valid_log_probs + (batch.flow + 1e-8).log()).tensor, dim=0)
+        nll_losses = model_ret.valid_log_probs.logsumexp_over_rows(offset=(batch.flow + 1e-8).log())
         nll_losses = nll_losses * batch.flow_k
         nll_loss = Metric('nll_loss', -nll_losses.sum(), batch.total_flow_k)
         loss = Metric('loss', self.reg_hyper * reg_loss.mean + nll_loss.mean, 1)